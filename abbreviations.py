@@ -0,0 +1,110 @@
+"""
+Expansion of the abbreviations and synonyms of institution names.
+
+Display names are often abbreviated, e.g. 'Harvard-Smithsonian Ctr.
+Astrophys.', while affiliations usually spell the words out. Both the
+indexer and the searcher rewrite the words of the table to a single
+canonical form so that all the spellings end up identical. All the
+abbreviations are matched in one pass by a regular expression factored
+as a trie, which does not backtrack over the alternatives.
+
+Abbreviations that are also words or parts of real names, such as 'Tech'
+in 'Virginia Tech' or 'Soc' in 'SOC', are only expanded when they end with
+a dot.
+"""
+
+import re
+
+# Lowercase abbreviation or synonym: canonical form. An abbreviation also
+# matches with a trailing dot, which is removed.
+ABBREVIATIONS = {
+        'acad': 'Academy',
+        'assoc': 'Association',
+        'astron': 'Astronomy',
+        'astrophys': 'Astrophysics',
+        'centre': 'Center',
+        'chem': 'Chemistry',
+        'coll': 'College',
+        'ctr': 'Center',
+        'dept': 'Department',
+        'div': 'Division',
+        'engn': 'Engineering',
+        'fac': 'Faculty',
+        'geophys': 'Geophysics',
+        'hosp': 'Hospital',
+        'inst': 'Institute',
+        'intl': 'International',
+        'lab': 'Laboratory',
+        'labs': 'Laboratories',
+        'math': 'Mathematics',
+        'natl': 'National',
+        'nucl': 'Nuclear',
+        'observ': 'Observatory',
+        'phys': 'Physics',
+        'sch': 'School',
+        'technol': 'Technology',
+        'univ': 'University',
+        }
+
+# Ambiguous abbreviations, only expanded with their trailing dot.
+DOTTED_ABBREVIATIONS = {
+        'obs': 'Observatory',
+        'res': 'Research',
+        'sci': 'Science',
+        'soc': 'Society',
+        'tech': 'Technology',
+        }
+
+def _get_trie_pattern(words):
+    """
+    Returns a regular expression matching any of the words, factored by
+    common prefixes.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for character in word:
+            node = node.setdefault(character, {})
+        node[''] = {}
+
+    def get_pattern(node):
+        alternatives = [re.escape(character) + get_pattern(child)
+                for character, child in sorted(node.items()) if character]
+        if not alternatives:
+            return ''
+        if len(alternatives) == 1:
+            pattern = alternatives[0]
+        else:
+            pattern = '(?:%s)' % '|'.join(alternatives)
+        if '' in node:
+            return '(?:%s)?' % pattern
+        return pattern
+
+    return get_pattern(trie)
+
+RE_ABBREVIATIONS = re.compile(r'\b(?:(%s)\b\.?|(%s)\.)' % (_get_trie_pattern(ABBREVIATIONS),
+        _get_trie_pattern(DOTTED_ABBREVIATIONS)), re.IGNORECASE | re.UNICODE)
+
+# Normalized word: normalized canonical word, for the word-level indexes.
+# The normalized words have lost their dots, so the ambiguous abbreviations
+# are left as they are.
+CANONICAL_WORDS = dict((abbreviation, canonical.lower())
+        for abbreviation, canonical in ABBREVIATIONS.items())
+
+def _replace(match):
+    if match.group(1):
+        return ABBREVIATIONS[match.group(1).lower()]
+    return DOTTED_ABBREVIATIONS[match.group(2).lower()]
+
+def expand_abbreviations(text):
+    """
+    Returns the text with the abbreviations and synonyms replaced by their
+    canonical form.
+    """
+    return RE_ABBREVIATIONS.sub(_replace, text)
+
+def get_canonical_word(word):
+    """
+    Returns the canonical form of a normalized word.
+    """
+    return CANONICAL_WORDS.get(word, word)
@@ -0,0 +1,102 @@
+"""
+Clustering of near-duplicate affiliations with MinHash LSH.
+
+Affiliations that only differ by zip codes, street numbers, punctuation or
+a department prefix are grouped together. Only the most frequent
+affiliation of each cluster is searched and its match is given to the
+members that are similar enough to it. The other members are searched on
+their own.
+"""
+
+import re
+
+from minhash import MinHasher, get_shingles, jaccard
+
+RE_DIGITS = re.compile(r'\d+')
+
+# Members at least this similar to the representative inherit its match.
+PROPAGATION_THRESHOLD = 0.8
+# Affiliations sharing an LSH band are only clustered above this similarity.
+CLUSTER_THRESHOLD = 0.6
+
+def get_affiliation_shingles(affiliation):
+    """
+    Numbers are removed as they mostly are zip codes and street numbers.
+    """
+    return get_shingles(RE_DIGITS.sub(' ', affiliation))
+
+def cluster_affiliations(affiliations, threshold=CLUSTER_THRESHOLD, bands=20, rows=5):
+    """
+    Groups the affiliations of a dictionary {affiliation: number of
+    occurrences}. Returns a list of (representative, members) where the
+    representative is the most frequent member.
+    """
+    hasher = MinHasher(bands, rows)
+    names = sorted(affiliations, key=lambda a: (-affiliations[a], a))
+    shingles = [get_affiliation_shingles(name) for name in names]
+
+    # Union-find over the affiliation numbers. Within a bucket every
+    # affiliation is only compared to the first one, which keeps the cost
+    # linear for the huge buckets of very common patterns.
+    parents = range(len(names))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    buckets = {}
+    for i, affiliation_shingles in enumerate(shingles):
+        for key in hasher.get_band_keys(hasher.get_signature(affiliation_shingles)):
+            first = buckets.setdefault(key, i)
+            if first != i and find(first) != find(i) and \
+                    jaccard(shingles[first], affiliation_shingles) >= threshold:
+                # The most frequent affiliation stays the root.
+                root1, root2 = find(first), find(i)
+                parents[max(root1, root2)] = min(root1, root2)
+
+    clusters = {}
+    for i in xrange(len(names)):
+        clusters.setdefault(find(i), []).append(i)
+
+    return [(names[root], [names[i] for i in members])
+            for root, members in sorted(clusters.items())]
+
+def search_clustered(affiliations, search_function, threshold=PROPAGATION_THRESHOLD):
+    """
+    Searches the affiliations of a dictionary {affiliation: number of
+    occurrences} with `search_function`, which takes a list of affiliations
+    and returns (affiliation, results) pairs like search_institutions.
+
+    Returns the (affiliation, results) pairs of all the affiliations, or None
+    if the search failed, and statistics about the queries that were avoided.
+    """
+    propagated = {}
+    queries = []
+    for representative, members in cluster_affiliations(affiliations):
+        queries.append(representative)
+        representative_shingles = get_affiliation_shingles(representative)
+        for member in members:
+            if member == representative:
+                continue
+            if jaccard(representative_shingles, get_affiliation_shingles(member)) >= threshold:
+                propagated[member] = representative
+            else:
+                # Not similar enough to trust the match of the representative.
+                queries.append(member)
+
+    statistics = {
+            'affiliations': len(affiliations),
+            'queries': len(queries),
+            'avoided': len(propagated),
+            }
+
+    results = search_function(queries)
+    if results is None:
+        return None, statistics
+
+    results = dict(results)
+    out = [(affiliation, results[affiliation]) for affiliation in queries]
+    out += [(member, results[representative]) for member, representative in propagated.items()]
+    return out, statistics
@@ -0,0 +1,150 @@
+"""
+Approximate nearest-neighbour index of the institution names.
+
+Every name, name variant and acronym is turned into a MinHash signature of
+its hashed character n-grams and stored under its LSH band keys. The index
+is built by institution_indexer and consists of:
+
+    ann_keys.bin      sorted 64-bit band keys
+    ann_entries.bin   the name entry of each key
+    ann_names.marshal the entries (institution id, display name, name) and
+                      the MinHash parameters
+
+The key files are memory-mapped and searched by bisection, so finding the
+candidates of a query only costs a few binary searches per band whatever
+the size of the index. The candidates are then ranked by the Jaccard
+similarity of their n-grams with the query.
+"""
+
+import marshal
+import os
+import re
+import struct
+
+import local_indexes
+from minhash import MinHasher, get_shingles, jaccard
+
+KEYS_FILE = 'ann_keys.bin'
+ENTRIES_FILE = 'ann_entries.bin'
+NAMES_FILE = 'ann_names.marshal'
+
+NAME_FIELDS = ('display_name', 'institution', 'institution_acronym', 'name_variants')
+
+RE_SEGMENT_SEPARATORS = re.compile('[,;]')
+
+def get_names(document):
+    """
+    Returns the unique names of an institution document.
+    """
+    names = []
+    for field in NAME_FIELDS:
+        values = document.get(field) or []
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            if value and value not in names:
+                names.append(value)
+    return names
+
+def build_ann_index(documents, directory, bands=16, rows=4, ngram=3, seed=1):
+    """
+    Builds the index of the names of the documents and writes it to
+    `directory`.
+    """
+    hasher = MinHasher(bands, rows, seed)
+    entries = []
+    pairs = []
+    for document in documents:
+        for name in get_names(document):
+            signature = hasher.get_signature(get_shingles(name, ngram))
+            for key in hasher.get_band_keys(signature):
+                pairs.append((key, len(entries)))
+            entries.append((document['id'], document['display_name'], name))
+    pairs.sort()
+
+    keys = struct.pack('<%dQ' % len(pairs), *[key for key, _ in pairs])
+    entry_numbers = struct.pack('<%dI' % len(pairs), *[entry for _, entry in pairs])
+
+    local_indexes.write_file(os.path.join(directory, KEYS_FILE), keys)
+    local_indexes.write_file(os.path.join(directory, ENTRIES_FILE), entry_numbers)
+    parameters = {'bands': bands, 'rows': rows, 'ngram': ngram, 'seed': seed}
+    local_indexes.write_file(os.path.join(directory, NAMES_FILE),
+            marshal.dumps((parameters, entries)))
+
+class AnnIndex(object):
+    """
+    Read-only view of an index built by build_ann_index.
+    """
+
+    def __init__(self, directory):
+        parameters, self.entries = marshal.load(open(os.path.join(directory, NAMES_FILE), 'rb'))
+        self.ngram = parameters['ngram']
+        self.hasher = MinHasher(parameters['bands'], parameters['rows'], parameters['seed'])
+        self.keys = local_indexes.map_file(os.path.join(directory, KEYS_FILE))
+        self.entry_numbers = local_indexes.map_file(os.path.join(directory, ENTRIES_FILE))
+        self.size = len(self.keys) / 8
+        self._shingles = {}
+
+    def _get_key(self, position):
+        return struct.unpack_from('<Q', self.keys, position * 8)[0]
+
+    def _lookup(self, key):
+        """
+        Returns the entries stored under a band key.
+        """
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        entries = []
+        while low < self.size and self._get_key(low) == key:
+            entries.append(struct.unpack_from('<I', self.entry_numbers, low * 4)[0])
+            low += 1
+        return entries
+
+    def get_candidates(self, text):
+        """
+        Returns the numbers of the entries that share a band with the text.
+        """
+        signature = self.hasher.get_signature(get_shingles(text, self.ngram))
+        candidates = set()
+        for key in self.hasher.get_band_keys(signature):
+            candidates.update(self._lookup(key))
+        return candidates
+
+    def _get_entry_shingles(self, entry):
+        shingles = self._shingles.get(entry)
+        if shingles is None:
+            shingles = self._shingles[entry] = get_shingles(self.entries[entry][2], self.ngram)
+        return shingles
+
+    def search(self, text, k=10, ids=None):
+        """
+        Returns the `k` institutions with the most similar names, in the
+        format of institution_searcher.search_institution. If `ids` is given,
+        only these institutions are returned.
+
+        An affiliation is much longer than an institution name, so each of
+        its comma-separated segments is looked up on its own and an
+        institution gets the score of its best matching segment.
+        """
+        best = {}
+        for segment in RE_SEGMENT_SEPARATORS.split(text):
+            shingles = get_shingles(segment, self.ngram)
+            if len(shingles) < 2:
+                continue
+            for entry in self.get_candidates(segment):
+                identifier, display_name, _ = self.entries[entry]
+                if ids is not None and identifier not in ids:
+                    continue
+                score = jaccard(shingles, self._get_entry_shingles(entry))
+                if score > best.get(identifier, (0, None))[0]:
+                    best[identifier] = (score, display_name)
+
+        results = sorted(best.items(), key=lambda item: item[1][0], reverse=True)[:k]
+        return [{'id': identifier, 'display_name': display_name, 'score': score}
+                for identifier, (score, display_name) in results]
@@ -0,0 +1,149 @@
+"""
+Prefix index of the institution names for type-ahead lookups.
+
+The normalized names, name variants and acronyms are stored in a sorted
+array, together with their suffixes starting at a word so that 'smithsonian'
+completes 'Harvard-Smithsonian Center for Astrophysics'. The index is built
+by institution_indexer and consists of:
+
+    autocomplete_keys.bin      the sorted UTF-8 keys, concatenated
+    autocomplete_offsets.bin   32-bit offset of each key and of the end
+    autocomplete_entries.bin   32-bit entry of each key
+    autocomplete_top.marshal   the best entries of the short prefixes
+    autocomplete_names.marshal the entries (institution id, display name)
+
+The files are memory-mapped and the keys starting with a prefix, which are
+contiguous, are found by bisection and ranked. A short prefix starts too
+many keys to rank them at every lookup, so its completions are ranked when
+the index is built. UTF-8 preserves the order of the code points, so the
+keys are compared as bytes without being decoded.
+"""
+
+import heapq
+import marshal
+import os
+import struct
+
+import ann_index
+import local_indexes
+from text_normalization import normalize
+
+KEYS_FILE = 'autocomplete_keys.bin'
+OFFSETS_FILE = 'autocomplete_offsets.bin'
+ENTRIES_FILE = 'autocomplete_entries.bin'
+TOP_FILE = 'autocomplete_top.marshal'
+NAMES_FILE = 'autocomplete_names.marshal'
+
+# The completions of the prefixes of at most SHORT_PREFIX_LENGTH characters
+# are ranked at build time, up to TOP_COMPLETIONS of them.
+SHORT_PREFIX_LENGTH = 3
+TOP_COMPLETIONS = 20
+
+def build_autocomplete_index(documents, directory):
+    """
+    Builds the prefix index of the names of the documents and writes it to
+    `directory`.
+    """
+    entries = []
+    keys = set()
+    for document in documents:
+        entry = len(entries)
+        entries.append((document['id'], document['display_name']))
+        for name in ann_index.get_names(document):
+            words = normalize(name).encode('utf_8').split()
+            for position in xrange(len(words)):
+                # The low bit tells whether the key is a suffix of the name,
+                # which ranks it after the names starting with the prefix.
+                keys.add((' '.join(words[position:]), entry << 1 | (position > 0)))
+    keys = sorted(keys)
+
+    # Best rank of every institution for each short prefix, ranked as in
+    # AutocompleteIndex.complete.
+    best = {}
+    for key, entry in keys:
+        rank = (entry & 1, len(key), entry >> 1)
+        characters = key.decode('utf_8')
+        for length in xrange(1, min(len(characters), SHORT_PREFIX_LENGTH) + 1):
+            prefix_best = best.setdefault(characters[:length].encode('utf_8'), {})
+            if rank < prefix_best.get(entry >> 1, (2,)):
+                prefix_best[entry >> 1] = rank
+    top = {}
+    for prefix, prefix_best in best.iteritems():
+        top[prefix] = [entry for _, _, entry in
+                heapq.nsmallest(TOP_COMPLETIONS, prefix_best.values())]
+
+    offsets = [0]
+    for key, _ in keys:
+        offsets.append(offsets[-1] + len(key))
+
+    local_indexes.write_file(os.path.join(directory, KEYS_FILE),
+            ''.join([key for key, _ in keys]))
+    local_indexes.write_file(os.path.join(directory, OFFSETS_FILE),
+            struct.pack('<%dI' % len(offsets), *offsets))
+    local_indexes.write_file(os.path.join(directory, ENTRIES_FILE),
+            struct.pack('<%dI' % len(keys), *[entry for _, entry in keys]))
+    local_indexes.write_file(os.path.join(directory, TOP_FILE), marshal.dumps(top))
+    local_indexes.write_file(os.path.join(directory, NAMES_FILE), marshal.dumps(entries))
+
+class AutocompleteIndex(object):
+    """
+    Read-only view of an index built by build_autocomplete_index.
+    """
+
+    def __init__(self, directory):
+        self.names = marshal.load(open(os.path.join(directory, NAMES_FILE), 'rb'))
+        self.top = marshal.load(open(os.path.join(directory, TOP_FILE), 'rb'))
+        self.keys = local_indexes.map_file(os.path.join(directory, KEYS_FILE))
+        self.offsets = local_indexes.map_file(os.path.join(directory, OFFSETS_FILE))
+        self.entries = local_indexes.map_file(os.path.join(directory, ENTRIES_FILE))
+        self.size = len(self.entries) / 4
+
+    def _get_key(self, position):
+        start, end = struct.unpack_from('<II', self.offsets, position * 4)
+        return self.keys[start:end]
+
+    def _get_entry(self, position):
+        return struct.unpack_from('<I', self.entries, position * 4)[0]
+
+    def complete(self, prefix, k=10):
+        """
+        Returns the (institution id, display name) of at most k institutions
+        with a name starting with the prefix, or a word of the name starting
+        with it. Names starting with the prefix come first, then the matches
+        are ranked by length.
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        if len(prefix) <= SHORT_PREFIX_LENGTH and k <= TOP_COMPLETIONS:
+            return [self.names[entry] for entry in
+                    self.top.get(prefix.encode('utf_8'), [])[:k]]
+        prefix = prefix.encode('utf_8')
+
+        start = self._bisect(lambda key: key < prefix)
+        end = self._bisect(lambda key: key[:len(prefix)] <= prefix, start)
+
+        # Best (suffix bit, key length) of every institution of the keys
+        # starting with the prefix, which are not sorted by length.
+        best = {}
+        for position in xrange(start, end):
+            key_start, key_end = struct.unpack_from('<II', self.offsets, position * 4)
+            entry = self._get_entry(position)
+            rank = (entry & 1, key_end - key_start, entry >> 1)
+            if rank < best.get(entry >> 1, (2,)):
+                best[entry >> 1] = rank
+        return [self.names[entry] for _, _, entry in heapq.nsmallest(k, best.values())]
+
+    def _bisect(self, is_before, low=0):
+        """
+        Returns the position of the first key from `low` on that is not
+        before, given that the keys before come first.
+        """
+        high = self.size
+        while low < high:
+            middle = (low + high) // 2
+            if is_before(self._get_key(middle)):
+                low = middle + 1
+            else:
+                high = middle
+        return low
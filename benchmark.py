@@ -0,0 +1,445 @@
+#!/usr/bin/python
+"""
+Benchmarks that run without Solr or Celery.
+
+Usage: python benchmark.py [options] benchmark_name [benchmark_name ...]
+"""
+
+from collections import defaultdict
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from overload import AIMDLimiter, CircuitBreaker, QueryGuard
+from scheduler import AdaptiveScheduler
+
+def get_skewed_latencies(number, mean_latency, seed=0):
+    """
+    Returns per-query latencies drawn from a heavy-tailed distribution and
+    sorted so that the slow queries are clustered at the end of the input,
+    the way long affiliations or fuzzy queries often are.
+    """
+    generator = random.Random(seed)
+    latencies = [generator.paretovariate(1.5) for _ in xrange(number)]
+    scale = mean_latency * number / sum(latencies)
+    return sorted(latency * scale for latency in latencies)
+
+def _sleep_chunk(latencies):
+    """
+    Latency stand-in for search_chunk: sleeps for each query of the chunk.
+    """
+    start = time.time()
+    for latency in latencies:
+        time.sleep(latency)
+    return {'results': latencies, 'elapsed': time.time() - start}
+
+def _fail_chunk(latencies, failing):
+    """
+    Like _sleep_chunk, but reports all the queries as failed if `failing`.
+    """
+    chunk = _sleep_chunk(latencies)
+    chunk['failures'] = failing and len(latencies) or 0
+    return chunk
+
+def _run_static(pool, latencies, workers):
+    """
+    Reproduces the fixed chunking of search_institutions.
+    """
+    chunk_size = len(latencies) / workers or 1
+    chunk_size = min(chunk_size, 1000)
+    task_results = [pool.apply_async(_sleep_chunk, (latencies[i:i+chunk_size],))
+            for i in xrange(0, len(latencies), chunk_size)]
+    results = []
+    for task_result in task_results:
+        results += task_result.get()['results']
+    return results
+
+def benchmark_scheduling(options):
+    """
+    Compares the static and adaptive chunking of search_institutions on a
+    skewed workload.
+    """
+    workers = options.workers
+    latencies = get_skewed_latencies(options.number, options.latency, options.seed)
+    ideal = sum(latencies) / workers
+    print 'Queries: %d, workers: %d, total work: %.2fs, slowest query: %.3fs' % \
+            (len(latencies), workers, sum(latencies), max(latencies))
+    print 'Ideal wall time: %.2fs' % ideal
+
+    pool = ThreadPool(workers)
+
+    start = time.time()
+    _run_static(pool, latencies, workers)
+    elapsed = time.time() - start
+    print 'Static chunks:   %.2fs (%.2fx ideal)' % (elapsed, elapsed / ideal)
+
+    def submit(chunk):
+        return pool.apply_async(_sleep_chunk, (chunk,))
+    scheduler = AdaptiveScheduler(submit, workers, target_duration=options.target)
+    start = time.time()
+    results = scheduler.run(latencies)
+    elapsed = time.time() - start
+    assert results == latencies
+    print 'Adaptive chunks: %.2fs (%.2fx ideal, %d chunks)' % (elapsed,
+            elapsed / ideal, len(scheduler.chunk_sizes))
+
+    # The first 20 chunks report failed queries, so the limiter must shrink
+    # the number of chunks in flight before it grows again.
+    limits = []
+    def submit_failing(chunk):
+        limits.append(limiter.get_limit())
+        return pool.apply_async(_fail_chunk, (chunk, len(limits) <= 20))
+    limiter = AIMDLimiter(initial_limit=workers, max_limit=workers)
+    scheduler = AdaptiveScheduler(submit_failing, workers, target_duration=options.target,
+            limiter=limiter)
+    results = scheduler.run(latencies)
+    assert results == latencies
+    print 'With failures:   limit %d -> %d -> %d' % (workers, min(limits), limiter.get_limit())
+    assert workers == 1 or min(limits) < workers
+
+    pool.terminate()
+
+class OverloadedSolr(object):
+    """
+    Fault-injecting stand-in for a Solr connection with `capacity` request
+    slots. Past its capacity, the service time grows quadratically with the
+    number of requests in flight and requests are rejected with the
+    probability `error_rate`. Requests slower than `timeout` fail after
+    having used the server for `timeout` seconds.
+    """
+
+    def __init__(self, capacity=4, service_time=0.005, timeout=0.1, error_rate=0.2, seed=0):
+        self.capacity = capacity
+        self.service_time = service_time
+        self.timeout = timeout
+        self.error_rate = error_rate
+        self.in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def query(self, q, fields=None):
+        self._lock.acquire()
+        self.in_flight += 1
+        load = float(self.in_flight) / self.capacity
+        rejected = load > 1 and self._random.random() < self.error_rate
+        self._lock.release()
+
+        try:
+            if rejected:
+                raise IOError('HTTP 503: Solr overloaded.')
+            latency = self.service_time * max(load, 1) ** 2
+            if latency > self.timeout:
+                time.sleep(self.timeout)
+                raise socket.timeout('timed out')
+            time.sleep(latency)
+            return []
+        finally:
+            self._lock.acquire()
+            self.in_flight -= 1
+            self._lock.release()
+
+def _run_clients(query, clients, duration):
+    """
+    Runs closed-loop clients for `duration` seconds and returns the number of
+    successful and failed queries.
+    """
+    counts = {'success': 0, 'failure': 0}
+    lock = threading.Lock()
+    end = time.time() + duration
+
+    def client():
+        while time.time() < end:
+            try:
+                query('query')
+                outcome = 'success'
+            except Exception:
+                outcome = 'failure'
+            lock.acquire()
+            counts[outcome] += 1
+            lock.release()
+
+    threads = [threading.Thread(target=client) for _ in xrange(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return counts
+
+def benchmark_overload(options):
+    """
+    Compares unprotected queries with queries going through a QueryGuard
+    against an overloaded Solr stand-in.
+    """
+    clients = options.workers * 4
+    duration = options.duration
+    print 'Clients: %d, stand-in capacity: 4 slots, duration: %.1fs' % (clients, duration)
+
+    solr = OverloadedSolr(seed=options.seed)
+    counts = _run_clients(solr.query, clients, duration)
+    print 'Unprotected: %6.1f successful queries/s, %6.1f failed queries/s' % \
+            (counts['success'] / duration, counts['failure'] / duration)
+
+    solr = OverloadedSolr(seed=options.seed)
+    limiter = AIMDLimiter(initial_limit=clients, max_limit=clients,
+            latency_threshold=solr.service_time * 2)
+    guard = QueryGuard(limiter=limiter,
+            breaker=CircuitBreaker(failure_threshold=20, reset_timeout=0.1),
+            deadline=0.5, retries=2, backoff=0.01)
+    counts = _run_clients(lambda q: guard.call(solr.query, q), clients, duration)
+    print 'Guarded:     %6.1f successful queries/s, %6.1f failed queries/s (final limit %d)' % \
+            (counts['success'] / duration, counts['failure'] / duration, limiter.get_limit())
+
+IMPORT_TIME_MODULES = ('institution_searcher', 'institution_indexer', 'match_client')
+
+def benchmark_import_time(options):
+    """
+    Measures the time needed to import the main modules in a fresh
+    interpreter, which is what every Celery worker and CLI call pays.
+    """
+    for module in IMPORT_TIME_MODULES:
+        code = 'import time; start = time.time(); import %s; print time.time() - start' % module
+        timings = []
+        for _ in xrange(options.repeat):
+            output = subprocess.Popen([sys.executable, '-c', code],
+                    stdout=subprocess.PIPE).communicate()[0]
+            timings.append(float(output.strip().splitlines()[-1]))
+        print '%-22s %7.2fms (best of %d)' % (module, min(timings) * 1000, options.repeat)
+
+ABBREVIATED_AFFILIATIONS = (
+        'Harvard-Smithsonian Ctr. Astrophys., 60 Garden St., Cambridge, MA 02138, USA',
+        'Dept. of Phys. and Astron., Univ. of California, Los Angeles, CA 90095, USA',
+        'Max-Planck-Inst. f\xc3\xbcr Astrophysik, Karl-Schwarzschild-Str. 1, Garching, Germany',
+        'Department of Physics and Astronomy, University of Leicester, Leicester LE1 7RH, UK',
+        'Lawrence Berkeley Natl. Lab., 1 Cyclotron Road, Berkeley, CA 94720',
+        'Space Research Institute (IKI), Moscow, Russia',
+        )
+
+def benchmark_abbreviations(options):
+    """
+    Measures the throughput of the abbreviation expansion alone and of the
+    whole query cleaning, in seconds per million strings.
+    """
+    from abbreviations import expand_abbreviations
+    from institution_searcher import _clean_affiliation
+
+    random.seed(options.seed)
+    affiliations = [random.choice(ABBREVIATED_AFFILIATIONS) for _ in xrange(options.number)]
+    for name, function in (('expand_abbreviations', expand_abbreviations),
+            ('_clean_affiliation', _clean_affiliation)):
+        timings = []
+        for _ in xrange(options.repeat):
+            start = time.time()
+            for affiliation in affiliations:
+                function(affiliation)
+            timings.append(time.time() - start)
+        print '%-22s %7.2fs per million strings (best of %d)' % (name,
+                min(timings) * 1e6 / len(affiliations), options.repeat)
+
+NAME_WORDS = ('Institute', 'University', 'Laboratory', 'Center', 'National',
+        'Physics', 'Astronomy', 'Astrophysics', 'Space', 'Research', 'Science',
+        'Observatory', 'Nuclear', 'Theoretical', 'Applied', 'Department')
+
+def get_synthetic_documents(number, seed=0):
+    """
+    Returns institution documents with random names made of common words
+    and of a random place name.
+    """
+    random.seed(seed)
+    documents = []
+    for i in xrange(number):
+        place = ''.join(random.choice('bcdfghklmnprstvz') + random.choice('aeiou')
+                for _ in xrange(random.randint(2, 4))).title()
+        name = ' '.join(random.sample(NAME_WORDS, random.randint(1, 4)) + [place])
+        acronym = ''.join(word[0] for word in name.split())
+        documents.append({'id': str(900000 + i), 'display_name': name,
+                'institution_acronym': [acronym], 'name_variants': [place + ' ' + name]})
+    return documents
+
+def benchmark_autocomplete(options):
+    """
+    Builds the prefix index of `number` synthetic institutions and measures
+    the latency of completions of prefixes of 1 to 8 characters.
+    """
+    import shutil
+    import tempfile
+    from autocomplete import AutocompleteIndex, build_autocomplete_index
+
+    documents = get_synthetic_documents(options.number, options.seed)
+    directory = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        build_autocomplete_index(documents, directory)
+        print 'Built the index of %d institutions in %.2fs' % (len(documents), time.time() - start)
+        index = AutocompleteIndex(directory)
+
+        names = [random.choice(documents)['display_name'].split()[-1] for _ in xrange(1000)]
+        for length in (1, 2, 4, 8):
+            prefixes = [name[:length] for name in names]
+            timings = []
+            for _ in xrange(options.repeat):
+                start = time.time()
+                for prefix in prefixes:
+                    index.complete(prefix, 10)
+                timings.append(time.time() - start)
+            print 'Prefixes of %d characters: %.3fms per completion (best of %d)' % (length,
+                    min(timings) * 1000 / len(prefixes), options.repeat)
+    finally:
+        shutil.rmtree(directory)
+
+def get_synthetic_evaluation(number, seed=0):
+    """
+    Returns an evaluation in the format of institution_test_suite.evaluate
+    and the ICN dictionary it was made from. Some ICNs are not ASCII.
+    """
+    random.seed(seed)
+    icns = {}
+    for i in xrange(max(number / 20, 2)):
+        icn = '%s %s %d' % (random.choice(NAME_WORDS), random.choice(NAME_WORDS), i)
+        if not i % 10:
+            icn = icn.replace('e', '\xc3\xa9')
+        icns[icn] = ['%s variant %d' % (icn, j) for j in xrange(random.randint(1, 5))]
+    names = sorted(icns)
+
+    evaluation = []
+    for _ in xrange(number):
+        icn = random.choice(names)
+        institution = random.choice(icns[icn])
+        draw = random.random()
+        if draw < 0.1:
+            top = []
+        else:
+            first = draw < 0.7 and icn or random.choice(names)
+            scores = sorted([random.uniform(0.5, 10.) for _ in xrange(random.randint(1, 5))],
+                    reverse=True)
+            top = [(scores[0], first.decode('utf-8'))] + \
+                    [(score, random.choice(names).decode('utf-8')) for score in scores[1:]]
+        evaluation.append((icn, institution, top))
+    return evaluation, icns
+
+def benchmark_evaluation_analysis(options):
+    """
+    Compares the analyses of institution_test_suite with their vectorized
+    versions on a synthetic evaluation of `number` records. Raises an
+    AssertionError if any number differs.
+    """
+    import institution_test_suite as t
+    import warnings
+    from evaluation_arrays import EvaluationArrays
+
+    # Non-ASCII byte strings are compared with unicode names on purpose.
+    warnings.simplefilter('ignore', UnicodeWarning)
+
+    evaluation, icns = get_synthetic_evaluation(options.number, options.seed)
+
+    def run_loops():
+        res = t.get_matches(evaluation)
+        correct, incorrect = t.separate_results(res)
+        top_results = dict((institution, top) for _, institution, top in evaluation)
+        ratios = [t.compute_ratios(correct, top_results), t.compute_ratios(incorrect, top_results)]
+        histograms = []
+        for r in ratios:
+            clustered = defaultdict(list)
+            for inst, ratio in r:
+                clustered[ratio].append(inst)
+            histograms.append([len(clustered[float(i) / 20]) for i in range(0, 21)])
+        return (len([r for r in res if r[0] == r[2]]), len(res)), ratios, histograms, \
+                t.get_sorted_errors(res), t.analyse_icns(res, icns)
+
+    def run_arrays():
+        arrays = EvaluationArrays(evaluation)
+        ratios = [arrays.compute_ratios(True), arrays.compute_ratios(False)]
+        histograms = [arrays.get_ratio_histogram(True).tolist(),
+                arrays.get_ratio_histogram(False).tolist()]
+        return arrays.get_statistics(), ratios, histograms, arrays.get_sorted_errors(), \
+                arrays.analyse_icns(icns)
+
+    outputs = []
+    for name, function in (('loops', run_loops), ('arrays', run_arrays)):
+        timings = []
+        for _ in xrange(options.repeat):
+            start = time.time()
+            output = function()
+            timings.append(time.time() - start)
+        outputs.append(output)
+        print '%-6s %8.3fs for %d records (best of %d)' % (name, min(timings),
+                len(evaluation), options.repeat)
+
+    names = ('statistics', 'ratios', 'histograms', 'sorted errors', 'ICN analysis')
+    for name, loops, arrays in zip(names, *outputs):
+        assert loops == arrays, 'Different %s.' % name
+    print 'Identical results.'
+
+def benchmark_indexing(options):
+    """
+    Generates the MARCXML files of `scale` times the synthetic institutions
+    of synthetic_data.py and measures their parsing into the documents sent
+    to Solr, and the peak memory of the process.
+    """
+    import resource
+    import shutil
+    import tempfile
+    import institution_indexer
+    import synthetic_data
+
+    directory = tempfile.mkdtemp()
+    try:
+        institutions = synthetic_data.generate_institutions(
+                int(synthetic_data.INSTITUTIONS_PER_SCALE * options.scale), options.seed)
+        paths = synthetic_data.write_institution_files(institutions, directory)
+        del institutions
+        start = time.time()
+        documents = institution_indexer.get_institution_documents(directory)
+        elapsed = time.time() - start
+        print 'Parsed %d files into %d documents in %.2fs (%.0f documents/s)' % (len(paths),
+                len(documents), elapsed, len(documents) / elapsed)
+        print 'Peak memory: %.1f MB' % (
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+    finally:
+        shutil.rmtree(directory)
+
+BENCHMARKS = {
+        'abbreviations': benchmark_abbreviations,
+        'autocomplete': benchmark_autocomplete,
+        'evaluation_analysis': benchmark_evaluation_analysis,
+        'import_time': benchmark_import_time,
+        'indexing': benchmark_indexing,
+        'overload': benchmark_overload,
+        'scheduling': benchmark_scheduling,
+        }
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    usage = "usage: %%prog [options] benchmark [benchmark ...]\n\nBenchmarks: %s" % \
+            ', '.join(sorted(BENCHMARKS))
+    parser = OptionParser(usage=usage)
+    parser.add_option("-n", "--number", dest="number", type="int", default=2000,
+            help="number of queries")
+    parser.add_option("-w", "--workers", dest="workers", type="int", default=8,
+            help="number of parallel workers")
+    parser.add_option("-l", "--latency", dest="latency", type="float", default=0.005,
+            help="mean simulated query latency in seconds")
+    parser.add_option("-t", "--target", dest="target", type="float", default=0.2,
+            help="target chunk duration of the adaptive scheduler in seconds")
+    parser.add_option("-d", "--duration", dest="duration", type="float", default=3.,
+            help="duration of the load benchmarks in seconds")
+    parser.add_option("-r", "--repeat", dest="repeat", type="int", default=5,
+            help="number of repetitions of the timing benchmarks")
+    parser.add_option("-s", "--seed", dest="seed", type="int", default=0,
+            help="random seed")
+    parser.add_option("--scale", dest="scale", type="float", default=1.,
+            help="scale factor of the synthetic data, see synthetic_data.py")
+
+    options, args = parser.parse_args()
+    if not args:
+        parser.error("no benchmark given")
+    for name in args:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark: %s" % name)
+
+    for name in args:
+        print '== %s ==' % name
+        BENCHMARKS[name](options)
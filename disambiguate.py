@@ -3,13 +3,17 @@ import os
 import re
 import time
 
+import affiliation_clusters
 import institution_searcher as s
+import profiling
 import spreadsheet_interface
 from clean_ads_affiliations import _preclean_affiliation
 from ads.Unicode import UnicodeHandlerError
 
 STATS = {}
 
+FAILED_PATH = 'var/failed_affiliations.txt'
+
 def get_affiliations(path):
     """
     Reads the affiliations from an affiliation file and returns a dictionary
@@ -76,6 +80,14 @@ def upload_matched(matched, spreadsheet_name, output_number, affiliations):
 
     spreadsheet_interface.upload_data(output, spreadsheet_name, 'Matched')
 
+def output_failed(failed, path):
+    """
+    Writes the affiliations whose search failed so that they can be retried.
+    """
+    if not os.path.exists(os.path.dirname(path)):
+        os.mkdir(os.path.dirname(path))
+    open(path, 'w').write('\n'.join(r[0] for r in failed))
+
 def upload_unmatched(unmatched, spreadsheet_name, output_number, affiliations):
     output = [{'affiliation': r[0], 'number': affiliations[r[0]]} for r in unmatched]
     output = sorted(output, key=lambda r: int(r['number']), reverse=True)[:output_number]
@@ -84,16 +96,28 @@ def upload_unmatched(unmatched, spreadsheet_name, output_number, affiliations):
 
     spreadsheet_interface.upload_data(output, spreadsheet_name, 'Unmatched')
 
-def main(affiliation_file, spreadsheet_name, everything, output_number):
+def get_search_function(affinity=False, adaptive=False, batch=False):
+    """
+    Returns a function searching a list of affiliations.
+    """
+    if batch:
+        import tfidf_matcher
+        return tfidf_matcher.search_institutions
+    return lambda affs: s.search_institutions(affs, affinity=affinity, adaptive=adaptive)
+
+def main(affiliation_file, spreadsheet_name, everything, output_number, affinity=False, adaptive=False, batch=False, cluster=False, profiler=None):
     """
     Run the affiliation disambiguation and upload the unmatched affiliations
-    to Google Docs.
+    to Google Docs. The stages are profiled by `profiler`, if any.
     """
+    if profiler is None:
+        profiler = profiling.Profiler()
     STATS['datetime'] = time.asctime()
     STATS['affiliationfile'] = os.path.basename(affiliation_file)
     print 'Reading affiliations from %s.' % affiliation_file
     try:
-        affiliations = get_affiliations(affiliation_file)
+        with profiler.stage('read'):
+            affiliations = get_affiliations(affiliation_file)
     except IOError, e:
         print 'Impossible to read file: %s' % e
 
@@ -104,18 +128,37 @@ def main(affiliation_file, spreadsheet_name, everything, output_number):
         affiliations = dict(sorted(affiliations.items(), key=lambda aff: aff[1], reverse=True)[:output_number])
 
     print 'Disambiguating %d affiliations...' % len(affiliations)
-    res = s.search_institutions(affiliations.keys())
+    search_function = get_search_function(affinity, adaptive, batch)
+    with profiler.stage('search'):
+        if cluster:
+            res, cluster_stats = affiliation_clusters.search_clustered(affiliations, search_function)
+            print 'Clustering avoided %d of %d queries.' % (cluster_stats['avoided'],
+                    cluster_stats['affiliations'])
+        else:
+            res = search_function(affiliations.keys())
+    if res is None:
+        # The search function has already reported the error.
+        print 'Impossible to disambiguate the affiliations.'
+        return
     print 'Done disambiguating.'
 
-    spreadsheet_interface.connect()
-    unmatched = [r for r in res if not r[1]]
-    STATS['unmatched'] = len(unmatched)
-    upload_unmatched(unmatched, spreadsheet_name, output_number, affiliations)
-    matched = [r for r in res if r[1]]
-    STATS['matched'] = len(matched)
-    upload_matched(matched, spreadsheet_name, output_number, affiliations)
+    # None means that the search failed, an empty list that nothing matched.
+    failed = [r for r in res if r[1] is None]
+    if failed:
+        print 'Warning: %d searches failed, see %s.' % (len(failed), FAILED_PATH)
+        output_failed(failed, FAILED_PATH)
+
+    with profiler.stage('upload'):
+        spreadsheet_interface.connect()
+        unmatched = [r for r in res if r[1] is not None and not r[1]]
+        STATS['unmatched'] = len(unmatched)
+        upload_unmatched(unmatched, spreadsheet_name, output_number, affiliations)
+        matched = [r for r in res if r[1]]
+        STATS['matched'] = len(matched)
+        upload_matched(matched, spreadsheet_name, output_number, affiliations)
 
-    spreadsheet_interface.upload_statistics(STATS, spreadsheet_name)
+        spreadsheet_interface.upload_statistics(STATS, spreadsheet_name)
+    profiler.finish()
 
 if __name__ == '__main__':
     from optparse import OptionParser
@@ -126,6 +169,21 @@ if __name__ == '__main__':
     parser.add_option("-e", "--everything",
             action="store_true", dest="everything", default=False,
             help="find both matched and unmatched affiliations")
+    parser.add_option("-a", "--affinity",
+            action="store_true", dest="affinity", default=False,
+            help="route each affiliation to the worker that has it cached")
+    parser.add_option("--adaptive",
+            action="store_true", dest="adaptive", default=False,
+            help="size the chunks from the observed query latency")
+    parser.add_option("-b", "--batch",
+            action="store_true", dest="batch", default=False,
+            help="match locally with sparse TF-IDF matrices instead of Solr")
+    parser.add_option("-c", "--cluster",
+            action="store_true", dest="cluster", default=False,
+            help="only search one affiliation per cluster of near duplicates")
+    parser.add_option("--profile",
+            action="store_true", dest="profile", default=False,
+            help="profile the stages into %s, see profiling.py" % profiling.PROFILE_DIRECTORY)
 
     options, args = parser.parse_args()
     if len(args) != 2:
@@ -140,4 +198,7 @@ if __name__ == '__main__':
     except TypeError:
         parser.error('wrong output number')
 
-    main(affiliation_file, spreadsheet_name, options.everything, output_number)
+    profiler = profiling.Profiler(options.profile and
+            profiling.get_run_directory('disambiguate') or None)
+    main(affiliation_file, spreadsheet_name, options.everything, output_number,
+            options.affinity, options.adaptive, options.batch, options.cluster, profiler)
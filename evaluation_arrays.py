@@ -0,0 +1,195 @@
+"""
+Analysis of the evaluations of institution_test_suite with NumPy arrays.
+
+The (icn, institution, top results) records of an evaluation are turned
+once into arrays of integer codes, scores and correctness flags, from which
+the statistics, the separation ratios, the error counts and the edit
+distances are computed without Python loops over the records. The results
+are identical to those of the functions of institution_test_suite, which
+benchmark.py checks on a synthetic evaluation.
+
+Requires NumPy.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import Levenshtein
+except ImportError:
+    Levenshtein = None
+
+from institution_test_suite import get_matches
+
+NAN = float('nan')
+
+# Number of pairs of strings whose edit distances are computed together.
+DISTANCE_BATCH_SIZE = 4096
+
+def _encode(values, vocabulary):
+    """
+    Returns the codes of the values in the vocabulary, which is extended
+    with the new values. None is coded -1.
+    """
+    return numpy.array([value is None and -1 or vocabulary.setdefault(value, len(vocabulary))
+            for value in values], dtype=numpy.int64)
+
+def _get_strings(vocabulary):
+    strings = [None] * len(vocabulary)
+    for value, code in vocabulary.items():
+        strings[code] = value
+    return strings
+
+def get_edit_distances(strings1, strings2):
+    """
+    Returns the Levenshtein distances between the byte strings of two lists
+    as an array. The C implementation of python-Levenshtein is used if it
+    is installed.
+    """
+    if Levenshtein is not None:
+        return numpy.array([Levenshtein.distance(string1, string2)
+                for string1, string2 in zip(strings1, strings2)], dtype=numpy.int64)
+    return get_vectorized_edit_distances(strings1, strings2)
+
+def get_vectorized_edit_distances(strings1, strings2):
+    """
+    Same as get_edit_distances with NumPy only. The pairs are sorted by
+    length and processed in batches, each with one dynamic programming pass
+    vectorized over the batch.
+    """
+    distances = numpy.zeros(len(strings1), dtype=numpy.int64)
+    lengths1 = numpy.array([len(s) for s in strings1], dtype=numpy.int64)
+    lengths2 = numpy.array([len(s) for s in strings2], dtype=numpy.int64)
+    order = numpy.lexsort((lengths2, lengths1))
+
+    for start in xrange(0, len(order), DISTANCE_BATCH_SIZE):
+        batch = order[start:start + DISTANCE_BATCH_SIZE]
+        batch_lengths1, batch_lengths2 = lengths1[batch], lengths2[batch]
+        width1, width2 = batch_lengths1.max(), batch_lengths2.max()
+        characters1 = numpy.zeros((len(batch), width1), dtype=numpy.uint8)
+        characters2 = numpy.zeros((len(batch), width2), dtype=numpy.uint8)
+        for row, i in enumerate(batch):
+            characters1[row, :lengths1[i]] = numpy.frombuffer(strings1[i], dtype=numpy.uint8)
+            characters2[row, :lengths2[i]] = numpy.frombuffer(strings2[i], dtype=numpy.uint8)
+
+        # Row 0 of the dynamic programming table: distances to the empty
+        # prefix of the first strings.
+        previous = numpy.tile(numpy.arange(width2 + 1, dtype=numpy.int64), (len(batch), 1))
+        result = batch_lengths2.copy()
+        rows = numpy.arange(len(batch))
+        for i in xrange(width1):
+            current = numpy.empty_like(previous)
+            current[:, 0] = i + 1
+            costs = characters2 != characters1[:, i:i + 1]
+            substitutions = previous[:, :-1] + costs
+            deletions = previous[:, 1:] + 1
+            best = numpy.minimum(substitutions, deletions)
+            for j in xrange(width2):
+                current[:, j + 1] = numpy.minimum(best[:, j], current[:, j] + 1)
+            previous = current
+            finished = batch_lengths1 == i + 1
+            result[finished] = current[rows[finished], batch_lengths2[finished]]
+        distances[batch] = result
+    return distances
+
+class EvaluationArrays(object):
+    """
+    Evaluation of institution_test_suite.evaluate held as arrays.
+    """
+
+    def __init__(self, evaluation):
+        matches = get_matches(evaluation)
+        self.institutions = [institution for _, institution, _ in evaluation]
+
+        vocabulary = {}
+        self.icn_codes = _encode([icn for icn, _, _ in matches], vocabulary)
+        self.match_codes = _encode([match for _, _, match in matches], vocabulary)
+        self.names = _get_strings(vocabulary)
+        self.correct = self.icn_codes == self.match_codes
+
+        # The two first scores of each record, NaN when missing. As in
+        # institution_test_suite, an institution has the results of its last
+        # record.
+        first_scores = {}
+        for _, institution, top in evaluation:
+            top = (top or [])[:2]
+            first_scores[institution] = [result[0] for result in top] + [NAN] * (2 - len(top))
+        self.scores = numpy.array([first_scores[institution] for institution in self.institutions],
+                dtype=numpy.float64).reshape((len(evaluation), 2))
+
+    def get_statistics(self):
+        """
+        Returns the number of correct matches and the number of records.
+        """
+        return int(self.correct.sum()), len(self.correct)
+
+    def get_ratio_buckets(self, correct=True):
+        """
+        Returns the record numbers and the buckets, in twentieths, of the
+        ratios of the two first scores of the correct or incorrect matches.
+        """
+        mask = (self.correct == correct) & ~numpy.isnan(self.scores[:, 1])
+        records = numpy.nonzero(mask)[0]
+        buckets = (self.scores[records, 1] / self.scores[records, 0] * 20).astype(numpy.int64)
+        return records, buckets
+
+    def compute_ratios(self, correct=True):
+        """
+        Same as institution_test_suite.compute_ratios on the correct or
+        incorrect matches.
+        """
+        records, buckets = self.get_ratio_buckets(correct)
+        ratios = buckets.astype(numpy.float64) / 20
+        return [(self.institutions[record], ratio)
+                for record, ratio in zip(records.tolist(), ratios.tolist())]
+
+    def get_ratio_histogram(self, correct=True):
+        """
+        Returns the numbers printed by institution_test_suite.display_ratios:
+        the number of ratios in each of the 21 buckets from 0 to 1.
+        """
+        _, buckets = self.get_ratio_buckets(correct)
+        return numpy.bincount(buckets[(buckets >= 0) & (buckets <= 20)], minlength=21)[:21]
+
+    def get_sorted_errors(self):
+        """
+        Same as institution_test_suite.get_sorted_errors.
+        """
+        counts = numpy.bincount(self.icn_codes[~self.correct], minlength=len(self.names))
+        codes = numpy.nonzero(counts)[0]
+        return sorted(zip(counts[codes].tolist(), [self.names[c] for c in codes]), reverse=True)
+
+    def analyse_icns(self, icns):
+        """
+        Same as institution_test_suite.analyse_icns. The edit distances are
+        only computed once per distinct pair of ICNs.
+        """
+        encoded = [isinstance(name, str) and name or name.encode('utf-8') for name in self.names]
+        vocabulary = {}
+        codes = _encode(encoded, vocabulary)
+        strings = _get_strings(vocabulary)
+
+        matched = self.match_codes >= 0
+        originals = codes[self.icn_codes[matched]]
+        matches = codes[self.match_codes[matched]]
+        different = originals != matches
+        originals, matches = originals[different], matches[different]
+        if not len(originals):
+            return []
+
+        pairs, inverse = numpy.unique(originals * len(strings) + matches, return_inverse=True)
+        pair_originals, pair_matches = pairs // len(strings), pairs % len(strings)
+        distances = get_edit_distances([strings[c] for c in pair_originals],
+                [strings[c] for c in pair_matches])[inverse]
+        weights = numpy.array([1. / len(icns[s]) if s in icns else numpy.nan
+                for s in strings])[originals]
+
+        # Ranks of the strings so that the sort matches the sort of tuples.
+        ranks = numpy.empty(len(strings), dtype=numpy.int64)
+        ranks[sorted(xrange(len(strings)), key=strings.__getitem__)] = numpy.arange(len(strings))
+        order = numpy.lexsort((ranks[matches], ranks[originals], weights, distances))
+        return [(distance, weight, strings[original], strings[match])
+                for distance, weight, original, match in zip(distances[order].tolist(),
+                        weights[order].tolist(), originals[order].tolist(), matches[order].tolist())]
@@ -0,0 +1,119 @@
+"""
+Country and city detection used to block the candidates of a search.
+
+The gazetteer is built by institution_indexer from the country,
+country_code and city values of the indexed institutions, so it only knows
+places that can actually narrow the search. Detection looks at the trailing
+segments of an affiliation, where places are usually written, and tries
+the longest word sequences first.
+"""
+
+import marshal
+import os
+import re
+
+import local_indexes
+from text_normalization import normalize
+
+GAZETTEER_FILE = 'gazetteer.marshal'
+
+# Fields in the order of preference for blocking.
+BLOCK_FIELDS = ('country', 'country_code', 'city')
+
+RE_SEGMENT_SEPARATORS = re.compile('[,;]')
+
+def build_gazetteer(documents, directory):
+    """
+    Builds the gazetteer of the places of the documents and writes it to
+    `directory`.
+    """
+    places = {}
+    ids = {}
+    for document in documents:
+        for field in BLOCK_FIELDS:
+            for value in document.get(field) or []:
+                if field == 'country_code':
+                    # Codes such as DE or IN are common words in lowercase.
+                    phrase = value.strip()
+                else:
+                    phrase = normalize(value)
+                if not phrase:
+                    continue
+                filters = places.setdefault(phrase, [])
+                if (field, value) not in filters:
+                    filters.append((field, value))
+                ids.setdefault((field, value), []).append(document['id'])
+
+    local_indexes.write_file(os.path.join(directory, GAZETTEER_FILE), marshal.dumps((places, ids)))
+
+class Gazetteer(object):
+
+    def __init__(self, directory):
+        self.places, ids = marshal.load(open(os.path.join(directory, GAZETTEER_FILE), 'rb'))
+        self.ids = dict((key, frozenset(value)) for key, value in ids.items())
+        self.max_words = max([len(phrase.split()) for phrase in self.places] or [0])
+
+    def _find(self, segment):
+        """
+        Returns the filters of the longest place found in a segment.
+        """
+        code = segment.strip()
+        if code in self.places:
+            return [f for f in self.places[code] if f[0] == 'country_code']
+
+        words = normalize(segment).split()
+        for size in xrange(min(self.max_words, len(words)), 0, -1):
+            # Places are usually at the end of a segment.
+            for start in xrange(len(words) - size, -1, -1):
+                filters = self.places.get(' '.join(words[start:start + size]))
+                if filters:
+                    return [f for f in filters if f[0] != 'country_code']
+        return []
+
+    def detect(self, affiliation, segments=3):
+        """
+        Returns a dictionary {field: value} with at most one country and one
+        city found in the last `segments` segments of the affiliation.
+        """
+        if not isinstance(affiliation, unicode):
+            affiliation = affiliation.decode('utf_8', 'replace')
+
+        found = {}
+        for segment in reversed(RE_SEGMENT_SEPARATORS.split(affiliation)[-segments:]):
+            blocks = {}
+            for field, value in self._find(segment):
+                block = field == 'city' and 'city' or 'country'
+                blocks.setdefault(block, []).append((field, value))
+            if 'country' in blocks:
+                # Cities named after their country, e.g. Luxembourg.
+                blocks.pop('city', None)
+            for block, filters in blocks.items():
+                # Names with several values are too ambiguous to block.
+                if len(filters) == 1 and block not in found:
+                    found[block] = filters[0]
+        return dict(found.values())
+
+    def get_filter_query(self, block):
+        """
+        Returns a Solr filter query for a block returned by detect(). Solr
+        caches filter queries independently of the main query.
+        """
+        clauses = []
+        for field in BLOCK_FIELDS:
+            if field in block:
+                clauses.append('%s:"%s"' % (field, block[field].replace('"', '')))
+        return ' AND '.join(clauses)
+
+    def get_ids(self, block):
+        """
+        Returns the set of the ids of the institutions of a block, for the
+        matchers that run in the process.
+        """
+        ids = None
+        for field, value in block.items():
+            block_ids = self.ids.get((field, value), frozenset())
+            if ids is None:
+                ids = block_ids
+            else:
+                ids = ids & block_ids
+        return ids
@@ -0,0 +1,91 @@
+"""
+Mapping of the legacy institution codes (ICN) to the current ones.
+
+Inspire records keep the legacy ICN in 110__u and the current one in
+110__t. The indexer writes the deduplicated pairs once, at the end of the
+indexing, as:
+
+    icn_mapping.txt      sorted 'legacy ICN<TAB>current ICN' lines
+    icn_mapping.offsets  32-bit offset of each line and of the end
+
+Both files are memory-mapped and a legacy ICN is looked up by bisection,
+without loading the mapping.
+"""
+
+import os
+import struct
+
+import local_indexes
+
+MAPPING_FILE = 'icn_mapping.txt'
+OFFSETS_FILE = 'icn_mapping.offsets'
+
+def get_icn_pairs(documents):
+    """
+    Returns the sorted (legacy ICN, current ICN) pairs of the documents,
+    with a single current ICN per legacy ICN.
+    """
+    mapping = {}
+    for document in sorted(documents, key=lambda d: d['id']):
+        old = (document.get('desy_icn') or u'').strip().encode('utf_8')
+        new = document['display_name'].strip().encode('utf_8')
+        if old and new and old != new:
+            mapping.setdefault(old, new)
+    return sorted(mapping.items())
+
+def build_icn_mapping(documents, directory):
+    """
+    Writes the mapping of the legacy ICNs of the documents to `directory`.
+    """
+    lines = ['%s\t%s\n' % pair for pair in get_icn_pairs(documents)]
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+
+    local_indexes.write_file(os.path.join(directory, MAPPING_FILE), ''.join(lines))
+    local_indexes.write_file(os.path.join(directory, OFFSETS_FILE),
+            struct.pack('<%dI' % len(offsets), *offsets))
+
+class IcnMapping(object):
+    """
+    Read-only view of a mapping built by build_icn_mapping.
+    """
+
+    def __init__(self, directory):
+        self.lines = local_indexes.map_file(os.path.join(directory, MAPPING_FILE))
+        self.offsets = local_indexes.map_file(os.path.join(directory, OFFSETS_FILE))
+        self.size = max(len(self.offsets) / 4 - 1, 0)
+
+    def _get_pair(self, position):
+        start, end = struct.unpack_from('<II', self.offsets, position * 4)
+        return self.lines[start:end - 1].split('\t', 1)
+
+    def __len__(self):
+        return self.size
+
+    def get_current_icn(self, icn):
+        """
+        Returns the current ICN of a legacy ICN, or None if it is not a
+        legacy ICN. The result has the type of the argument.
+        """
+        decode = isinstance(icn, unicode)
+        key = decode and icn.encode('utf_8') or icn
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_pair(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.size:
+            old, new = self._get_pair(low)
+            if old == key:
+                return decode and new.decode('utf_8') or new
+        return None
+
+    def resolve(self, icn):
+        """
+        Returns the current ICN of an ICN, which is the ICN itself if it is
+        not a legacy one.
+        """
+        return self.get_current_icn(icn) or icn
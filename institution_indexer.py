@@ -1,9 +1,7 @@
 #!/usr/bin/python
 
-import ConfigParser
 import os
 import re
-import solr
 import sys
 import time
 import urllib2
@@ -14,12 +12,18 @@ except ImportError:
     # Invenio is not installed, use fallback standalone bibrecord.
     import bibrecord
 
-cfg = ConfigParser.ConfigParser()
-cfg.read('accounts.cfg')
+import local_indexes
+import profiling
+from abbreviations import expand_abbreviations
+from solr_connection import SolrConnections
 
-CONNECTION = solr.SolrConnection(cfg.get('solr', 'url'),
-        http_user=cfg.get('solr', 'user'),
-        http_pass=cfg.get('solr', 'password'))
+CONNECTIONS = SolrConnections()
+
+def get_connection():
+    """
+    Returns the Solr connection of the current process and thread.
+    """
+    return CONNECTIONS.get()
 
 INDEX_FIELDS = {
         'institution': ['110__a', '110__t', '110__u', '110__x'],
@@ -33,17 +37,19 @@ INDEX_FIELDS = {
         'country_code': ['371__g'],
         }
 
-if not os.path.exists('etc'):
-    os.mkdir('etc')
+def create_directory(path):
+    if not os.path.exists(path):
+        os.mkdir(path)
 
 def delete_solr_documents():
-    CONNECTION.delete_query('*:*')
-    CONNECTION.commit()
+    get_connection().delete_query('*:*')
+    get_connection().commit()
 
 def get_institution_marcxml():
     """
     Downloads the Inspire institution database.
     """
+    create_directory('etc')
     marcxml = download_institution_chunk(0)
     out = open('etc/institutions_000.xm', 'w')
     out.write(marcxml)
@@ -73,9 +79,16 @@ def get_institution_records(path):
     """
     return [res[0] for res in bibrecord.create_records(open(path).read())]
 
-def index_records(records):
+def get_institution_files(directory='etc'):
     """
-    Indexes all the institution records and then commits.
+    Returns the paths of the downloaded institution MARCXML files.
+    """
+    return [os.path.join(directory, path) for path in sorted(os.listdir(directory))
+            if path.endswith('.xm')]
+
+def get_indexable_records(records):
+    """
+    Returns the indexable data of the records that should be indexed.
     """
     to_add = []
     for record in records:
@@ -84,8 +97,24 @@ def index_records(records):
             if not data['display_name'].startswith('Unlisted') and \
                 not data['display_name'].startswith('obsolete'):
                 to_add.append(data)
+    return to_add
 
-    CONNECTION.add_many(to_add)
+def get_institution_documents(directory='etc'):
+    """
+    Returns the indexable data of all the institutions, as sent to Solr.
+    """
+    documents = []
+    for path in get_institution_files(directory):
+        documents += get_indexable_records(get_institution_records(path))
+    return documents
+
+def index_records(records):
+    """
+    Indexes all the institution records and returns the indexed data.
+    """
+    to_add = get_indexable_records(records)
+    get_connection().add_many(to_add)
+    return to_add
 
 def get_name_variants(record):
     """
@@ -133,17 +162,18 @@ def get_indexable_data(record):
         if values:
             data[index] = list(set(values))
 
-    # Name variants
+    # Name variants, with the abbreviations of all the names expanded the
+    # same way as in the searched affiliations.
     name_variants = get_name_variants(record)
+    for name in [data['display_name']] + data.get('institution', []) + name_variants[:]:
+        canonical_name = expand_abbreviations(name)
+        if canonical_name != name and canonical_name not in name_variants:
+            name_variants.append(canonical_name)
     if name_variants:
         data['name_variants'] = name_variants
 
-    old = bibrecord.record_get_field_value(record, '110', '', '', 'u')
-    new = bibrecord.record_get_field_value(record, '110', '', '', 't')
-
-    if old and new and old != new:
-        open('etc/old_new.txt', 'a').write('%s\t%s\n' % (old, new))
-
+    # The legacy ICN of desy_icn is mapped to the display name by
+    # icn_mapping, built with the local indexes.
     return data
 
 def record_is_deleted(record):
@@ -153,17 +183,40 @@ def record_is_deleted(record):
     return bibrecord.record_get_field_value(record, '980', '', '', 'c') == 'DELETED'
 
 if __name__ == '__main__':
-    if sys.argv[-1] == '--download':
+    create_directory('etc')
+    # With --profile, every stage is profiled, see profiling.py.
+    profiler = profiling.Profiler('--profile' in sys.argv and
+            profiling.get_run_directory('indexer') or None)
+    if '--local-indexes' in sys.argv:
+        # Only rebuild the local indexes from the downloaded files.
+        print time.asctime() + ': Building the local indexes.'
+        with profiler.stage('parse'):
+            documents = get_institution_documents('etc')
+        with profiler.stage('local_indexes'):
+            local_indexes.build_local_indexes(documents)
+        profiler.finish()
+        sys.exit(0)
+    if '--download' in sys.argv:
         print time.asctime() + ': Delete all previous institution files.'
         for path in os.listdir('etc'):
             os.remove('etc/' + path)
         print time.asctime() + ': Download the Inspire institution database.'
-        get_institution_marcxml()
+        with profiler.stage('download'):
+            get_institution_marcxml()
     print time.asctime() + ': Delete all documents in Solr.'
-    delete_solr_documents()
+    with profiler.stage('delete'):
+        delete_solr_documents()
     print time.asctime() + ': Indexing in Solr.'
-    for path in sorted(os.listdir('etc')):
+    documents = []
+    for path in get_institution_files('etc'):
         print time.asctime() + ': File %s.' % path
-        records = get_institution_records('etc/' + path)
-        index_records(records)
-    CONNECTION.commit()
+        with profiler.stage('parse'):
+            records = get_institution_records(path)
+        with profiler.stage('index'):
+            documents += index_records(records)
+    with profiler.stage('commit'):
+        get_connection().commit()
+    print time.asctime() + ': Building the local indexes.'
+    with profiler.stage('local_indexes'):
+        local_indexes.build_local_indexes(documents)
+    profiler.finish()
@@ -1,24 +1,51 @@
 #!/usr/bin/python
 
-import ConfigParser
+import hashlib
 import json
 import logging
 import os
 import re
-import solr
+import socket
 import sys
 import time
 import multiprocessing
 import unicodedata
 
+import local_indexes
+import profiling
+import token_features
+import tracing
+from abbreviations import expand_abbreviations
+from lru_cache import LRUCache
+from overload import AIMDLimiter, CircuitBreaker, QueryGuard
+from scheduler import AdaptiveScheduler
+from segmentation import split_affiliation
+from solr_connection import SolrConnections
+
 NUM_OF_CPUS = multiprocessing.cpu_count()
 
-if not os.path.exists('var/error.log'):
-    if not os.path.exists('var'):
-        os.mkdir('var')
-    open('var/error.log', 'w').close() 
+ERROR_LOG = 'var/error.log'
+
+# The errors go to ERROR_LOG through a handler of this logger only, so that
+# the logging of the applications importing the module is left alone.
+LOGGER = logging.getLogger(__name__)
+
+_LOGGING_CONFIGURED = False
 
-logging.basicConfig(filename='var/error.log', level=logging.WARNING)
+def log_error(message):
+    """
+    Logs an error to var/error.log, opening the log on first use.
+    """
+    global _LOGGING_CONFIGURED
+    if not _LOGGING_CONFIGURED:
+        if not os.path.exists(os.path.dirname(ERROR_LOG)):
+            os.mkdir(os.path.dirname(ERROR_LOG))
+        handler = logging.FileHandler(ERROR_LOG)
+        handler.setLevel(logging.WARNING)
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        LOGGER.addHandler(handler)
+        _LOGGING_CONFIGURED = True
+    LOGGER.error(message)
 
 try:
     from celery.task import task
@@ -29,123 +56,402 @@ except ImportError:
             return func(*args, **kwargs)
         return empty_decorator
 
-cfg = ConfigParser.ConfigParser()
-cfg.read('accounts.cfg')
+# Time allowed for a query, retries included, and for a single HTTP request.
+QUERY_DEADLINE = 10.
+QUERY_TIMEOUT = 5.
+
+CONNECTIONS = SolrConnections(timeout=QUERY_TIMEOUT)
 
-CONNECTION = solr.SolrConnection(cfg.get('solr', 'url'),
-        http_user=cfg.get('solr', 'user'),
-        http_pass=cfg.get('solr', 'password'))
+def get_connection():
+    """
+    Returns the Solr connection of the current process and thread.
+    """
+    return CONNECTIONS.get()
+
+_GUARD = (None, None)
+
+def get_guard():
+    """
+    Returns the QueryGuard of the current process. The guard holds locks, so
+    a forked worker creates its own.
+    """
+    global _GUARD
+    pid, guard = _GUARD
+    if pid != os.getpid():
+        # Queries that slow down past the threshold shrink the concurrency limit.
+        guard = QueryGuard(
+                limiter=AIMDLimiter(initial_limit=4, max_limit=32, latency_threshold=2.),
+                breaker=CircuitBreaker(failure_threshold=10, reset_timeout=5.),
+                deadline=QUERY_DEADLINE,
+                retries=2)
+        _GUARD = (os.getpid(), guard)
+    return guard
 
 RE_MULTIPLE_SPACES = re.compile('\s+')
 
 SCORE_PERCENTAGE = 0.8
 
-def search_institution(institution, clean_up=True, logic="OR", fuzzy=False, postprocess=False, fields=('id', 'display_name', 'score')):
+# Results whose separation score with the first result is at most the
+# threshold are reranked by process_results, up to RERANK_CANDIDATES.
+SEPARATION_THRESHOLD = 0.2
+RERANK_CANDIDATES = 10
+
+# Per-process cache of Solr results, keyed by the final query string.
+RESULT_CACHE_SIZE = 10000
+RESULT_CACHE = LRUCache(RESULT_CACHE_SIZE)
+
+# Number of Celery queues used by the cache-affinity routing. Each queue
+# 'affinity.N' should be consumed by exactly one worker process, e.g.:
+#     celeryd -Q affinity.0 -c 1
+AFFINITY_QUEUE_NUMBER = 20
+AFFINITY_QUEUE = 'affinity.%d'
+
+def search_institution(institution, clean_up=True, logic="OR", fuzzy=False, postprocess=True, fields=('id', 'display_name', 'score'), block=False, tag=False):
     """
-    Searches an institution and returns the response object.
+    Searches an institution and returns the list of results. Returns None if
+    the query failed, as opposed to an empty list when nothing matched.
+
+    With `fuzzy`, the candidates come from the local n-gram index when it has
+    been built and from Solr fuzzy queries otherwise.
+
+    With `block`, the search is restricted to the institutions of the
+    country and city found in the affiliation, if any. The unrestricted
+    search is used when the restricted one finds nothing.
+
+    With `tag`, only the known institution names found in the affiliation by
+    the name tagger are searched, when there are some.
+    """
+    query = institution
+    if tag:
+        tagger = local_indexes.get_name_tagger()
+        query = tagger is not None and tagger.get_short_query(institution) or institution
+
+    if block:
+        gazetteer = local_indexes.get_gazetteer()
+        place = gazetteer is not None and gazetteer.detect(institution)
+        if place:
+            results = _search_institution(query, clean_up, logic, fuzzy,
+                    postprocess, fields, place)
+            if results is None or results:
+                return results
+
+    return _search_institution(query, clean_up, logic, fuzzy, postprocess, fields)
+
+def _search_institution(institution, clean_up, logic, fuzzy, postprocess, fields, place=None):
+    """
+    Searches an institution, only among the institutions of `place` if it is
+    a block detected by the gazetteer.
     """
     clean_institution = clean_up and _clean_affiliation(institution) or institution
-    if fuzzy:
-        clean_institution = re.sub('(\s|$)', r'~\1', clean_institution)
-    if logic != 'OR':
-        clean_institution = clean_institution.replace(' ', ' %s ' % logic)
+    ann_index = fuzzy and local_indexes.get_ann_index() or None
+    params = {}
+    if ann_index is not None:
+        # Segments are delimited by the commas removed by the cleaning. The
+        # index ranks names by similarity, so `logic` does not apply.
+        ids = place and local_indexes.get_gazetteer().get_ids(place) or None
+        search = lambda: _get_ann_results(ann_index, institution, ids, fields)
+        # The place is a dictionary, keyed by its filter query as for Solr.
+        cache_key = ('ann', institution, tuple(fields), postprocess,
+                place and local_indexes.get_gazetteer().get_filter_query(place) or None)
+    else:
+        if fuzzy:
+            clean_institution = re.sub('(\s|$)', r'~\1', clean_institution)
+        if logic != 'OR':
+            clean_institution = clean_institution.replace(' ', ' %s ' % logic)
+        if place:
+            # Filter queries are cached by Solr independently of the query.
+            params['fq'] = local_indexes.get_gazetteer().get_filter_query(place)
+        search = lambda: list(get_connection().query(clean_institution, fields=fields,
+                **params).results)
+        cache_key = (clean_institution, tuple(fields), postprocess, params.get('fq'))
+
+    results = RESULT_CACHE.get(cache_key)
+    if results is not None:
+        return list(results)
 
     try:
-        response = CONNECTION.query(clean_institution, fields=fields)
+        results = get_guard().call(search)
     except Exception, e:
         error = {
                 'institution': institution,
                 'clean_institution': clean_institution,
                 'clean_up': clean_up,
                 'time': time.asctime(),
-                'exception': e.reason,
+                'error_type': e.__class__.__name__,
+                'exception': getattr(e, 'reason', None) or str(e),
                 }
-        logging.error(json.dumps(error))
+        log_error(json.dumps(error))
         return None
 
-    results = list(response.results)
     if postprocess == True:
-        process_results(clean_institution, results)
+        # Read at call time so that the threshold can be tuned, e.g. by sweeps.
+        process_results(clean_institution, results, SEPARATION_THRESHOLD)
 
-    return results
+    RESULT_CACHE.set(cache_key, results)
+    return list(results)
 
-def process_results(query, results):
+def _get_ann_results(ann_index, institution, ids, fields):
     """
-    Perform post-processing of the results to improve the matching.
+    Returns the candidates of the local n-gram index with the fields of the
+    Solr results.
     """
-    if len(results) > 1:
-        if get_separation_score(results) <= 0.2:
-            query = query.decode('utf_8')
-            name0 = results[0]['display_name']
-            name1 = results[1]['display_name']
+    return [dict((field, result[field]) for field in fields if field in result)
+            for result in ann_index.search(institution, ids=ids)]
 
-            fquery = fingerprint(query)
-            fname0 = fingerprint(name0)
-            fname1 = fingerprint(name1)
+def process_results(query, results, threshold=SEPARATION_THRESHOLD, k=RERANK_CANDIDATES):
+    """
+    Perform post-processing of the results to improve the matching.
+
+    The first results whose scores are too close to tell them apart are
+    reordered by the proportion of the words of the institution name that
+    appear in the query. The token sets of the names are precomputed by the
+    indexer; the display names are tokenized when they are not available.
+    """
+    if len(results) < 2 or get_separation_score(results) > threshold:
+        return
 
-            p0 = len(fname0.intersection(fquery)) / len(fname0)
-            p1 = len(fname1.intersection(fquery)) / len(fname1)
-            if p1 > p0:
-                print 'INFO: Query "%s" now matches "%s" instead of "%s".' % (query, name1, name0)
-                results[0], results[1] = results[1], results[0]
+    top_score = results[0]['score']
+    candidates = [r for r in results[:k] if 1 - r['score'] / top_score <= threshold]
+
+    features = local_indexes.get_token_features()
+    if features is not None:
+        query_ids = features.get_query_ids(query)
+    query_tokens = token_features.get_tokens(query)
+
+    def get_coverage(result):
+        if features is not None:
+            coverage = features.get_coverage(query_ids, result.get('id'))
+            if coverage is not None:
+                return coverage
+        name = token_features.get_tokens(result['display_name'])
+        return name and float(len(name & query_tokens)) / len(name) or 0.
+
+    # The sort is stable: equally covered results keep the Solr order.
+    candidates.sort(key=get_coverage, reverse=True)
+    if candidates[0] is not results[0]:
+        LOGGER.info('Query "%s" now matches "%s" instead of "%s".', query,
+                candidates[0]['display_name'], results[0]['display_name'])
+    results[:len(candidates)] = candidates
 
 @task
-def search_institutions(institutions, clean_up=True, number_of_processes=NUM_OF_CPUS - 2):
+def search_institutions(institutions, clean_up=True, number_of_processes=NUM_OF_CPUS - 2, affinity=False, adaptive=False, trace=None):
     """
     Searches for multiple institutions.
+
+    The Celery tasks are traced when the SEARCH_TRACE environment variable is
+    set (see tracing.py). `trace` is the trace context of a task.
+
+    With `affinity`, every query is routed to a fixed Celery queue chosen from
+    a hash of its cleaned form so that it lands on the worker that already
+    has it cached. The results are then grouped by queue instead of following
+    the input order.
+
+    With `adaptive`, chunks are sized from the observed query latency and
+    handed out to workers as they become idle (see scheduler.py).
     """
     results = []
 
-    if number_of_processes == 1:
-        for institution in institutions:
-            result = search_institution(institution, clean_up)
-            results.append((institution, result))
+    if affinity and number_of_processes > 1:
+        return search_institutions_affinity(institutions, clean_up)
+    elif adaptive and number_of_processes > 1:
+        tracer = tracing.TaskTracer('search_institutions')
+        def submit(chunk):
+            return tracer.delay(search_chunk, chunk, clean_up)
+        # Fewer chunks are kept in flight while workers report failed queries.
+        limiter = AIMDLimiter(initial_limit=number_of_processes, max_limit=number_of_processes)
+        scheduler = AdaptiveScheduler(submit, number_of_processes, limiter=limiter)
+        try:
+            results = scheduler.run(institutions)
+        except AttributeError:
+            print >> sys.stderr, "Error: Multiprocessing is not available without celery."
+            return
+        tracer.finish()
+        return results
+    elif number_of_processes == 1:
+        task_start = tracing.start_task(trace)
+        # Profiled in the workers started with SEARCH_PROFILE.
+        with profiling.get_task_profiler().stage('search_institutions'):
+            for institution in institutions:
+                start = time.time()
+                result = search_institution(institution, clean_up)
+                tracing.add_span(trace, 'query', start, time.time(), institution=institution,
+                        results=result is not None and len(result) or None)
+                results.append((institution, result))
+        tracing.add_span(trace, 'task', task_start, time.time(), queries=len(institutions))
     elif number_of_processes > 1:
         # Perform a parallelized search.
-        task_results = []
+        tracer = tracing.TaskTracer('search_institutions')
         chunk_size = len(institutions) / number_of_processes or 1
         chunk_size = min(chunk_size, 1000)
 
         for chunk in (institutions[i:i+chunk_size] for i in xrange(0, len(institutions), chunk_size)):
             # Create the task and store the result object.
             try:
-                r = search_institutions.delay(chunk, clean_up, number_of_processes=1)
+                tracer.delay(search_institutions, chunk, clean_up, number_of_processes=1)
             except AttributeError:
                 print >> sys.stderr, "Error: Multiprocessing is not available without celery."
                 return
 
+        # Now we wait that all tasks complete and extract the results.
+        tracer.wait()
+        for chunk_results in tracer.get_results():
+            results += chunk_results
+    else:
+        log_error('Incorrect number of processes: %d' % number_of_processes)
+        return
+
+    return results
+
+def search_segments(institution, clean_up=True, **options):
+    """
+    Searches every institution of a multi-institution affiliation on its
+    own. Returns a list of (segment, results) with a single segment when the
+    affiliation names a single institution. Segments repeat much more than
+    whole affiliations, so they mostly hit the result cache.
+    """
+    tagger = local_indexes.get_name_tagger()
+    return [(segment, search_institution(segment, clean_up, **options))
+            for segment in split_affiliation(institution, tagger)]
+
+def search_institutions_segmented(institutions, clean_up=True, **options):
+    """
+    Like search_institutions, but returns (institution, [(segment, results),
+    ...]) pairs. Every distinct segment is only searched once for all the
+    institutions.
+    """
+    tagger = local_indexes.get_name_tagger()
+    segments = dict((institution, split_affiliation(institution, tagger))
+            for institution in institutions)
+    unique_segments = sorted(set(segment for institution_segments in segments.values()
+            for segment in institution_segments))
+
+    results = search_institutions(unique_segments, clean_up, **options)
+    if results is None:
+        return None
+    results = dict(results)
+    return [(institution, [(segment, results[segment]) for segment in segments[institution]])
+            for institution in institutions]
+
+def search_institutions_affinity(institutions, clean_up=True, number_of_queues=AFFINITY_QUEUE_NUMBER):
+    """
+    Searches for multiple institutions, routing each one to the queue given by
+    `get_affinity_queue`. Prints the cache hit rate of each worker.
+    """
+    buckets = {}
+    for institution in institutions:
+        queue = get_affinity_queue(institution, clean_up, number_of_queues)
+        buckets.setdefault(queue, []).append(institution)
+
+    task_results = []
+    for queue, bucket in sorted(buckets.items()):
+        for i in xrange(0, len(bucket), 1000):
+            try:
+                r = search_chunk.apply_async((bucket[i:i+1000], clean_up), queue=queue)
+            except AttributeError:
+                print >> sys.stderr, "Error: Multiprocessing is not available without celery."
+                return
             task_results.append(r)
 
-        # Now we wait that all tasks complete.
-        while any([not task_result.ready() for task_result in task_results]):
-            time.sleep(0.1)
+    while any([not task_result.ready() for task_result in task_results]):
+        time.sleep(0.1)
 
-       # Extract the results.
-        for task_result in task_results:
-            results += task_result.result
-    else:
-        logging.ERROR('Incorrect number of processes: %d' % number_of_processes)
-        return
+    results = []
+    statistics = {}
+    for task_result in task_results:
+        chunk = task_result.result
+        results += chunk['results']
+        worker = statistics.setdefault(chunk['worker'], {'hits': 0, 'misses': 0})
+        worker['hits'] += chunk['hits']
+        worker['misses'] += chunk['misses']
+
+    print_cache_statistics(statistics)
 
     return results
 
+def get_affinity_queue(institution, clean_up=True, number_of_queues=AFFINITY_QUEUE_NUMBER):
+    """
+    Returns the Celery queue of an institution. The queue only depends on the
+    cleaned query so it is stable across runs and processes.
+    """
+    clean_institution = clean_up and _clean_affiliation(institution) or institution
+    if isinstance(clean_institution, unicode):
+        clean_institution = clean_institution.encode('utf_8')
+    digest = hashlib.md5(clean_institution).hexdigest()
+    return AFFINITY_QUEUE % (int(digest[:8], 16) % number_of_queues)
+
+@task
+def search_chunk(institutions, clean_up=True, trace=None):
+    """
+    Searches a chunk of institutions in the current process and returns the
+    results along with the time spent, the number of failed queries and the
+    result cache activity.
+    """
+    hits, misses = RESULT_CACHE.hits, RESULT_CACHE.misses
+    start = time.time()
+    results = search_institutions(institutions, clean_up, number_of_processes=1, trace=trace)
+    return {
+            'results': results,
+            'elapsed': time.time() - start,
+            'failures': len([r for r in results if r[1] is None]),
+            'worker': get_worker_id(),
+            'hits': RESULT_CACHE.hits - hits,
+            'misses': RESULT_CACHE.misses - misses,
+            }
+
+def get_worker_id():
+    """
+    Returns an identifier of the current process. Computed on each call as
+    Celery workers are forked after this module is imported.
+    """
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def print_cache_statistics(statistics):
+    """
+    Prints the result cache hit rate of each worker.
+    """
+    total_hits, total_lookups = 0, 0
+    for worker, counts in sorted(statistics.items()):
+        lookups = counts['hits'] + counts['misses']
+        total_hits += counts['hits']
+        total_lookups += lookups
+        print 'Worker %s: %d/%d cache hits (%.2f%%)' % (worker, counts['hits'],
+                lookups, lookups and 100. * counts['hits'] / lookups or 0.)
+    print 'Total: %d/%d cache hits (%.2f%%)' % (total_hits, total_lookups,
+            total_lookups and 100. * total_hits / total_lookups or 0.)
+
 def get_best_matches(institution, minimum_score=SCORE_PERCENTAGE):
     """
-    Searches an institution and returns the best match i.e. the best result.
+    Searches an institution and prints the best matches i.e. the results
+    whose score is close enough to the best score.
+    """
+    print_best_matches(get_best_results(institution, minimum_score))
+
+def get_best_results(institution, minimum_score=SCORE_PERCENTAGE):
+    """
+    Searches an institution and returns the best matches.
     """
     results = search_institution(institution)
+    if not results:
+        return results
+
+    minimum_score = results[0]['score'] * minimum_score
+    return [result for result in results if float(result['score']) >= minimum_score]
+
+def print_best_matches(results):
     if results:
-        minimum_score = results[0]['score'] * minimum_score
         for result in results:
-            score = float(result['score'])
-            if score >= minimum_score:
-                print '%.2f' % score, result['id'], result['display_name']
-            else:
-                break
+            print '%.2f' % float(result['score']), result['id'], result['display_name']
     else:
         print 'No result found.'
 
+SEARCH_FAILED = 'SEARCH FAILED'
+
 def get_match(institution):
+    """
+    Returns the (name, separation score) of the best match of an
+    institution, None if nothing matched or SEARCH_FAILED if the search
+    failed.
+    """
     try:
         results = search_institution(institution)
     except:
@@ -160,6 +466,8 @@ def get_match(institution):
         else:
             score = get_separation_score(results)
             return (first_match_name, score)
+    elif results is None:
+        return SEARCH_FAILED
     else:
         return None
 
@@ -174,30 +482,31 @@ def get_separation_score(results):
     return (1 - score2 / score1)
 
 def get_top_results(institution, n):
+    """
+    Returns the (score, name) of the n first results of an institution, an
+    empty list if nothing matched or None if the search failed.
+    """
     try:
         results = search_institution(institution)
     except:
         print _clean_affiliation(institution)
         raise
 
-    if results:
-        out = []
-        for i in range(n):
-            try:
-                result = results[i]
-            except IndexError:
-                break
-            score = result['score']
-            name = RE_MULTIPLE_SPACES.sub(' ', result['display_name'].strip())
-            out.append((score, name))
-        return out
-    else:
+    if results is None:
         return None
+    out = []
+    for result in results[:n]:
+        score = result['score']
+        name = RE_MULTIPLE_SPACES.sub(' ', result['display_name'].strip())
+        out.append((score, name))
+    return out
 
 def output_results(results):
     output = []
     for result in results:
-        if not result[1]:
+        if result[1] is None:
+            output.append('%s\t%s' % (result[0], SEARCH_FAILED))
+        elif not result[1]:
             output.append(result[0])
         elif len(result[1]) == 1:
             name1 = result[1][0]['display_name']
@@ -237,17 +546,53 @@ def get_match_ratio(institutions):
         results.append((institution, top_results))
     return results
 
+@task
+def get_top_matches(institutions, n, trace=None):
+    """
+    Returns the (icn, institution, top n results) of (icn, institution)
+    pairs. The results are the (score, name) pairs of get_top_results.
+    """
+    task_start = tracing.start_task(trace)
+    results = []
+    for icn, institution in institutions:
+        start = time.time()
+        results.append((icn, institution, get_top_results(institution, n)))
+        tracing.add_span(trace, 'query', start, time.time(), institution=institution)
+    tracing.add_span(trace, 'task', task_start, time.time(), queries=len(institutions))
+    return results
+
 RE_CLEAN_AFF = re.compile('[()[\]:&"]')
+RE_LEADING_DASH = re.compile('(^|\s)-')
+RE_RESERVED_TERMS = re.compile('(^|\s)(or|and|not|OR|AND|NOT)($|\s)')
+RE_SEPARATORS = re.compile('[;,/-]')
+RE_SPACES = re.compile('\s\s+')
 
 def _clean_affiliation(aff):
+    # The indexer adds the same canonical forms to the name variants.
+    aff = expand_abbreviations(aff)
     aff = RE_CLEAN_AFF.sub(' ', aff)
-    aff = re.sub('(^|\s)-', r'\1', aff)
+    aff = RE_LEADING_DASH.sub(r'\1', aff)
     # Put reserved search terms in between quotes.
-    aff = re.sub('(^|\s)(or|and|not|OR|AND|NOT)($|\s)', r'\1 \3', aff)
+    aff = RE_RESERVED_TERMS.sub(r'\1 \3', aff)
     # Hack to allow separate token search when separated by slash or semicolon.
-    aff = re.sub('[;,/-]', ' ', aff)
-    aff = re.sub('\s\s+', ' ', aff)
+    aff = RE_SEPARATORS.sub(' ', aff)
+    aff = RE_SPACES.sub(' ', aff)
     return aff.strip()
 
 if __name__ == '__main__':
-    get_best_matches(sys.argv[-1])
+    import match_client
+    if '--profile' in sys.argv[1:-1]:
+        # Profiles the local search, cold and then warm.
+        profiler = profiling.Profiler(profiling.get_run_directory('searcher'))
+        with profiler.stage('first_search'):
+            get_best_matches(sys.argv[-1])
+        RESULT_CACHE.clear()
+        with profiler.stage('second_search'):
+            get_best_matches(sys.argv[-1])
+        profiler.finish()
+        sys.exit(0)
+    try:
+        # Use the match server if it is running, it has everything warm.
+        print_best_matches(match_client.MatchClient().get_best_results(sys.argv[-1]))
+    except match_client.ServerUnavailable:
+        get_best_matches(sys.argv[-1])
@@ -1,33 +1,51 @@
 from collections import defaultdict
-import Levenshtein
 import marshal
 import os
 import re
 import time
 
+import affiliation_clusters
 import institution_searcher as s
+import local_indexes
+import tracing
 
 RE_SPACES = re.compile('\s+')
 
+TEST_FILES = ('tests/astronomy_affiliations', 'tests/physics_affiliations')
+
+# Mapping between old and new ICNs appended by the indexers that predate
+# the local indexes.
+OLD_NEW_PATH = 'etc/old_new.txt'
+
+def get_icn_resolver():
+    """
+    Returns a function mapping a legacy ICN to the current one, from the
+    mapping built with the local indexes or else from etc/old_new.txt.
+    """
+    mapping = local_indexes.get_icn_mapping()
+    if mapping is not None:
+        return mapping.resolve
+    if os.path.exists(OLD_NEW_PATH):
+        old_new = dict(line.rstrip('\n').split('\t', 1) for line in open(OLD_NEW_PATH)
+                if '\t' in line)
+        return lambda icn: old_new.get(icn, icn)
+    raise IOError('No ICN mapping: run institution_indexer.py --local-indexes.')
+
 def get_icns(reextract=False):
     if reextract:
+        resolve = get_icn_resolver()
+
         os.chdir('desy_affiliations')
         import desy_affs
         icns = desy_affs.get_icns()
         os.chdir('..')
 
-        # Find the match file between old and new ICNs.
-        match = dict(line.strip().split('\t') for line in open('old_new.txt').readlines())
-
         for icn in icns.keys():
             if '; 'in icn or icn.endswith(' to be removed'):
                 # Delete pairs of affiliations.
                 del icns[icn]
             else:
-                if icn in match:
-                    new_icn = RE_SPACES.sub(' ', match[icn].strip())
-                else:
-                    new_icn = icn
+                new_icn = RE_SPACES.sub(' ', resolve(icn).strip())
 
                 try:
                     new_icn = new_icn.decode('utf-8')
@@ -56,6 +74,9 @@ def test_icns_only(icns):
     return test([(icn, icn) for icn in icns])
 
 def analyse_icns(res, icns):
+    # Only needed here, so that the evaluation does not depend on it.
+    import Levenshtein
+
     out = []
     for original, _, matched in res:
         if matched is not None:
@@ -73,42 +94,87 @@ def analyse_icns(res, icns):
                     ))
     return sorted(out)
 
-def test(icns):
+# Number of results recorded per query by the evaluation.
+EVALUATION_K = 5
+EVALUATION_PATH = 'var/evaluation.marshal'
+
+def evaluate(icns, k=EVALUATION_K, path=EVALUATION_PATH):
+    """
+    Searches every (icn, institution) pair once and records the top k
+    (score, name) results of each, an empty list if nothing matched or None
+    if the search failed. The evaluation is saved to `path` so that all the
+    analyses can be run offline from it.
+    """
     if isinstance(icns, dict):
         icns = extend_icns(icns)
 
-    results = []
+    tracer = tracing.TaskTracer('evaluate')
     chunk_size = len(icns) / PROCESS_NUMBER + 1
 
     while icns:
         chunk = icns[:chunk_size]
         icns = icns[chunk_size:]
-        results.append(s.match_institutions.delay(chunk))
+        tracer.delay(s.get_top_matches, chunk, k)
 
-    while not all([r.ready() for r in results]):
-        time.sleep(0.1)
+    tracer.wait()
+    evaluation = []
+    for chunk_evaluation in tracer.get_results():
+        evaluation += chunk_evaluation
 
-    out = []
-    for r in results:
-        out += r.result
+    save_evaluation(evaluation, path)
+    return evaluation
 
-    print_statistics(out)
+def save_evaluation(evaluation, path=EVALUATION_PATH):
+    if not os.path.exists(os.path.dirname(path)):
+        os.mkdir(os.path.dirname(path))
+    marshal.dump(evaluation, open(path, 'wb'))
 
+def load_evaluation(path=EVALUATION_PATH):
+    return marshal.load(open(path, 'rb'))
+
+def get_matches(evaluation):
+    """
+    Returns the (icn, institution, matched icn) of an evaluation, with None
+    as matched icn if nothing matched.
+    """
+    out = []
+    for icn, institution, top in evaluation:
+        match = top and top[0][1] or None
+        out.append((icn, institution, match))
     return out
 
-def test_ratio(icns):
-    res = test(icns)
+def test(icns, path=EVALUATION_PATH):
+    """
+    Evaluates the ICNs and prints the accuracy. Returns the matches, from
+    which all the analyses can be computed.
+    """
+    res = get_matches(evaluate(icns, path=path))
+    print_statistics(res)
+    return res
+
+def test_ratio(icns=None, path=EVALUATION_PATH):
+    """
+    Returns the score ratios of the correct and of the incorrect matches,
+    from a new evaluation of the ICNs or from the saved one if no ICNs are
+    given.
+    """
+    if icns is None:
+        evaluation = load_evaluation(path)
+    else:
+        evaluation = evaluate(icns, path=path)
+    res = get_matches(evaluation)
     correct_matches, incorrect_matches = separate_results(res)
 
-    correct_ratios = compute_ratios(correct_matches)
-    incorrect_ratios = compute_ratios(incorrect_matches)
+    top_results = dict((institution, top) for _, institution, top in evaluation)
+    correct_ratios = compute_ratios(correct_matches, top_results)
+    incorrect_ratios = compute_ratios(incorrect_matches, top_results)
 
     return correct_ratios, incorrect_ratios
 
-def compute_ratios(matches):
+def compute_ratios(matches, top_results=None):
     out = []
 
-    for inst, results in get_two_first_results(matches):
+    for inst, results in get_two_first_results(matches, top_results):
         if results and len(results) >= 2:
             out.append((inst, float(int(results[1][0] / results[0][0] * 20)) / 20))
 
@@ -117,17 +183,29 @@ def compute_ratios(matches):
 def display_ratios(ratios):
     clustered = defaultdict(list)
     for inst, ratio in ratios:
-        clustered[ratio].append(clustered)
+        clustered[ratio].append(inst)
 
     for i in [float(i) / 20 for i in range(0, 21)]:
         print len(clustered[i])
 
-def get_two_first_results(institutions):
+def get_two_first_results(institutions, top_results=None):
+    """
+    Returns the two first (score, name) results of the institutions, as
+    recorded by the evaluation, or searched again if `top_results` is None.
+    """
+    if top_results is None:
+        return _search_two_first_results(institutions)
+
+    out = []
+    for institution in institutions:
+        top = top_results.get(institution)
+        out.append((institution, top and top[:2] or None))
+    return out
+
+def _search_two_first_results(institutions):
     results = []
     chunk_size = len(institutions) / PROCESS_NUMBER + 1
 
-    first = []
-
     while institutions:
         chunk = institutions[:chunk_size]
         institutions = institutions[chunk_size:]
@@ -162,6 +240,153 @@ def get_sorted_errors(res):
 
 PREVIOUS_SCORE = 0
 
+def read_test_affiliations(path):
+    """
+    Returns the (affiliation, institution id) pairs of a test file whose
+    lines are formatted as 'affiliation---id'. Affiliations without id have
+    no matching record and their id is None.
+
+    Lines of the synthetic files of synthetic_data.py are formatted as
+    'ids<TAB>affiliation'. The id of an affiliation of several institutions
+    is the tuple of their ids, any of which is a correct match (see
+    is_expected).
+    """
+    pairs = []
+    for line in open(path):
+        # The ids of an affiliation without institution are empty, so the
+        # tab that follows them is kept.
+        line = line.rstrip()
+        if line.strip() and not line.startswith('#'):
+            if '\t' in line:
+                ids, affiliation = line.split('\t', 1)
+                ids = ids.split(',')
+                pairs.append((affiliation, len(ids) > 1 and tuple(ids) or ids[0] or None))
+                continue
+            line = line.strip()
+            if '---' in line:
+                affiliation, icn_id = line.rsplit('---', 1)
+            else:
+                affiliation, icn_id = line, None
+            pairs.append((affiliation, icn_id))
+    return pairs
+
+def is_expected(identifier, icn_id):
+    """
+    Tells whether a result id is the expected id of a test pair, or one of
+    them for the affiliations of several institutions.
+    """
+    if isinstance(icn_id, tuple):
+        return identifier in icn_id
+    return identifier == icn_id
+
+def get_id_accuracy(pairs, results):
+    """
+    Returns the percentage of affiliations whose first result has the
+    expected id, or that have no result when no record matches.
+    """
+    results = dict(results)
+    correct = 0
+    for affiliation, icn_id in pairs:
+        result = results.get(affiliation)
+        if icn_id is None:
+            correct += result is not None and not result
+        elif result and is_expected(result[0]['id'], icn_id):
+            correct += 1
+    return 100. * correct / len(pairs)
+
+def evaluate_clustering(paths=TEST_FILES, search_function=None):
+    """
+    Compares the accuracy and the number of queries of the search with and
+    without clustering of near-duplicate affiliations.
+    """
+    if search_function is None:
+        search_function = lambda affs: s.search_institutions(affs, number_of_processes=1)
+
+    for path in paths:
+        pairs = read_test_affiliations(path)
+        affiliations = defaultdict(int)
+        for affiliation, _ in pairs:
+            affiliations[affiliation] += 1
+
+        accuracy = get_id_accuracy(pairs, search_function(affiliations.keys()))
+        results, statistics = affiliation_clusters.search_clustered(affiliations, search_function)
+        clustered_accuracy = get_id_accuracy(pairs, results)
+
+        print '%s: %d queries avoided out of %d, accuracy %.2f%% -> %.2f%%' % (path,
+                statistics['avoided'], statistics['affiliations'], accuracy, clustered_accuracy)
+
+def evaluate_search_options(paths=TEST_FILES, variants=(('default', {}),)):
+    """
+    Runs the test files through search_institution with each of the
+    (name, keyword arguments) variants and prints the accuracy and the mean
+    query latency of each.
+    """
+    for path in paths:
+        pairs = read_test_affiliations(path)
+        for name, options in variants:
+            results = []
+            start = time.time()
+            for affiliation, _ in pairs:
+                results.append((affiliation, s.search_institution(affiliation, **options)))
+            latency = (time.time() - start) / len(pairs)
+            print '%s [%s]: accuracy %.2f%%, %.1fms per query' % (path, name,
+                    get_id_accuracy(pairs, results), latency * 1000)
+
+def evaluate_blocking(paths=TEST_FILES):
+    """
+    Compares the search with and without country/city blocking.
+    """
+    s.RESULT_CACHE.clear()
+    evaluate_search_options(paths, (('unblocked', {}), ('blocked', {'block': True})))
+
+def evaluate_tagging(paths=TEST_FILES):
+    """
+    Compares the search of the full affiliations with the search of the
+    institution names found by the name tagger, and reports how often the
+    tagger alone names a single institution and how often it is right.
+    """
+    s.RESULT_CACHE.clear()
+    evaluate_search_options(paths, (('full', {}), ('tagged', {'tag': True})))
+
+    tagger = local_indexes.get_name_tagger()
+    if tagger is None:
+        print 'No name tagger, run institution_indexer.py --local-indexes.'
+        return
+    for path in paths:
+        pairs = read_test_affiliations(path)
+        matches = [(tagger.get_direct_match(affiliation), identifier)
+                for affiliation, identifier in pairs]
+        direct = [m for m in matches if m[0] is not None]
+        correct = [m for m in direct if is_expected(m[0], m[1])]
+        print '%s: %d direct matches out of %d, %d correct' % (path, len(direct),
+                len(pairs), len(correct))
+
+def evaluate_segmentation(paths=TEST_FILES):
+    """
+    Compares the search of whole affiliations with the search of their
+    segments: number of Solr queries, latency and accuracy. A segmented
+    affiliation is correct when one of its segments matches the expected id.
+    """
+    for path in paths:
+        pairs = read_test_affiliations(path)
+        for name, search in (('whole', lambda a: [(a, s.search_institution(a))]),
+                ('segmented', s.search_segments)):
+            s.RESULT_CACHE.clear()
+            misses = s.RESULT_CACHE.misses
+            correct, segmented = 0, 0
+            start = time.time()
+            for affiliation, icn_id in pairs:
+                segments = search(affiliation)
+                segmented += len(segments) > 1
+                if icn_id is None:
+                    correct += all(r is not None and not r for _, r in segments)
+                else:
+                    correct += any(r and is_expected(r[0]['id'], icn_id) for _, r in segments)
+            latency = (time.time() - start) / len(pairs)
+            print '%s [%s]: %d affiliations, %d segmented, %d queries, %.1fms per affiliation, accuracy %.2f%%' % (
+                    path, name, len(pairs), segmented, s.RESULT_CACHE.misses - misses,
+                    latency * 1000, 100. * correct / len(pairs))
+
 def print_statistics(results):
     correct = [r for r in results if r[0] == r[2]]
     score = float(len(correct)) / len(results) * 100
@@ -0,0 +1,286 @@
+#!/usr/bin/python
+"""
+Load and soak tests of the matching.
+
+Affiliations of test files, repeated `scale` times, are sent to one of the
+matching functions by a pool of threads or processes:
+
+- closed loop: `concurrency` requests are in flight at any time, and a new
+  one is sent as soon as one completes;
+- open loop: requests are sent at the target rate whether or not the
+  previous ones completed. Their latency is counted from the time they
+  were due, so that the queueing delay of an overloaded deployment shows.
+
+The throughput, the p50/p95/p99/max latencies, the error and empty result
+rates and the resident memory of the workers are reported for every
+interval, and the memory growth of every worker at the end, so that long
+soaks show leaks. With processes, every worker has its own result cache, so
+the hit rate depends on the number of workers, and the reported memory is
+the sum of the resident memory of the workers.
+
+A request is one affiliation, or a batch of them for search_institutions.
+Failed searches (None, or SEARCH_FAILED for get_match) and exceptions count
+as errors.
+
+Usage: python load_test.py [options] [test_file ...]
+"""
+
+import os
+import random
+import threading
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import institution_searcher as s
+from institution_test_suite import TEST_FILES, read_test_affiliations
+from percentiles import get_percentile
+from profiling import get_rss
+
+TARGETS = ('search_institution', 'get_match', 'search_institutions')
+
+OK, EMPTY, ERROR = 'ok', 'empty', 'error'
+
+def get_outcome(result):
+    if result is None:
+        return ERROR
+    elif not result:
+        return EMPTY
+    return OK
+
+def call_target(target, affiliations):
+    """
+    Returns the outcomes of a request of a list of affiliations.
+    """
+    if target == 'search_institution':
+        return [get_outcome(s.search_institution(affiliations[0]))]
+    elif target == 'get_match':
+        match = s.get_match(affiliations[0])
+        if match == s.SEARCH_FAILED:
+            return [ERROR]
+        return [match is None and EMPTY or OK]
+    results = s.search_institutions(affiliations, number_of_processes=1)
+    if results is None:
+        return [ERROR] * len(affiliations)
+    return [get_outcome(result) for _, result in results]
+
+def _run_request(arguments):
+    """
+    Runs a request in a worker and returns its outcomes, the worker process
+    id and its resident memory.
+    """
+    target, affiliations = arguments
+    try:
+        outcomes = call_target(target, affiliations)
+    except Exception:
+        outcomes = [ERROR] * len(affiliations)
+    return outcomes, os.getpid(), get_rss()
+
+def _disable_cache():
+    s.RESULT_CACHE.size = 0
+    s.RESULT_CACHE.clear()
+
+class Window(object):
+    """
+    Measures of the requests completed during a reporting interval.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.latencies = []
+        self.outcomes = {OK: 0, EMPTY: 0, ERROR: 0}
+        self.memory = {}
+
+    def add(self, latency, outcomes, pid, rss):
+        self.latencies.append(latency)
+        for outcome in outcomes:
+            self.outcomes[outcome] += 1
+        self.memory[pid] = rss
+
+    def get_measures(self, end, start_time, outstanding):
+        affiliations = sum(self.outcomes.values())
+        return {
+                'time': self.start - start_time,
+                'duration': end - self.start,
+                'requests': len(self.latencies),
+                'throughput': affiliations / ((end - self.start) or 1.),
+                'p50_latency': get_percentile(self.latencies, 50) * 1000,
+                'p95_latency': get_percentile(self.latencies, 95) * 1000,
+                'p99_latency': get_percentile(self.latencies, 99) * 1000,
+                'max_latency': max(self.latencies or [0.]) * 1000,
+                'error_rate': 100. * self.outcomes[ERROR] / (affiliations or 1),
+                'empty_rate': 100. * self.outcomes[EMPTY] / (affiliations or 1),
+                'outstanding': outstanding,
+                'rss': sum(self.memory.values()),
+                }
+
+def print_header():
+    print '    time  requests  aff/s   p50 ms   p95 ms   p99 ms   max ms  errors   empty  queued  rss MB'
+
+def print_measures(m):
+    print '%7.1fs %9d %6.1f %8.1f %8.1f %8.1f %8.1f %6.2f%% %6.2f%% %7d %7.1f' % (m['time'],
+            m['requests'], m['throughput'], m['p50_latency'], m['p95_latency'],
+            m['p99_latency'], m['max_latency'], m['error_rate'], m['empty_rate'],
+            m['outstanding'], m['rss'] / 1048576.)
+
+def get_requests(affiliations, batch_size):
+    """
+    Returns an endless iterator over the requests of the affiliations.
+    """
+    while True:
+        for i in xrange(0, len(affiliations), batch_size):
+            yield affiliations[i:i + batch_size]
+
+def run_load(affiliations, target='search_institution', concurrency=8, qps=None,
+        duration=60., number_of_requests=None, batch_size=1, processes=False,
+        interval=10., cache=True, report=print_measures):
+    """
+    Sends the affiliations in a closed loop, or in an open loop at `qps`
+    requests per second, until `duration` seconds elapsed or
+    `number_of_requests` were sent. `report` is called with the measures of
+    every interval. Returns those measures and the memory of every worker at
+    its first and last request.
+    """
+    if not cache:
+        # Before the workers are forked.
+        _disable_cache()
+    pool = (processes and Pool or ThreadPool)(concurrency)
+    lock = threading.Lock()
+    slots = threading.Semaphore(concurrency)
+    start_time = time.time()
+    state = {'window': Window(start_time), 'outstanding': 0, 'memory': {}}
+    windows = []
+
+    def complete(due, result):
+        outcomes, pid, rss = result
+        with lock:
+            state['window'].add(time.time() - due, outcomes, pid, rss)
+            state['memory'].setdefault(pid, [rss, rss])[1] = rss
+            state['outstanding'] -= 1
+        if not qps:
+            slots.release()
+
+    def rotate(now):
+        with lock:
+            window, state['window'] = state['window'], Window(now)
+            outstanding = state['outstanding']
+        measures = window.get_measures(now, start_time, outstanding)
+        windows.append(measures)
+        if report is not None:
+            report(measures)
+
+    requests = get_requests(affiliations, batch_size)
+    reports = [start_time + interval]
+
+    def wait(ready):
+        # Polls so that the reports are printed while waiting.
+        while True:
+            if time.time() >= reports[0]:
+                rotate(reports[0])
+                reports[0] += interval
+            if ready():
+                return
+            time.sleep(0.001)
+
+    sent = 0
+    try:
+        while (number_of_requests is None or sent < number_of_requests) and \
+                time.time() - start_time < duration:
+            if qps:
+                due = start_time + sent / float(qps)
+                wait(lambda: time.time() >= due)
+            else:
+                wait(lambda: slots.acquire(False))
+                due = time.time()
+
+            with lock:
+                state['outstanding'] += 1
+            pool.apply_async(_run_request, ((target, requests.next()),),
+                    callback=lambda result, due=due: complete(due, result))
+            sent += 1
+    except KeyboardInterrupt:
+        print 'Interrupted, waiting for the outstanding requests.'
+    finally:
+        pool.close()
+        pool.join()
+    rotate(time.time())
+    return windows, state['memory']
+
+def get_summary(windows):
+    """
+    Returns the totals of the measures of all the intervals.
+    """
+    requests = sum(w['requests'] for w in windows)
+    duration = sum(w['duration'] for w in windows) or 1.
+    affiliations = sum(w['throughput'] * w['duration'] for w in windows)
+    def average(name):
+        return sum(w[name] * w['throughput'] * w['duration'] for w in windows) / (affiliations or 1)
+    return {
+            'requests': requests,
+            'throughput': affiliations / duration,
+            'max_latency': max([w['max_latency'] for w in windows] or [0.]),
+            'error_rate': average('error_rate'),
+            'empty_rate': average('empty_rate'),
+            }
+
+if __name__ == '__main__':
+    import json
+    from optparse import OptionParser
+    usage = "usage: %prog [options] [test_file ...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-f", "--function", dest="target", default='search_institution',
+            choices=TARGETS, help="matching function: %s" % ', '.join(TARGETS))
+    parser.add_option("-c", "--concurrency", dest="concurrency", type="int", default=8,
+            help="number of workers")
+    parser.add_option("-q", "--qps", dest="qps", type="float", default=None,
+            help="target requests per second, in an open loop")
+    parser.add_option("-d", "--duration", dest="duration", type="float", default=60.,
+            help="duration of the test in seconds")
+    parser.add_option("-n", "--requests", dest="requests", type="int", default=None,
+            help="number of requests to send")
+    parser.add_option("-b", "--batch-size", dest="batch_size", type="int", default=100,
+            help="affiliations per request of search_institutions")
+    parser.add_option("-s", "--scale", dest="scale", type="int", default=1,
+            help="number of repetitions of the affiliations")
+    parser.add_option("-i", "--interval", dest="interval", type="float", default=10.,
+            help="reporting interval in seconds")
+    parser.add_option("-P", "--processes", action="store_true", dest="processes", default=False,
+            help="use worker processes instead of threads")
+    parser.add_option("--no-cache", action="store_false", dest="cache", default=True,
+            help="disable the result cache of the workers")
+    parser.add_option("--seed", dest="seed", type="int", default=None,
+            help="shuffle the affiliations with this seed")
+    parser.add_option("-o", "--output", dest="output", default=None,
+            help="JSON file of the measures")
+
+    options, args = parser.parse_args()
+    affiliations = []
+    for path in args or TEST_FILES:
+        affiliations += [affiliation for affiliation, _ in read_test_affiliations(path)]
+    affiliations *= options.scale
+    if options.seed is not None:
+        random.Random(options.seed).shuffle(affiliations)
+    batch_size = options.target == 'search_institutions' and options.batch_size or 1
+
+    print 'Sending %d affiliations to %s with %d %s, %s.' % (len(affiliations), options.target,
+            options.concurrency, options.processes and 'processes' or 'threads',
+            options.qps and 'at %g requests/s' % options.qps or 'in a closed loop')
+    if options.processes:
+        print 'Every worker process has its own result cache; rss is the sum over the workers.'
+    print_header()
+    windows, memory = run_load(affiliations, options.target, options.concurrency, options.qps,
+            options.duration, options.requests, batch_size, options.processes,
+            options.interval, options.cache)
+
+    summary = get_summary(windows)
+    print 'Total: %d requests, %.1f affiliations/s, %.2f%% errors, %.2f%% empty.' % (
+            summary['requests'], summary['throughput'], summary['error_rate'],
+            summary['empty_rate'])
+    for pid, (first, last) in sorted(memory.items()):
+        print 'Worker %d: %.1f MB -> %.1f MB (%+.1f MB)' % (pid, first / 1048576.,
+                last / 1048576., (last - first) / 1048576.)
+
+    if options.output:
+        json.dump({'windows': windows, 'summary': summary,
+                'memory': dict((str(pid), values) for pid, values in memory.items())},
+                open(options.output, 'w'), indent=2, sort_keys=True)
@@ -0,0 +1,155 @@
+#!/usr/bin/python
+"""
+Evaluation of the matching without Celery.
+
+The test pairs are searched by a local pool of processes or threads. The
+top results of every query are saved under a hash of the cleaned query and
+of the search options, together with the generation of the index. A rerun
+only searches the queries whose cleaned form changed, so tuning the
+cleaning code only costs the queries it affects. Reindexing invalidates all
+the saved results.
+
+Usage: python local_evaluation.py [options] [test_file ...]
+"""
+
+import hashlib
+import marshal
+import os
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+import institution_searcher as s
+import local_indexes
+from institution_test_suite import EVALUATION_K, TEST_FILES, is_expected, read_test_affiliations
+
+SAVED_RESULTS_PATH = 'var/evaluation_results.marshal'
+
+def get_query_key(institution, k, options):
+    """
+    Returns the key of the saved top k results of a query.
+    """
+    clean_institution = options.get('clean_up', True) and \
+            s._clean_affiliation(institution) or institution
+    if isinstance(clean_institution, unicode):
+        clean_institution = clean_institution.encode('utf_8')
+    return hashlib.sha1('%s\0%d\0%r' % (clean_institution, k, sorted(options.items()))).hexdigest()
+
+def _search_top_results(arguments):
+    """
+    Returns the top k (score, name, id) results of an institution, an empty
+    list if nothing matched or None if the search failed.
+    """
+    institution, k, options = arguments
+    results = s.search_institution(institution, **options)
+    if results is None:
+        return None
+    return [(result['score'], s.RE_MULTIPLE_SPACES.sub(' ', result['display_name'].strip()),
+            result['id']) for result in results[:k]]
+
+def load_saved_results(path=SAVED_RESULTS_PATH):
+    """
+    Returns the saved results {query key: top results}, which are empty if
+    they were computed against another index.
+    """
+    generation = local_indexes.get_index_generation()
+    if os.path.exists(path):
+        saved_generation, results = marshal.load(open(path, 'rb'))
+        if saved_generation == generation:
+            return results
+    return {}
+
+def save_results(results, path=SAVED_RESULTS_PATH):
+    if not os.path.exists(os.path.dirname(path)):
+        os.mkdir(os.path.dirname(path))
+    out = open(path + '.tmp', 'wb')
+    marshal.dump((local_indexes.get_index_generation(), results), out)
+    out.close()
+    os.rename(path + '.tmp', path)
+
+def run_evaluation(pairs, k=EVALUATION_K, processes=s.NUM_OF_CPUS, threads=False,
+        path=SAVED_RESULTS_PATH, **options):
+    """
+    Evaluates a list of (expected, institution) pairs and returns the
+    (expected, institution, top results) records in the format of
+    institution_test_suite.evaluate, and the number of queries sent.
+    Failed searches are not saved and are retried by the next run.
+    """
+    saved = load_saved_results(path)
+    keys = [get_query_key(institution, k, options) for _, institution in pairs]
+
+    queries = {}
+    for key, (_, institution) in zip(keys, pairs):
+        if key not in saved and key not in queries:
+            queries[key] = institution
+
+    if queries:
+        pool = threads and ThreadPool(processes) or Pool(processes)
+        try:
+            tops = pool.map(_search_top_results,
+                    [(institution, k, options) for institution in queries.values()],
+                    chunksize=max(len(queries) / (processes * 4), 1))
+        finally:
+            pool.close()
+            pool.join()
+
+        new_results = dict((key, top) for key, top in zip(queries.keys(), tops)
+                if top is not None)
+        saved.update(new_results)
+        save_results(saved, path)
+
+    records = [(expected, institution, saved.get(key))
+            for key, (expected, institution) in zip(keys, pairs)]
+    return records, len(queries)
+
+def get_accuracy(records):
+    """
+    Returns the percentage of records whose first result is the expected
+    one, comparing ids for the test files and ICNs for the ICN corpus.
+    """
+    correct = 0
+    for expected, _, top in records:
+        if expected is None:
+            correct += top is not None and not top
+        elif top:
+            # Legacy expected ICNs are compared by their current ICN.
+            correct += is_expected(top[0][2], expected) or (not isinstance(expected, tuple)
+                    and local_indexes.resolve_icn(expected) == top[0][1])
+    return 100. * correct / (len(records) or 1)
+
+def get_icn_pairs(path='icns.marshal'):
+    """
+    Returns the (icn, institution) pairs of the ICN corpus.
+    """
+    pairs = []
+    for icn, institutions in marshal.load(open(path, 'rb')).items():
+        for institution in institutions:
+            pairs.append((icn, institution))
+    return pairs
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    usage = "usage: %prog [options] [test_file ...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-p", "--processes", dest="processes", type="int",
+            default=s.NUM_OF_CPUS, help="number of parallel searches")
+    parser.add_option("-t", "--threads", action="store_true", dest="threads",
+            default=False, help="search in threads instead of processes")
+    parser.add_option("-i", "--icns", action="store_true", dest="icns", default=False,
+            help="also evaluate the ICN corpus of icns.marshal")
+    parser.add_option("-k", dest="k", type="int", default=EVALUATION_K,
+            help="number of results recorded per query")
+
+    options, args = parser.parse_args()
+    corpora = [(path, read_test_affiliations(path)) for path in args or TEST_FILES]
+    # The test files have the id first, as the ICN corpus has the ICN first.
+    corpora = [(path, [(icn_id, affiliation) for affiliation, icn_id in pairs])
+            for path, pairs in corpora]
+    if options.icns:
+        corpora.append(('icns.marshal', get_icn_pairs()))
+
+    for path, pairs in corpora:
+        start = time.time()
+        records, queries = run_evaluation(pairs, options.k, options.processes, options.threads)
+        print '%s: accuracy %.2f%%, %d queries for %d pairs, %.2fs' % (path,
+                get_accuracy(records), queries, len(pairs), time.time() - start)
@@ -0,0 +1,134 @@
+"""
+Local indexes built next to the Solr index by institution_indexer.
+
+The indexes are loaded on first use and kept for the life of the process,
+which is what makes them cheap in Celery workers and in the match server.
+A missing index is reported as None so that callers can fall back to Solr.
+"""
+
+import mmap
+import os
+import time
+
+import ann_index
+import autocomplete
+import gazetteer
+import icn_mapping
+import name_tagger
+import token_features
+
+INDEX_DIRECTORY = 'var/index'
+# Identifier of the last indexing, which invalidates saved search results.
+GENERATION_FILE = 'generation'
+
+_LOADED = {}
+# Generation of the indexes of every directory when they were first checked.
+_GENERATIONS = {}
+
+def build_local_indexes(documents, directory=INDEX_DIRECTORY):
+    """
+    Builds all the local indexes from the documents sent to Solr.
+    """
+    ann_index.build_ann_index(documents, directory)
+    gazetteer.build_gazetteer(documents, directory)
+    token_features.build_token_features(documents, directory)
+    name_tagger.build_name_tagger(documents, directory)
+    autocomplete.build_autocomplete_index(documents, directory)
+    icn_mapping.build_icn_mapping(documents, directory)
+    write_file(os.path.join(directory, GENERATION_FILE), '%.6f\n' % time.time())
+    _LOADED.clear()
+
+def write_file(path, data):
+    """
+    Writes an index file, replacing it atomically so that running searchers
+    are not affected.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    out = open(path + '.tmp', 'wb')
+    out.write(data)
+    out.close()
+    os.rename(path + '.tmp', path)
+
+def map_file(path):
+    """
+    Returns a read-only memory map of an index file, or '' if it is empty.
+    """
+    f = open(path, 'rb')
+    try:
+        if not os.fstat(f.fileno()).st_size:
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+def _load(name, loader, directory, filename):
+    # Called for every query, so the path is only built on the first call.
+    key = (directory, name)
+    if key not in _LOADED:
+        if os.path.exists(os.path.join(directory, filename)):
+            _LOADED[key] = loader()
+        else:
+            _LOADED[key] = None
+    return _LOADED[key]
+
+def get_ann_index(directory=INDEX_DIRECTORY):
+    return _load('ann', lambda: ann_index.AnnIndex(directory),
+            directory, ann_index.NAMES_FILE)
+
+def get_gazetteer(directory=INDEX_DIRECTORY):
+    return _load('gazetteer', lambda: gazetteer.Gazetteer(directory),
+            directory, gazetteer.GAZETTEER_FILE)
+
+def get_token_features(directory=INDEX_DIRECTORY):
+    return _load('token_features', lambda: token_features.TokenFeatures(directory),
+            directory, token_features.FEATURES_FILE)
+
+def get_name_tagger(directory=INDEX_DIRECTORY):
+    return _load('name_tagger', lambda: name_tagger.NameTagger(directory),
+            directory, name_tagger.TAGGER_FILE)
+
+def get_autocomplete_index(directory=INDEX_DIRECTORY):
+    return _load('autocomplete', lambda: autocomplete.AutocompleteIndex(directory),
+            directory, autocomplete.NAMES_FILE)
+
+def get_icn_mapping(directory=INDEX_DIRECTORY):
+    return _load('icn_mapping', lambda: icn_mapping.IcnMapping(directory),
+            directory, icn_mapping.OFFSETS_FILE)
+
+def resolve_icn(icn, directory=INDEX_DIRECTORY):
+    """
+    Returns the current ICN of a possibly legacy ICN.
+    """
+    mapping = get_icn_mapping(directory)
+    if mapping is None:
+        return icn
+    return mapping.resolve(icn)
+
+def get_index_generation(directory=INDEX_DIRECTORY):
+    """
+    Returns the identifier of the last indexing, or '' if it is unknown.
+    """
+    path = os.path.join(directory, GENERATION_FILE)
+    if not os.path.exists(path):
+        return ''
+    return open(path).read().strip()
+
+def reload_indexes():
+    """
+    Forgets the loaded indexes, e.g. after a reindexing.
+    """
+    _LOADED.clear()
+
+def reload_if_reindexed(directory=INDEX_DIRECTORY):
+    """
+    Forgets the loaded indexes if `directory` was reindexed since the last
+    check, and returns whether it was.
+    """
+    generation = get_index_generation(directory)
+    if _GENERATIONS.setdefault(directory, generation) == generation:
+        return False
+    _GENERATIONS[directory] = generation
+    reload_indexes()
+    return True
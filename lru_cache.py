@@ -0,0 +1,92 @@
+"""
+Small least-recently-used cache with hit/miss accounting.
+"""
+
+import threading
+
+class LRUCache(object):
+    """
+    Dictionary-like cache that evicts the least recently used entry once it
+    holds more than `size` entries. Safe to share between threads.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+        self._lock = threading.Lock()
+        # Circular doubly linked list: [previous, next, key, value].
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for `key` and marks it as recently used.
+        """
+        with self._lock:
+            link = self._data.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._move_to_end(link)
+            return link[3]
+
+    def set(self, key, value):
+        """
+        Stores `value` under `key`, evicting the oldest entry if needed.
+        """
+        with self._lock:
+            link = self._data.get(key)
+            if link is not None:
+                link[3] = value
+                self._move_to_end(link)
+                return
+
+            if self.size <= 0:
+                return
+
+            if len(self._data) >= self.size:
+                oldest = self._root[1]
+                oldest[0][1] = oldest[1]
+                oldest[1][0] = oldest[0]
+                del self._data[oldest[2]]
+
+            last = self._root[0]
+            link = [last, self._root, key, value]
+            last[1] = link
+            self._root[0] = link
+            self._data[key] = link
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._root[:] = [self._root, self._root, None, None]
+
+    def statistics(self):
+        """
+        Returns the number of hits, misses and the hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': lookups and float(self.hits) / lookups or 0.,
+                }
+
+    def _move_to_end(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        last = self._root[0]
+        link[0] = last
+        link[1] = self._root
+        last[1] = link
+        self._root[0] = link
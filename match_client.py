@@ -0,0 +1,105 @@
+"""
+Thin client for match_server.py.
+
+Only depends on the standard library so that it starts instantly. The server
+address is read from the MATCH_SERVER environment variable, either as
+http://host:port or as the path of a Unix socket.
+"""
+
+import httplib
+import json
+import os
+import socket
+import urllib
+
+DEFAULT_SOCKET = 'var/match_server.sock'
+
+# Same as institution_searcher.SEARCH_FAILED, without importing the searcher.
+SEARCH_FAILED = 'SEARCH FAILED'
+
+class ServerUnavailable(Exception):
+    """
+    Raised when the match server cannot be reached.
+    """
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+class MatchClient(object):
+    """
+    Client of the match server. The methods mirror institution_searcher.
+    """
+
+    def __init__(self, address=None, timeout=60):
+        self.address = address or os.environ.get('MATCH_SERVER', DEFAULT_SOCKET)
+        self.timeout = timeout
+        self._connection = None
+
+    def _connect(self):
+        if self.address.startswith('http://'):
+            host = self.address[len('http://'):].rstrip('/')
+            return httplib.HTTPConnection(host, timeout=self.timeout)
+        else:
+            return UnixHTTPConnection(self.address, timeout=self.timeout)
+
+    def _request(self, method, path, body=None):
+        headers = body is not None and {'Content-Type': 'application/json'} or {}
+        # Retry once on a fresh connection if the kept-alive one was closed.
+        for attempt in (0, 1):
+            if self._connection is None:
+                self._connection = self._connect()
+            try:
+                self._connection.request(method, path, body, headers)
+                response = self._connection.getresponse()
+                data = response.read()
+                break
+            except (socket.error, httplib.HTTPException), e:
+                self._connection.close()
+                self._connection = None
+                if attempt:
+                    raise ServerUnavailable('%s: %s' % (self.address, e))
+
+        if response.status != 200:
+            raise ServerUnavailable('%s: HTTP %d' % (self.address, response.status))
+        return json.loads(data)
+
+    def _get(self, path, **params):
+        for key, value in params.items():
+            if isinstance(value, unicode):
+                params[key] = value.encode('utf_8')
+            elif isinstance(value, bool):
+                params[key] = int(value)
+        return self._request('GET', '%s?%s' % (path, urllib.urlencode(params)))
+
+    def get_match(self, institution):
+        response = self._get('/match', q=institution)
+        if response.get('failed'):
+            return SEARCH_FAILED
+        return response['match'] and tuple(response['match'])
+
+    def get_best_results(self, institution, minimum_score=0.8):
+        return self._get('/best', q=institution, minimum_score=minimum_score)['results']
+
+    def search_institution(self, institution, clean_up=True, logic="OR", fuzzy=False, postprocess=True):
+        return self._get('/search', q=institution, clean_up=clean_up, logic=logic,
+                fuzzy=fuzzy, postprocess=postprocess)['results']
+
+    def search_institutions(self, institutions, clean_up=True):
+        body = json.dumps({'institutions': institutions, 'clean_up': clean_up})
+        results = self._request('POST', '/batch', body)['results']
+        return [tuple(result) for result in results]
+
+    def complete(self, prefix, k=10):
+        return [tuple(result) for result in self._get('/complete', q=prefix, k=k)['results']]
+
+    def status(self):
+        return self._get('/status')
@@ -0,0 +1,239 @@
+#!/usr/bin/python
+"""
+Long-running match server.
+
+Keeps the Solr connections, the result cache and the local indexes of
+institution_searcher warm and serves them over HTTP, on a TCP port or on a
+Unix socket. All the responses are JSON:
+
+    GET  /match?q=...                  get_match
+    GET  /best?q=...&minimum_score=... get_best_results
+    GET  /search?q=...&clean_up=1&logic=OR&fuzzy=0&postprocess=1
+                                       search_institution
+    POST /batch  {"institutions": [...], "clean_up": true}
+                                       search_institutions in the server
+    GET  /complete?q=...&k=10          completions of a name prefix
+    GET  /status                       cache statistics and uptime
+    POST /reload                       reloads the local indexes
+
+The local indexes and the result cache are also reloaded when the server
+sees, at most every RELOAD_INTERVAL seconds, that the index was rebuilt.
+Keep-alive connections idle for IDLE_TIMEOUT seconds are closed so that
+they do not hold the threads of the pool.
+"""
+
+import BaseHTTPServer
+import json
+import os
+import Queue
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+import institution_searcher as s
+import local_indexes
+from match_client import DEFAULT_SOCKET
+
+DEFAULT_THREADS = 8
+IDLE_TIMEOUT = 30.
+RELOAD_INTERVAL = 5.
+
+def _get_flag(params, name, default):
+    if name not in params:
+        return default
+    return params[name][0].lower() in ('1', 'true', 'yes', 'on')
+
+class MatchRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keep client connections open between queries.
+    protocol_version = 'HTTP/1.1'
+    timeout = IDLE_TIMEOUT
+
+    def do_GET(self):
+        self.server.check_indexes()
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        query = params.get('q', [''])[0]
+
+        if url.path == '/match':
+            match = s.get_match(query)
+            failed = match == s.SEARCH_FAILED
+            self.send_json({'match': not failed and match or None, 'failed': failed})
+        elif url.path == '/best':
+            minimum_score = float(params.get('minimum_score', [s.SCORE_PERCENTAGE])[0])
+            results = s.get_best_results(query, minimum_score)
+            self.send_json({'results': results, 'failed': results is None})
+        elif url.path == '/search':
+            results = s.search_institution(query,
+                    clean_up=_get_flag(params, 'clean_up', True),
+                    logic=params.get('logic', ['OR'])[0],
+                    fuzzy=_get_flag(params, 'fuzzy', False),
+                    postprocess=_get_flag(params, 'postprocess', True))
+            self.send_json({'results': results, 'failed': results is None})
+        elif url.path == '/complete':
+            index = local_indexes.get_autocomplete_index()
+            if index is None:
+                self.send_error(503, 'No autocomplete index')
+                return
+            try:
+                k = int(params.get('k', [10])[0])
+            except ValueError:
+                k = 0
+            if k < 1:
+                self.send_error(400, 'k must be a positive integer')
+                return
+            self.send_json({'results': index.complete(query, k)})
+        elif url.path == '/status':
+            self.send_json({
+                'pid': os.getpid(),
+                'uptime': time.time() - self.server.start_time,
+                'threads': self.server.threads,
+                'cache': s.RESULT_CACHE.statistics(),
+                })
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        if self.path == '/reload':
+            self.server.check_indexes(force=True)
+            self.send_json({'generation': local_indexes.get_index_generation()})
+            return
+        if self.path != '/batch':
+            self.send_error(404)
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            data = json.loads(self.rfile.read(length))
+            institutions = [i.encode('utf_8') for i in data['institutions']]
+        except (ValueError, KeyError, AttributeError):
+            self.send_error(400)
+            return
+
+        self.server.check_indexes()
+        results = s.search_institutions(institutions, data.get('clean_up', True),
+                number_of_processes=1)
+        self.send_json({'results': results})
+
+    def send_json(self, data):
+        body = json.dumps(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        return self.client_address and self.client_address[0] or 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class PooledMixIn:
+    """
+    Serves the requests from a fixed pool of threads so that every thread
+    keeps its Solr connection open between requests.
+    """
+
+    threads = DEFAULT_THREADS
+    verbose = False
+
+    def start_pool(self):
+        self.start_time = time.time()
+        self.requests = Queue.Queue()
+        self.reload_lock = threading.Lock()
+        self.checked = 0.
+        for _ in xrange(self.threads):
+            thread = threading.Thread(target=self.process_requests)
+            thread.daemon = True
+            thread.start()
+
+    def process_requests(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def check_indexes(self, force=False):
+        """
+        Reloads the local indexes and clears the result cache if the index
+        was rebuilt, or unconditionally if `force` is set.
+        """
+        with self.reload_lock:
+            now = time.time()
+            if not force and now - self.checked < RELOAD_INTERVAL:
+                return
+            self.checked = now
+            if force:
+                local_indexes.reload_indexes()
+            elif not local_indexes.reload_if_reindexed():
+                return
+            s.RESULT_CACHE.clear()
+
+class PooledHTTPServer(PooledMixIn, BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+
+class PooledUnixHTTPServer(PooledMixIn, SocketServer.UnixStreamServer):
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        directory = os.path.dirname(self.server_address)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        SocketServer.UnixStreamServer.server_bind(self)
+        # Attributes expected by BaseHTTPRequestHandler.
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+def create_server(socket_path=None, port=None, host='localhost', threads=DEFAULT_THREADS):
+    """
+    Returns a match server listening on a TCP port if `port` is given and on
+    a Unix socket otherwise.
+    """
+    if port is not None:
+        server = PooledHTTPServer((host, port), MatchRequestHandler)
+    else:
+        server = PooledUnixHTTPServer(socket_path or DEFAULT_SOCKET, MatchRequestHandler)
+    server.threads = threads
+    server.start_pool()
+    return server
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-s", "--socket", dest="socket", default=DEFAULT_SOCKET,
+            help="Unix socket to listen on", metavar="PATH")
+    parser.add_option("-p", "--port", dest="port", type="int", default=None,
+            help="TCP port to listen on instead of the Unix socket")
+    parser.add_option("-H", "--host", dest="host", default='localhost',
+            help="host to listen on with --port")
+    parser.add_option("-t", "--threads", dest="threads", type="int", default=DEFAULT_THREADS,
+            help="number of threads and Solr connections")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
+            help="log every request")
+
+    options, args = parser.parse_args()
+    server = create_server(options.socket, options.port, options.host, options.threads)
+    server.verbose = options.verbose
+    if options.port is None:
+        print >> sys.stderr, 'Listening on %s.' % options.socket
+    else:
+        print >> sys.stderr, 'Listening on %s:%d.' % (options.host, options.port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,58 @@
+"""
+MinHash signatures of hashed character n-grams and their LSH band keys.
+"""
+
+import random
+import struct
+import zlib
+
+from text_normalization import normalize
+
+# Mersenne prime larger than any 32-bit shingle hash.
+PRIME = (1 << 61) - 1
+
+def get_shingles(text, n=3):
+    """
+    Returns the set of 32-bit hashes of the character n-grams of the
+    normalized text. The hashes are stable across processes.
+    """
+    text = ' %s ' % normalize(text)
+    text = text.encode('utf_8')
+    return set(zlib.crc32(text[i:i + n]) & 0xffffffff
+            for i in xrange(max(len(text) - n + 1, 1)))
+
+def jaccard(shingles1, shingles2):
+    if not shingles1 or not shingles2:
+        return 0.
+    return float(len(shingles1 & shingles2)) / len(shingles1 | shingles2)
+
+class MinHasher(object):
+    """
+    Computes MinHash signatures with `bands` * `rows` universal hash
+    functions. Two sets share at least one band key with a probability that
+    rises steeply around a Jaccard similarity of (1 / bands) ** (1 / rows).
+    """
+
+    def __init__(self, bands=16, rows=4, seed=1):
+        self.bands = bands
+        self.rows = rows
+        generator = random.Random(seed)
+        self.coefficients = [(generator.randint(1, PRIME - 1), generator.randint(0, PRIME - 1))
+                for _ in xrange(bands * rows)]
+
+    def get_signature(self, shingles):
+        if not shingles:
+            return []
+        return [min([(a * x + b) % PRIME for x in shingles]) for a, b in self.coefficients]
+
+    def get_band_keys(self, signature):
+        """
+        Returns one 64-bit key per band: the band number in the high bits and
+        a hash of the band values in the low bits.
+        """
+        keys = []
+        for band in xrange(self.bands if signature else 0):
+            values = signature[band * self.rows:(band + 1) * self.rows]
+            digest = zlib.crc32(struct.pack('<%dQ' % self.rows, *values)) & 0xffffffff
+            keys.append((band << 32) | digest)
+        return keys
@@ -0,0 +1,155 @@
+"""
+Aho-Corasick tagger of the known institution names in affiliations.
+
+The automaton works on normalized words rather than characters, so a name
+only matches on word boundaries and the automaton stays small. It is built
+by institution_indexer from the 110 names and acronyms and the 410 name
+variants of all the institutions and saved with marshal for a fast load.
+Scanning an affiliation takes linear time in its number of words whatever
+the number of names.
+"""
+
+import marshal
+import os
+import re
+
+import ann_index
+import local_indexes
+from abbreviations import get_canonical_word
+from text_normalization import normalize
+
+TAGGER_FILE = 'name_tagger.marshal'
+
+RE_WORD = re.compile(r'\w+', re.UNICODE)
+
+# Single words shorter than this are too ambiguous to be tagged.
+MINIMUM_SINGLE_WORD_LENGTH = 3
+
+def get_words(text):
+    """
+    Returns the normalized words of a text with their character spans.
+    Abbreviations are replaced by their canonical form.
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf_8', 'replace')
+    return [(get_canonical_word(normalize(match.group())), match.start(), match.end())
+            for match in RE_WORD.finditer(text)]
+
+def build_name_tagger(documents, directory):
+    """
+    Builds the automaton of the names of the documents and writes it to
+    `directory`.
+    """
+    # Trie: one dictionary {word: state} per state. State 0 is the root.
+    goto = [{}]
+    # Ids of the institutions of the name ending at each state.
+    outputs = [()]
+    for document in documents:
+        for name in ann_index.get_names(document):
+            words = [word for word, _, _ in get_words(name)]
+            if not words or (len(words) == 1 and len(words[0]) < MINIMUM_SINGLE_WORD_LENGTH):
+                continue
+            state = 0
+            for word in words:
+                next_state = goto[state].get(word)
+                if next_state is None:
+                    next_state = goto[state][word] = len(goto)
+                    goto.append({})
+                    outputs.append(())
+                state = next_state
+            if document['id'] not in outputs[state]:
+                outputs[state] += (document['id'],)
+
+    # Breadth-first computation of the failure links and of the length of
+    # the name ending at each state.
+    fail = [0] * len(goto)
+    depth = [0] * len(goto)
+    # Closest state on the failure chain that ends a name, or -1.
+    dictionary_link = [-1] * len(goto)
+    queue = list(goto[0].values())
+    for state in queue:
+        depth[state] = 1
+    position = 0
+    while position < len(queue):
+        state = queue[position]
+        position += 1
+        for word, next_state in goto[state].items():
+            depth[next_state] = depth[state] + 1
+            fallback = fail[state]
+            while fallback and word not in goto[fallback]:
+                fallback = fail[fallback]
+            fail[next_state] = goto[fallback].get(word, 0)
+            if fail[next_state] == next_state:
+                fail[next_state] = 0
+            target = fail[next_state]
+            dictionary_link[next_state] = outputs[target] and target or dictionary_link[target]
+            queue.append(next_state)
+
+    local_indexes.write_file(os.path.join(directory, TAGGER_FILE),
+            marshal.dumps((goto, fail, outputs, depth, dictionary_link)))
+
+class NameTagger(object):
+
+    def __init__(self, directory):
+        self.goto, self.fail, self.outputs, self.depth, self.dictionary_link = \
+                marshal.load(open(os.path.join(directory, TAGGER_FILE), 'rb'))
+
+    def get_mentions(self, text):
+        """
+        Returns all the institution names found in the text as a list of
+        (start, end, institution ids) where start and end are the character
+        offsets of the name in the text.
+        """
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        words = get_words(text)
+        mentions = []
+        state = 0
+        for position, (word, _, end) in enumerate(words):
+            while state and word not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(word, 0)
+
+            match = state
+            if not outputs[match]:
+                match = self.dictionary_link[match]
+            while match > 0:
+                start = words[position - self.depth[match] + 1][1]
+                mentions.append((start, end, outputs[match]))
+                match = self.dictionary_link[match]
+        return mentions
+
+    def get_longest_mentions(self, text):
+        """
+        Returns the mentions that are not part of a longer mention, in the
+        order of the text.
+        """
+        mentions = sorted(self.get_mentions(text), key=lambda m: (m[0] - m[1], m[0]))
+        kept = []
+        for mention in mentions:
+            if all(mention[1] <= other[0] or mention[0] >= other[1] for other in kept):
+                kept.append(mention)
+        return sorted(kept)
+
+    def get_direct_match(self, text):
+        """
+        Returns the id of the only institution named in the text, or None if
+        no institution or several are named.
+        """
+        ids = set()
+        for _, _, mention_ids in self.get_longest_mentions(text):
+            ids.update(mention_ids)
+        if len(ids) == 1:
+            return ids.pop()
+        return None
+
+    def get_short_query(self, text):
+        """
+        Returns the institution names found in the text joined by spaces, or
+        None if there are none.
+        """
+        if not isinstance(text, unicode):
+            text = text.decode('utf_8', 'replace')
+        mentions = self.get_longest_mentions(text)
+        if not mentions:
+            return None
+        return u' '.join(text[start:end] for start, end, _ in mentions).encode('utf_8')
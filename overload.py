@@ -0,0 +1,220 @@
+"""
+Protection of the Solr connection against overload: an AIMD concurrency
+limiter, a circuit breaker and a per-query deadline with bounded retry.
+"""
+
+import random
+import threading
+import time
+
+class SearchError(Exception):
+    """
+    Raised when a query could not be answered by Solr.
+    """
+
+class OverloadedError(SearchError):
+    """
+    Raised when no concurrency slot became free before the deadline.
+    """
+
+class CircuitOpenError(SearchError):
+    """
+    Raised without querying Solr while the circuit breaker is open.
+    """
+
+class DeadlineExceeded(SearchError):
+    """
+    Raised when the deadline of a query expired before it succeeded.
+    """
+
+class AIMDLimiter(object):
+    """
+    Concurrency limiter with additive increase and multiplicative decrease.
+
+    The limit grows by `increase` every time a full window of queries has
+    succeeded and is multiplied by `decrease` on a failure or on a query
+    slower than `latency_threshold`, at most once per window: the queries
+    that were in flight when the limit decreased were sent under the
+    previous limit, and their failures do not decrease it again.
+    """
+
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=64, increase=1.,
+            decrease=0.5, latency_threshold=None):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_threshold = latency_threshold
+        self.in_flight = 0
+        self.completed = 0
+        self._recovery = 0
+        self._condition = threading.Condition()
+
+    def get_limit(self):
+        return max(int(self.limit), self.min_limit)
+
+    def acquire(self, timeout=None):
+        """
+        Waits for a free slot. Raises OverloadedError after `timeout` seconds.
+        """
+        end = timeout is not None and time.time() + timeout or None
+        self._condition.acquire()
+        try:
+            while self.in_flight >= self.get_limit():
+                if end is None:
+                    self._condition.wait()
+                else:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        raise OverloadedError('No free Solr slot (limit %d).' % self.get_limit())
+                    self._condition.wait(remaining)
+            self.in_flight += 1
+        finally:
+            self._condition.release()
+
+    def release(self, success, latency=None):
+        """
+        Frees a slot and adjusts the limit from the outcome of the query.
+        """
+        self._condition.acquire()
+        try:
+            self.in_flight -= 1
+            if success and (self.latency_threshold is None or latency is None or
+                    latency <= self.latency_threshold):
+                self.on_success()
+            else:
+                self.on_failure()
+            self._condition.notify_all()
+        finally:
+            self._condition.release()
+
+    def on_success(self):
+        self.completed += 1
+        self.limit = min(self.limit + self.increase / self.limit, self.max_limit)
+
+    def on_failure(self, in_flight=None):
+        """
+        Decreases the limit, unless the failure is that of a query sent before
+        the last decrease. Callers that do not go through acquire and release,
+        such as the AdaptiveScheduler, give their number of queries in flight.
+        """
+        self.completed += 1
+        if self.completed <= self._recovery:
+            return
+        self.limit = max(self.limit * self.decrease, self.min_limit)
+        if in_flight is None:
+            in_flight = self.in_flight
+        self._recovery = self.completed + in_flight
+
+class CircuitBreaker(object):
+    """
+    Stops sending queries after `failure_threshold` consecutive failures.
+
+    After `reset_timeout` seconds a single trial query is let through: the
+    circuit closes again if it succeeds and stays open otherwise.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=10, reset_timeout=5.):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns True if a query may be sent.
+        """
+        self._lock.acquire()
+        try:
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+        finally:
+            self._lock.release()
+
+    def record_success(self):
+        self._lock.acquire()
+        try:
+            self.failures = 0
+            self.state = self.CLOSED
+        finally:
+            self._lock.release()
+
+    def record_failure(self):
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.time()
+        finally:
+            self._lock.release()
+
+def is_retryable(exception):
+    """
+    Client errors such as query syntax errors will fail again.
+    """
+    return getattr(exception, 'httpcode', 500) >= 500
+
+class QueryGuard(object):
+    """
+    Runs queries under a concurrency limiter and a circuit breaker, retrying
+    failed queries with exponential backoff until the deadline.
+    """
+
+    def __init__(self, limiter=None, breaker=None, deadline=10., retries=2,
+            backoff=0.1):
+        self.limiter = limiter
+        self.breaker = breaker
+        self.deadline = deadline
+        self.retries = retries
+        self.backoff = backoff
+
+    def call(self, function, *args, **kwargs):
+        """
+        Returns the result of `function(*args, **kwargs)` or raises the
+        SearchError or the exception of the last attempt.
+        """
+        end = time.time() + self.deadline
+        attempt = 0
+        while True:
+            if self.breaker is not None and not self.breaker.allow():
+                raise CircuitOpenError('Solr circuit breaker is open.')
+
+            if self.limiter is not None:
+                self.limiter.acquire(end - time.time())
+
+            start = time.time()
+            try:
+                result = function(*args, **kwargs)
+            except Exception, e:
+                retryable = is_retryable(e)
+                if self.limiter is not None:
+                    # A client error says nothing about the load of Solr.
+                    self.limiter.release(not retryable)
+                if not retryable:
+                    raise
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+
+                attempt += 1
+                delay = self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                if attempt > self.retries:
+                    raise
+                if time.time() + delay >= end:
+                    raise DeadlineExceeded('Deadline of %.1fs exceeded after %d attempts: %s' %
+                            (self.deadline, attempt, e))
+                time.sleep(delay)
+                continue
+
+            if self.limiter is not None:
+                self.limiter.release(True, time.time() - start)
+            if self.breaker is not None:
+                self.breaker.record_success()
+            return result
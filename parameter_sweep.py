@@ -0,0 +1,191 @@
+#!/usr/bin/python
+"""
+Accuracy and latency of the search options over a grid of settings.
+
+Every search setting of the grid runs the test files with the result cache
+emptied, so that the latencies include the Solr queries. By default the
+settings run one after the other. With --processes, several settings run in
+parallel, which shortens the sweep but measures the latencies of each under
+the load of the others on Solr and on the CPUs: the accuracies are the same,
+the latencies are only comparable between sweeps run with the same number
+of processes.
+
+For each point, the sweep records:
+- the accuracy (see institution_test_suite.get_id_accuracy);
+- the unmatched rate, i.e. the affiliations for which nothing was found;
+- the ambiguous rate, i.e. the affiliations without a single best result
+  within the score percentage of the first one;
+- the median and 99th percentile query latencies;
+- the wall time.
+
+The points that no other point beats on accuracy, on the unmatched and
+ambiguous rates and on both latencies form the Pareto frontier, which is
+printed as a table. All the points are written to a JSON file.
+
+Usage: python parameter_sweep.py [options] [test_file ...]
+"""
+
+import itertools
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import institution_searcher as s
+import local_indexes
+from institution_test_suite import TEST_FILES, get_id_accuracy, read_test_affiliations
+from percentiles import get_percentile
+
+GRID = (
+        ('clean_up', (True, False)),
+        ('logic', ('OR', 'AND')),
+        ('fuzzy', (False, True)),
+        ('postprocess', (True, False)),
+        ('separation_threshold', (0.1, 0.2, 0.3)),
+        ('score_percentage', (0.7, 0.8, 0.9)),
+        )
+
+SEARCH_OPTIONS = ('clean_up', 'logic', 'fuzzy', 'postprocess')
+
+def get_points(grid=GRID, ann=False):
+    """
+    Returns the settings of the searches of the grid. The score percentage
+    does not change the searches and is applied to their results. The
+    points that only differ by an unused separation threshold, or by the
+    logic of fuzzy searches when `ann` tells that they use the local n-gram
+    index, are skipped.
+    """
+    grid = [(name, values) for name, values in grid if name != 'score_percentage']
+    thresholds = dict(grid).get('separation_threshold')
+    logics = dict(grid).get('logic')
+    names = [name for name, _ in grid]
+    points = []
+    for values in itertools.product(*[values for _, values in grid]):
+        point = dict(zip(names, values))
+        if thresholds and not point.get('postprocess', True) and \
+                point['separation_threshold'] != thresholds[0]:
+            continue
+        if ann and logics and point.get('fuzzy') and point['logic'] != logics[0]:
+            continue
+        points.append(point)
+    return points
+
+def is_ambiguous(results, score_percentage):
+    if not results:
+        return False
+    minimum_score = results[0]['score'] * score_percentage
+    return len([r for r in results if float(r['score']) >= minimum_score]) > 1
+
+def run_point(arguments):
+    """
+    Runs the test pairs with the settings of a point and returns its
+    measures for each score percentage.
+    """
+    point, pairs, score_percentages = arguments
+    separation_threshold = s.SEPARATION_THRESHOLD
+    s.SEPARATION_THRESHOLD = point.get('separation_threshold', s.SEPARATION_THRESHOLD)
+    options = dict((name, point[name]) for name in SEARCH_OPTIONS if name in point)
+    s.RESULT_CACHE.clear()
+
+    results, latencies = [], []
+    start = time.time()
+    try:
+        for affiliation, _ in pairs:
+            query_start = time.time()
+            results.append((affiliation, s.search_institution(affiliation, **options)))
+            latencies.append(time.time() - query_start)
+    finally:
+        s.SEPARATION_THRESHOLD = separation_threshold
+    wall_time = time.time() - start
+
+    # The failed searches are counted apart from the unmatched ones.
+    unmatched = len([r for _, r in results if r is not None and not r])
+    measures = []
+    for score_percentage in score_percentages:
+        ambiguous = len([r for _, r in results if is_ambiguous(r, score_percentage)])
+        settings = dict(point, score_percentage=score_percentage)
+        measures.append({
+                'settings': settings,
+                'accuracy': get_id_accuracy(pairs, results),
+                'unmatched_rate': 100. * unmatched / len(pairs),
+                'ambiguous_rate': 100. * ambiguous / len(pairs),
+                'failed': len([r for _, r in results if r is None]),
+                'p50_latency': get_percentile(latencies, 50) * 1000,
+                'p99_latency': get_percentile(latencies, 99) * 1000,
+                'wall_time': wall_time,
+                })
+    return measures
+
+def get_pareto_frontier(measures):
+    """
+    Returns the measures that are not dominated on accuracy, unmatched and
+    ambiguous rates, median and 99th percentile latency, by decreasing
+    accuracy.
+    """
+    def get_objectives(m):
+        return (m['accuracy'], -m['unmatched_rate'], -m['ambiguous_rate'],
+                -m['p50_latency'], -m['p99_latency'])
+
+    def dominates(a, b):
+        a, b = get_objectives(a), get_objectives(b)
+        return a != b and all(x >= y for x, y in zip(a, b))
+
+    frontier = [m for m in measures if not any(dominates(other, m) for other in measures)]
+    return sorted(frontier, key=lambda m: (-m['accuracy'], m['p50_latency']))
+
+def print_table(measures):
+    columns = [name for name, _ in GRID]
+    print ' '.join('%-12s' % name[:12] for name in columns) + \
+            '  accuracy unmatched ambiguous   p50 ms   p99 ms   wall s'
+    for m in measures:
+        print ' '.join('%-12s' % m['settings'].get(name, '') for name in columns) + \
+                '  %7.2f%% %8.2f%% %8.2f%% %8.2f %8.2f %8.2f' % (m['accuracy'],
+                        m['unmatched_rate'], m['ambiguous_rate'], m['p50_latency'],
+                        m['p99_latency'], m['wall_time'])
+
+def sweep(paths=TEST_FILES, grid=GRID, processes=1):
+    """
+    Returns the measures of all the points of the grid on the test files,
+    running `processes` points at a time.
+    """
+    pairs = []
+    for path in paths:
+        pairs += read_test_affiliations(path)
+
+    score_percentages = dict(grid).get('score_percentage', (s.SCORE_PERCENTAGE,))
+    points = get_points(grid, ann=local_indexes.get_ann_index() is not None)
+    arguments = [(point, pairs, score_percentages) for point in points]
+    if processes == 1:
+        point_measures = map(run_point, arguments)
+    else:
+        pool = Pool(processes)
+        try:
+            point_measures = pool.map(run_point, arguments, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [measure for measures in point_measures for measure in measures]
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    usage = "usage: %prog [options] [test_file ...]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-p", "--processes", dest="processes", type="int", default=1,
+            help="number of points run in parallel, which skews the latencies")
+    parser.add_option("-o", "--output", dest="output", default='var/sweep.json',
+            help="JSON file of the measures of all the points")
+
+    options, args = parser.parse_args()
+    start = time.time()
+    measures = sweep(args or TEST_FILES, processes=options.processes)
+    frontier = get_pareto_frontier(measures)
+    print 'Swept %d points in %.2fs, %d on the Pareto frontier:' % (len(measures),
+            time.time() - start, len(frontier))
+    print_table(frontier)
+
+    for measure in measures:
+        measure['pareto'] = measure in frontier
+    directory = os.path.dirname(options.output)
+    if directory and not os.path.exists(directory):
+        os.mkdir(directory)
+    json.dump(measures, open(options.output, 'w'), indent=2, sort_keys=True)
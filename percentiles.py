@@ -0,0 +1,13 @@
+"""
+Percentiles of the latencies measured by the sweeps and the load tests.
+"""
+
+def get_percentile(values, percentile):
+    """
+    Returns the nearest-rank percentile of the values, or 0. if there are
+    none.
+    """
+    values = sorted(values)
+    if not values:
+        return 0.
+    return values[int(round(percentile / 100. * (len(values) - 1)))]
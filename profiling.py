@@ -0,0 +1,309 @@
+"""
+Profiling of the stages of the indexer, of the disambiguation and of the
+searches, enabled with their --profile option.
+
+Each stage of a run gets, in the run directory:
+
+    STAGE.prof         cProfile statistics, for pstats or snakeviz
+    STAGE.txt          the functions with the most cumulative time
+    STAGE.folded       stacks sampled every few milliseconds of CPU time,
+                       in the folded format of flamegraph.pl and speedscope
+    STAGE.allocations  the top allocation sites with tracemalloc when it
+                       is available, and otherwise the types whose number
+                       of objects grew the most
+
+and summary.txt gives the wall and CPU time, the peak and the growth of the
+resident memory, and the hottest functions of every stage. The peak is
+sampled by a thread every RSS_INTERVAL. A stage run several times
+accumulates, and the files are rewritten at the end of each run of a stage
+so that they are complete even if the process never exits.
+
+Celery workers started with the SEARCH_PROFILE environment variable set to
+a directory profile the chunks they search, each worker process in its own
+run directory. Chunks are short and many, so the workers do not track the
+allocations and only write the files every TASK_WRITE_INTERVAL chunks and
+at exit. Only one profiler profiles at a time in a process: the chunks
+searched within a stage of the indexer or of the disambiguation are part of
+that stage.
+"""
+
+import atexit
+import cProfile
+import gc
+import os
+import pstats
+import re
+import resource
+import signal
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+PROFILE_DIRECTORY = 'var/profiles'
+PROFILE_VARIABLE = 'SEARCH_PROFILE'
+
+# Seconds of CPU time between two samples of the stack.
+SAMPLING_INTERVAL = 0.005
+# Seconds between two samples of the resident memory.
+RSS_INTERVAL = 0.05
+TASK_WRITE_INTERVAL = 20
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+RE_UNSAFE_CHARACTERS = re.compile(r'[^\w.-]+')
+
+# Id of the process in which a profiler runs a stage, so that a forked
+# child does not inherit it.
+_ACTIVE_PID = [None]
+
+def get_rss():
+    """
+    Returns the resident memory of the current process in bytes, or its peak
+    resident memory where /proc is not available.
+    """
+    try:
+        return int(open('/proc/self/statm').read().split()[1]) * PAGE_SIZE
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def get_run_directory(name, directory=PROFILE_DIRECTORY):
+    return os.path.join(directory, '%s-%s-%s-%d' % (name, time.strftime('%Y%m%d-%H%M%S'),
+            socket.gethostname(), os.getpid()))
+
+def _get_type_counts():
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+class Stage(object):
+    """
+    Measures of a stage, accumulated over its runs.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.samples = {}
+        self.runs = 0
+        self.wall_time = 0.
+        self.cpu_time = 0.
+        self.peak_rss = 0
+        self.rss_growth = 0
+        self.allocations = []
+
+class Profiler(object):
+    """
+    Profiles the stages of a run into a run directory. Does nothing if the
+    directory is None, so that the stages can always be declared.
+
+    Without `allocations`, the allocations are not tracked. The files are
+    written every `write_interval` runs of a stage.
+    """
+
+    def __init__(self, directory=None, allocations=True, write_interval=1):
+        self.directory = directory
+        self.allocations = allocations
+        self.write_interval = write_interval
+        self.stages = {}
+        self.order = []
+        self.active = None
+        if directory is not None and not os.path.exists(directory):
+            os.makedirs(directory)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Profiles the code of the block as the stage `name`. Nested stages,
+        including those of other profilers, are part of the enclosing one.
+        """
+        if self.directory is None or _ACTIVE_PID[0] == os.getpid():
+            yield
+            return
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+            self.order.append(name)
+        stage = self.active = self.stages[name]
+        _ACTIVE_PID[0] = os.getpid()
+
+        start_rss = get_rss()
+        if self.allocations and tracemalloc is not None:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.clear_traces()
+        elif self.allocations:
+            gc.collect()
+            type_counts = _get_type_counts()
+        rss_sampler = self._start_rss_sampling()
+        sampling = self._start_sampling(stage)
+        start, start_cpu = time.time(), time.clock()
+        stage.profile.enable()
+        try:
+            yield
+        finally:
+            stage.profile.disable()
+            stage.wall_time += time.time() - start
+            stage.cpu_time += time.clock() - start_cpu
+            if sampling:
+                self._stop_sampling()
+            end_rss = get_rss()
+            stage.rss_growth += end_rss - start_rss
+            stage.peak_rss = max(stage.peak_rss, start_rss, end_rss,
+                    self._stop_rss_sampling(rss_sampler))
+            if self.allocations and tracemalloc is not None:
+                stage.peak_rss = max(stage.peak_rss, start_rss + tracemalloc.get_traced_memory()[1])
+                statistics = tracemalloc.take_snapshot().statistics('lineno')[:TOP_ALLOCATIONS]
+                stage.allocations = ['%10.1f KB %8d blocks  %s' % (s.size / 1024., s.count,
+                        s.traceback) for s in statistics]
+            elif self.allocations:
+                counts = _get_type_counts()
+                growth = sorted(((counts[t] - type_counts.get(t, 0), t) for t in counts),
+                        reverse=True)[:TOP_ALLOCATIONS]
+                stage.allocations = ['%+10d objects  %s' % (number, t)
+                        for number, t in growth if number > 0]
+            stage.runs += 1
+            self.active = None
+            _ACTIVE_PID[0] = None
+            if not stage.runs % self.write_interval:
+                self.write_stage(stage)
+                self.write_summary()
+
+    def _start_rss_sampling(self):
+        """
+        Samples the resident memory in a thread, as reading /proc in the
+        SIGPROF handler would delay the profiled code.
+        """
+        stop = threading.Event()
+        peak = [0]
+        def sample():
+            while not stop.wait(RSS_INTERVAL):
+                peak[0] = max(peak[0], get_rss())
+        thread = threading.Thread(target=sample)
+        thread.daemon = True
+        thread.start()
+        return stop, thread, peak
+
+    def _stop_rss_sampling(self, rss_sampler):
+        """
+        Returns the peak resident memory sampled.
+        """
+        stop, thread, peak = rss_sampler
+        stop.set()
+        thread.join()
+        return peak[0]
+
+    def _start_sampling(self, stage):
+        """
+        Samples the stack of the main thread on SIGPROF, every
+        SAMPLING_INTERVAL of CPU time. Returns False outside the main thread,
+        where signal handlers cannot be set.
+        """
+        def sample(signum, frame):
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            stage.samples[key] = stage.samples.get(key, 0) + 1
+        try:
+            self._previous_handler = signal.signal(signal.SIGPROF, sample)
+        except ValueError:
+            return False
+        # Interrupted system calls, such as Solr requests, are restarted.
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, SAMPLING_INTERVAL, SAMPLING_INTERVAL)
+        return True
+
+    def _stop_sampling(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+
+    def _get_path(self, stage, extension):
+        return os.path.join(self.directory, RE_UNSAFE_CHARACTERS.sub('_', stage.name) + extension)
+
+    def write_stage(self, stage):
+        stage.profile.dump_stats(self._get_path(stage, '.prof'))
+
+        out = open(self._get_path(stage, '.txt'), 'w')
+        statistics = pstats.Stats(stage.profile, stream=out)
+        statistics.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        out.close()
+
+        out = open(self._get_path(stage, '.folded'), 'w')
+        for stack, count in sorted(stage.samples.items()):
+            out.write('%s %d\n' % (stack, count))
+        out.close()
+
+        if self.allocations:
+            open(self._get_path(stage, '.allocations'), 'w').write(
+                    '\n'.join(stage.allocations) + '\n')
+
+    def write_summary(self):
+        lines = ['%-20s %5s %10s %10s %10s %10s %8s' % ('stage', 'runs', 'wall s', 'cpu s',
+                'peak MB', 'growth MB', 'samples')]
+        for name in self.order:
+            stage = self.stages[name]
+            lines.append('%-20s %5d %10.2f %10.2f %10.1f %+10.1f %8d' % (name[:20], stage.runs,
+                    stage.wall_time, stage.cpu_time, stage.peak_rss / 1048576.,
+                    stage.rss_growth / 1048576., sum(stage.samples.values())))
+        for name in self.order:
+            lines += ['', 'Hottest functions of %s (own time):' % name]
+            statistics = pstats.Stats(self.stages[name].profile).stats
+            hottest = sorted(statistics.items(), key=lambda item: item[1][2], reverse=True)[:5]
+            for (filename, line, function), (_, calls, own_time, _, _) in hottest:
+                lines.append('  %8.3fs %8d calls  %s (%s:%d)' % (own_time, calls, function,
+                        os.path.basename(filename), line))
+        open(os.path.join(self.directory, 'summary.txt'), 'w').write('\n'.join(lines) + '\n')
+
+    def write(self):
+        """
+        Writes the files of all the stages and the summary.
+        """
+        if self.directory is not None and self.stages:
+            for name in self.order:
+                self.write_stage(self.stages[name])
+            self.write_summary()
+
+    def finish(self):
+        """
+        Writes and prints the summary of the run.
+        """
+        if self.directory is not None and self.stages:
+            self.write()
+            print >> sys.stderr, open(os.path.join(self.directory, 'summary.txt')).read()
+            print >> sys.stderr, 'Profiles written to %s.' % self.directory
+
+_TASK_PROFILER = None
+_NO_PROFILER = Profiler()
+
+def get_task_profiler():
+    """
+    Returns the profiler of the tasks of the current process, which does
+    nothing unless the SEARCH_PROFILE environment variable is set, nor while
+    another profiler runs a stage.
+    """
+    global _TASK_PROFILER
+    if _ACTIVE_PID[0] == os.getpid():
+        return _NO_PROFILER
+    if _TASK_PROFILER is None or _TASK_PROFILER.pid != os.getpid():
+        directory = os.environ.get(PROFILE_VARIABLE)
+        if directory:
+            directory = get_run_directory('worker', directory)
+        _TASK_PROFILER = Profiler(directory, allocations=False,
+                write_interval=TASK_WRITE_INTERVAL)
+        _TASK_PROFILER.pid = os.getpid()
+        # The last runs are written at exit.
+        atexit.register(_TASK_PROFILER.write)
+    return _TASK_PROFILER
@@ -0,0 +1,110 @@
+"""
+Adaptive chunk scheduling for parallel searches.
+
+The scheduler keeps one chunk in flight per worker and hands out the next
+chunk as soon as a worker becomes idle, so a slow chunk never holds back the
+others. Chunk sizes are derived from the observed per-item latency so that a
+chunk takes about `target_duration` seconds, and they shrink as the run nears
+completion so that the tail is spread over all the workers.
+"""
+
+import time
+
+class AdaptiveScheduler(object):
+    """
+    Dispatches chunks of items to asynchronous workers.
+
+    `submit` is called with a list of items and must return an object with
+    `ready()` and `get()` methods, such as a Celery or multiprocessing
+    AsyncResult. `get()` must return a dictionary with the list of 'results'
+    for the chunk, in order, and the 'elapsed' time spent on it by the worker.
+
+    If an AIMDLimiter is given, the number of chunks in flight is further
+    bounded by its limit, which shrinks whenever a chunk reports 'failures'.
+    """
+
+    def __init__(self, submit, workers, target_duration=2., initial_chunk_size=5,
+            max_chunk_size=1000, smoothing=0.3, poll_interval=0.01, limiter=None):
+        self.submit = submit
+        self.workers = workers
+        self.limiter = limiter
+        self.target_duration = target_duration
+        self.initial_chunk_size = initial_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.smoothing = smoothing
+        self.poll_interval = poll_interval
+        # Exponentially weighted average of the time spent per item.
+        self.item_latency = None
+        self.chunk_sizes = []
+
+    def get_concurrency(self):
+        """
+        Returns the number of chunks that may be in flight.
+        """
+        if self.limiter is None:
+            return self.workers
+        return min(self.workers, self.limiter.get_limit())
+
+    def next_chunk_size(self, remaining):
+        """
+        Returns the size of the next chunk given the number of remaining items.
+        """
+        if self.item_latency is None:
+            size = self.initial_chunk_size
+        elif self.item_latency > 0:
+            size = int(self.target_duration / self.item_latency)
+        else:
+            size = self.max_chunk_size
+
+        # Guided self-scheduling: never take more than a fraction of what is
+        # left so that the last chunks are small and finish together.
+        tail_size = remaining / (2 * self.workers)
+        size = min(size, tail_size, self.max_chunk_size)
+        return max(size, 1)
+
+    def record(self, chunk_size, elapsed):
+        """
+        Updates the per-item latency estimate with a completed chunk.
+        """
+        latency = float(elapsed) / chunk_size
+        if self.item_latency is None:
+            self.item_latency = latency
+        else:
+            self.item_latency = self.smoothing * latency + \
+                    (1 - self.smoothing) * self.item_latency
+
+    def run(self, items):
+        """
+        Processes all the items and returns the results in the input order.
+        """
+        results = [None] * len(items)
+        position = 0
+        pending = []
+
+        while position < len(items) or pending:
+            # Give work to every idle worker.
+            while position < len(items) and len(pending) < self.get_concurrency():
+                size = self.next_chunk_size(len(items) - position)
+                chunk = items[position:position + size]
+                pending.append((position, len(chunk), self.submit(chunk)))
+                self.chunk_sizes.append(len(chunk))
+                position += len(chunk)
+
+            done = [p for p in pending if p[2].ready()]
+            if not done:
+                time.sleep(self.poll_interval)
+                continue
+
+            for p in done:
+                pending.remove(p)
+                start, size, async_result = p
+                chunk = async_result.get()
+                results[start:start + size] = chunk['results']
+                self.record(size, chunk['elapsed'])
+                if self.limiter is not None:
+                    if chunk.get('failures'):
+                        self.limiter.on_failure(len(pending))
+                    else:
+                        self.limiter.on_success()
+
+        return results
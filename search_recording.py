@@ -0,0 +1,151 @@
+"""
+Recording and replay of the Solr queries.
+
+In record mode, every query sent to Solr is appended to a file as one JSON
+line with the query, its parameters, the results or the error, and the
+observed latency. In replay mode, the queries are answered from those lines
+held in memory, optionally after sleeping for the recorded latency, so
+that experiments run deterministically and without Solr.
+
+The mode is chosen with the SOLR_BACKEND environment variable, which is
+read by solr_connection.SolrConnections and thus also applies to Celery
+workers and to the pools of the evaluation runners:
+
+    SOLR_BACKEND=record:var/queries.jsonl          record the real queries
+    SOLR_BACKEND=replay:var/queries.jsonl          replay them instantly
+    SOLR_BACKEND=replay-latency:var/queries.jsonl  replay them with latency
+"""
+
+import json
+import os
+import threading
+import time
+
+from overload import is_retryable
+
+# HTTP code of the replayed errors that were retried when recorded but had
+# no code, such as timeouts, so that they are retried again.
+RETRYABLE_HTTPCODE = 503
+
+class ReplayError(Exception):
+    """
+    Raised for the queries that failed when recorded, with the same HTTP
+    code or RETRYABLE_HTTPCODE if they were retried without one, and for the
+    queries that were not recorded.
+    """
+
+    def __init__(self, message, httpcode=None):
+        Exception.__init__(self, message)
+        self.reason = message
+        self.httpcode = httpcode
+
+class Response(object):
+
+    def __init__(self, results):
+        self.results = results
+
+def _get_key(q, fields, params):
+    if not isinstance(q, unicode):
+        q = q.decode('utf_8', 'replace')
+    return json.dumps([q, list(fields or []), params], sort_keys=True)
+
+class RecordingConnection(object):
+    """
+    Wraps a Solr connection and records its queries. The other methods are
+    those of the wrapped connection.
+    """
+
+    def __init__(self, connection, path):
+        self.connection = connection
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # Lines are written with a single system call in append mode, so that
+        # several threads and processes can record to the same file.
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+
+    def query(self, q, fields=None, **params):
+        record = {'key': _get_key(q, fields, params)}
+        start = time.time()
+        try:
+            response = self.connection.query(q, fields=fields, **params)
+        except Exception, e:
+            record['error'] = getattr(e, 'reason', None) or str(e)
+            record['httpcode'] = getattr(e, 'httpcode', None)
+            record['retryable'] = is_retryable(e)
+            raise
+        else:
+            record['results'] = [dict(result) for result in response.results]
+            return response
+        finally:
+            record['latency'] = time.time() - start
+            os.write(self.fd, json.dumps(record) + '\n')
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.connection.close()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+_RECORDINGS = {}
+_RECORDINGS_LOCK = threading.Lock()
+
+def load_recording(path):
+    """
+    Returns the recorded queries of a file as a dictionary {key: record},
+    reading the file once per process. The last record of a query wins.
+    """
+    with _RECORDINGS_LOCK:
+        if path not in _RECORDINGS:
+            records = {}
+            for line in open(path):
+                record = json.loads(line)
+                records[record['key']] = record
+            _RECORDINGS[path] = records
+        return _RECORDINGS[path]
+
+class ReplayConnection(object):
+    """
+    Answers the recorded queries of a file.
+    """
+
+    def __init__(self, path, simulate_latency=False):
+        self.records = load_recording(path)
+        self.simulate_latency = simulate_latency
+
+    def query(self, q, fields=None, **params):
+        record = self.records.get(_get_key(q, fields, params))
+        if record is None:
+            raise ReplayError('Query not recorded: %r' % q)
+        if self.simulate_latency:
+            time.sleep(record['latency'])
+        if 'error' in record:
+            httpcode = record.get('httpcode')
+            # Older recordings have no flag: errors without a code, such as
+            # timeouts, were retried.
+            if httpcode is None and record.get('retryable', True):
+                httpcode = RETRYABLE_HTTPCODE
+            raise ReplayError(record['error'], httpcode)
+        # Copies, as the searcher reorders the results.
+        return Response([dict(result) for result in record['results']])
+
+    def close(self):
+        # The records are shared by the connections of the process.
+        pass
+
+def create_connection(backend, create_solr_connection):
+    """
+    Returns a connection for a SOLR_BACKEND value. `create_solr_connection`
+    creates a real Solr connection.
+    """
+    mode, _, path = backend.partition(':')
+    if mode == 'record':
+        return RecordingConnection(create_solr_connection(), path)
+    elif mode == 'replay':
+        return ReplayConnection(path)
+    elif mode == 'replay-latency':
+        return ReplayConnection(path, simulate_latency=True)
+    raise ValueError('Unknown Solr backend: %s' % backend)
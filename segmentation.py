@@ -0,0 +1,77 @@
+"""
+Segmentation of the affiliations that name several institutions.
+
+Affiliations such as 'Univ. of Tokyo; Argonne National Laboratory' or 'Univ.
+of Tokyo and Argonne National Laboratory' are split so that every
+institution is searched on its own. A boundary is only used when the text on
+both of its sides looks like an institution, i.e. contains a word such as
+University or a name known to the name tagger. 'Department of Physics and
+Astronomy' is kept whole, 'CERN and Argonne National Laboratory' is only
+split with the tagger, and a department or a country separated by a
+semicolon stays attached to its institution.
+
+Around an 'and', only the comma-separated parts next to it are looked at:
+in 'Kavli Institute, Dept. of Physics and Astronomy, Univ. of Chicago' the
+institutions are further away and the 'and' joins two fields of physics.
+"""
+
+import re
+
+from abbreviations import get_canonical_word
+from text_normalization import normalize
+
+RE_SEMICOLON = re.compile(r'\s*;\s*')
+RE_AND = re.compile(r'(\s+and\s+)', re.IGNORECASE)
+
+# Normalized words, after the expansion of the abbreviations, that make a
+# segment look like an institution.
+INSTITUTION_WORDS = frozenset([
+        'academy', 'center', 'college', 'institute', 'institution', 'instituto',
+        'istituto', 'laboratories', 'laboratory', 'observatoire', 'observatorio',
+        'observatory', 'universidad', 'universidade', 'universita', 'universitat',
+        'universite', 'universiteit', 'university', 'uniwersytet',
+        ])
+
+def is_institution(text, tagger=None):
+    """
+    Tells whether a piece of affiliation seems to name an institution.
+    """
+    for word in normalize(text).split():
+        if get_canonical_word(word) in INSTITUTION_WORDS:
+            return True
+    return tagger is not None and bool(tagger.get_mentions(text))
+
+def split_affiliation(affiliation, tagger=None):
+    """
+    Returns the segments of an affiliation, or a list with the affiliation
+    itself if it names a single institution.
+    """
+    segments = []
+    prefix = ''
+    for part in RE_SEMICOLON.split(affiliation):
+        if not part:
+            continue
+        if is_institution(part, tagger):
+            segments.append(prefix + part)
+            prefix = ''
+        elif segments:
+            segments[-1] += '; ' + part
+        else:
+            prefix += part + '; '
+    if len(segments) < 2:
+        segments = [affiliation]
+
+    split_segments = []
+    for segment in segments:
+        pieces = RE_AND.split(segment)
+        current = pieces[0]
+        for i in xrange(1, len(pieces), 2):
+            separator, piece = pieces[i], pieces[i + 1]
+            if is_institution(current.rsplit(',', 1)[-1], tagger) and \
+                    is_institution(piece.split(',', 1)[0], tagger):
+                split_segments.append(current)
+                current = piece
+            else:
+                current += separator + piece
+        split_segments.append(current)
+    return split_segments
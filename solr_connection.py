@@ -0,0 +1,73 @@
+"""
+Lazy access to accounts.cfg and to the Solr connections.
+
+Nothing is read or opened at import time so that Celery workers, tests and
+benchmarks only pay for what they use.
+"""
+
+import ConfigParser
+import os
+import threading
+
+CONFIG_PATH = 'accounts.cfg'
+
+# Environment variable selecting a recording or replay backend, see
+# search_recording.py.
+BACKEND_VARIABLE = 'SOLR_BACKEND'
+
+_CONFIG = None
+
+def get_config():
+    """
+    Returns the parsed accounts.cfg, reading it on the first call.
+    """
+    global _CONFIG
+    if _CONFIG is None:
+        cfg = ConfigParser.ConfigParser()
+        cfg.read(CONFIG_PATH)
+        _CONFIG = cfg
+    return _CONFIG
+
+class SolrConnections(object):
+    """
+    Creates one Solr connection per process and per thread on first use.
+
+    Solr connections are neither thread-safe nor usable on both sides of a
+    fork: a connection created before a Celery worker forked is discarded
+    in the child and a new one is opened.
+
+    The connections are created by `factory` if it is given, e.g. for
+    tests, and otherwise by the backend of the SOLR_BACKEND environment
+    variable or by solrpy.
+    """
+
+    def __init__(self, factory=None, **options):
+        self.factory = factory
+        self.options = options
+        self._local = threading.local()
+
+    def get(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid = os.getpid()
+            local.connection = None
+        if local.connection is None:
+            local.connection = self.create()
+        return local.connection
+
+    def create(self):
+        if self.factory is not None:
+            return self.factory()
+        backend = os.environ.get(BACKEND_VARIABLE)
+        if backend:
+            import search_recording
+            return search_recording.create_connection(backend, self.create_solr_connection)
+        return self.create_solr_connection()
+
+    def create_solr_connection(self):
+        import solr
+        cfg = get_config()
+        return solr.SolrConnection(cfg.get('solr', 'url'),
+                http_user=cfg.get('solr', 'user'),
+                http_pass=cfg.get('solr', 'password'),
+                **self.options)
@@ -0,0 +1,313 @@
+#!/usr/bin/python
+"""
+Local stand-in for the Solr server, for load tests on any machine.
+
+Only implements what solrpy sends for the searcher and the indexer:
+
+    /select  q, fl, fq, rows and start, answered in the XML format of
+             Solr, with scores
+    /update  <add>, <delete><query>*:*</query></delete> or <id>, <commit/>
+
+Any path ending with /select or /update is accepted, so the url of
+accounts.cfg only needs to point to the stand-in, e.g.
+http://localhost:8983/solr. Documents are searchable once committed.
+
+Scoring is BM25 over the normalized words of the searchable fields. A
+query is a list of words where '~' suffixes and OR are ignored and AND
+makes all the words required. Filter queries are conjunctions of
+field:"value" clauses matching exact field values.
+
+The latency and error rate are tunable to test the concurrency, batching
+and retries of the searcher and the indexer: every request waits for an
+exponentially distributed time and fails with HTTP 503 at the given rate.
+
+Usage: python solr_standin.py [options]
+"""
+
+import BaseHTTPServer
+import SocketServer
+import math
+import random
+import re
+import threading
+import time
+import urlparse
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+from text_normalization import normalize
+
+DEFAULT_PORT = 8983
+
+SEARCH_FIELDS = ('display_name', 'institution', 'institution_acronym',
+        'name_variants', 'department', 'address', 'city', 'state', 'country',
+        'zip_code', 'country_code')
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+RE_FILTER_CLAUSE = re.compile(r'(\w+):"([^"]*)"')
+
+def get_words(document):
+    words = []
+    for field in SEARCH_FIELDS:
+        values = document.get(field) or []
+        if not isinstance(values, list):
+            values = [values]
+        for value in values:
+            words += normalize(value).split()
+    return words
+
+class Index(object):
+    """
+    Immutable inverted index of committed documents.
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.postings = {}
+        self.lengths = {}
+        for identifier, document in documents.items():
+            words = get_words(document)
+            self.lengths[identifier] = len(words)
+            for word in words:
+                frequencies = self.postings.setdefault(word, {})
+                frequencies[identifier] = frequencies.get(identifier, 0) + 1
+        self.average_length = float(sum(self.lengths.values())) / (len(documents) or 1)
+
+    def search(self, q, filter_queries=()):
+        """
+        Returns the (score, id) pairs of the documents matching a query, by
+        decreasing score.
+        """
+        if q.strip() == '*:*':
+            scores = dict((identifier, 1.) for identifier in self.documents)
+            required = []
+        else:
+            words = q.replace('~', ' ').split()
+            conjunction = 'AND' in words
+            words = [normalize(w) for w in words if w not in ('AND', 'OR', 'NOT')]
+            words = [w for w in ' '.join(words).split()]
+            required = conjunction and words or []
+            scores = {}
+            for word in set(words):
+                frequencies = self.postings.get(word, {})
+                if not frequencies:
+                    continue
+                idf = math.log(1 + (len(self.documents) - len(frequencies) + 0.5) /
+                        (len(frequencies) + 0.5))
+                for identifier, frequency in frequencies.items():
+                    norm = K1 * (1 - B + B * self.lengths[identifier] / self.average_length)
+                    scores[identifier] = scores.get(identifier, 0.) + \
+                            idf * frequency * (K1 + 1) / (frequency + norm)
+
+        for word in required:
+            frequencies = self.postings.get(word, {})
+            scores = dict((i, score) for i, score in scores.items() if i in frequencies)
+        for filter_query in filter_queries:
+            for field, value in RE_FILTER_CLAUSE.findall(filter_query):
+                scores = dict((i, score) for i, score in scores.items()
+                        if value in self._get_values(i, field))
+        return sorted(((score, i) for i, score in scores.items()), key=lambda r: (-r[0], r[1]))
+
+    def _get_values(self, identifier, field):
+        values = self.documents[identifier].get(field) or []
+        if not isinstance(values, list):
+            values = [values]
+        return values
+
+def format_value(name, value):
+    if isinstance(value, list):
+        return '<arr name=%s>%s</arr>' % (quoteattr(name),
+                ''.join('<str>%s</str>' % escape(v) for v in value))
+    elif isinstance(value, float):
+        return '<float name=%s>%r</float>' % (quoteattr(name), value)
+    return '<str name=%s>%s</str>' % (quoteattr(name), escape(value))
+
+class SolrStandin(object):
+    """
+    Documents of the stand-in. Adds and deletes are applied on commit.
+    """
+
+    def __init__(self, documents=None):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.index = Index(dict((d['id'], d) for d in documents or []))
+
+    def select(self, params):
+        q = params.get('q', ['*:*'])[0].decode('utf_8', 'replace')
+        filter_queries = [fq.decode('utf_8', 'replace') for fq in params.get('fq', [])]
+        rows = int(params.get('rows', [10])[0])
+        start = int(params.get('start', [0])[0])
+        fields = ','.join(params.get('fl', ['*'])).split(',')
+
+        index = self.index
+        results = index.search(q, filter_queries)
+        docs = []
+        for score, identifier in results[start:start + rows]:
+            document = index.documents[identifier]
+            values = []
+            for name, value in sorted(document.items()):
+                if '*' in fields or name in fields:
+                    values.append(format_value(name, value))
+            if 'score' in fields:
+                values.append(format_value('score', score))
+            docs.append('<doc>%s</doc>' % ''.join(values))
+
+        max_score = results and results[0][0] or 0.
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<response>'
+                '<lst name="responseHeader"><int name="status">0</int><int name="QTime">0</int></lst>'
+                '<result name="response" numFound="%d" start="%d" maxScore="%r">%s</result>'
+                '</response>\n' % (len(results), start, max_score, ''.join(docs))).encode('utf_8')
+
+    def update(self, body):
+        root = ElementTree.fromstring(body)
+        with self.lock:
+            for element in root.iter():
+                if element.tag == 'doc' and root.tag == 'add':
+                    document = {}
+                    for field in element.findall('field'):
+                        name, value = field.get('name'), field.text or u''
+                        if name in document:
+                            if not isinstance(document[name], list):
+                                document[name] = [document[name]]
+                            document[name].append(value)
+                        elif name in ('id', 'display_name', 'desy_icn'):
+                            document[name] = value
+                        else:
+                            document[name] = [value]
+                    self.pending.append(('add', document))
+                elif element.tag == 'query' and root.tag == 'delete':
+                    self.pending.append(('delete_query', element.text.strip()))
+                elif element.tag == 'id' and root.tag == 'delete':
+                    self.pending.append(('delete_id', element.text.strip()))
+            if root.tag in ('commit', 'optimize'):
+                self._commit()
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n<response>'
+                '<lst name="responseHeader"><int name="status">0</int><int name="QTime">0</int></lst>'
+                '</response>\n')
+
+    def _commit(self):
+        documents = dict(self.index.documents)
+        for operation, value in self.pending:
+            if operation == 'add':
+                documents[value['id']] = value
+            elif operation == 'delete_id':
+                documents.pop(value, None)
+            elif value == '*:*':
+                documents.clear()
+            else:
+                field, _, field_value = value.partition(':')
+                for identifier, document in documents.items():
+                    values = document.get(field) or []
+                    if field_value.strip('"') in (isinstance(values, list) and values or [values]):
+                        del documents[identifier]
+        self.pending = []
+        # Searches in progress keep the previous index.
+        self.index = Index(documents)
+
+class StandinRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # solrpy keeps its connections alive.
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self.handle_solr_request(url.path, url.query, None)
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+            self.handle_solr_request(url.path, body, None)
+        else:
+            self.handle_solr_request(url.path, url.query, body)
+
+    def handle_solr_request(self, path, query, body):
+        server = self.server
+        if server.latency:
+            time.sleep(random.expovariate(1. / server.latency))
+        if server.error_rate and random.random() < server.error_rate:
+            self.send_body(503, 'Injected error\n', 'text/plain')
+            return
+
+        params = urlparse.parse_qs(query or '')
+        if path.endswith('/select'):
+            self.send_body(200, server.standin.select(params))
+        elif path.endswith('/update'):
+            try:
+                data = server.standin.update(body or '<commit/>')
+            except SyntaxError, e:
+                self.send_body(400, 'Invalid XML: %s\n' % e, 'text/plain')
+                return
+            if params.get('commit', [''])[0] == 'true':
+                server.standin.update('<commit/>')
+            self.send_body(200, data)
+        else:
+            self.send_body(404, 'Unknown path: %s\n' % path, 'text/plain')
+
+    def send_body(self, code, body, content_type='text/xml; charset=utf-8'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class StandinServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    verbose = False
+
+def create_server(port=DEFAULT_PORT, host='localhost', documents=None, latency=0., error_rate=0.):
+    """
+    Returns a stand-in server with the documents already committed. The
+    latency is the mean added latency in seconds.
+    """
+    server = StandinServer((host, port), StandinRequestHandler)
+    server.standin = SolrStandin(documents)
+    server.latency = latency
+    server.error_rate = error_rate
+    return server
+
+if __name__ == '__main__':
+    import sys
+    from optparse import OptionParser
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-p", "--port", dest="port", type="int", default=DEFAULT_PORT,
+            help="TCP port to listen on")
+    parser.add_option("-H", "--host", dest="host", default='localhost',
+            help="host to listen on")
+    parser.add_option("-l", "--latency", dest="latency", type="float", default=0.,
+            help="mean latency added to every request in seconds")
+    parser.add_option("-e", "--error-rate", dest="error_rate", type="float", default=0.,
+            help="proportion of the requests failing with HTTP 503")
+    parser.add_option("-d", "--documents", dest="documents", default=None, metavar="DIRECTORY",
+            help="load the institutions of the MARCXML files of a directory, e.g. etc")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose", default=False,
+            help="log every request")
+
+    options, args = parser.parse_args()
+    documents = []
+    if options.documents:
+        import institution_indexer
+        documents = institution_indexer.get_institution_documents(options.documents)
+    server = create_server(options.port, options.host, documents, options.latency,
+            options.error_rate)
+    server.verbose = options.verbose
+    print >> sys.stderr, 'Listening on %s:%d with %d documents.' % (options.host,
+            options.port, len(documents))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
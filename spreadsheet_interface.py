@@ -2,17 +2,16 @@
 Module to interact with Google Docs Spreadsheet.
 """
 
-import ConfigParser
 import time
 import gdata.spreadsheet.text_db
 
-CLIENT = None
+from solr_connection import get_config
 
-cfg = ConfigParser.ConfigParser()
-cfg.read('accounts.cfg')
+CLIENT = None
 
 def connect():
     global CLIENT
+    cfg = get_config()
     CLIENT = gdata.spreadsheet.text_db.DatabaseClient(cfg.get('spreadsheet', 'user'),
             cfg.get('spreadsheet', 'password'))
     return CLIENT
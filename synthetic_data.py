@@ -0,0 +1,366 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Seeded synthetic institution records and affiliation corpora.
+
+The institutions are written as Inspire-style MARCXML in the chunked
+layout of institution_indexer (etc/institutions_NNN.xm, 200 records per
+file), with:
+
+    110  name (a), department (b), ICN (t), legacy ICN (u), acronym (x)
+    371  address (a), city (b), state (c), country (d), zip code (e),
+         country code (g)
+    410  name variants, some from ADS (9) and some uppercase ones
+    980  INSTITUTION, CORE for some, DELETED (c) for some
+
+The affiliations are written as 'ids<TAB>affiliation' lines, the ids being
+the comma-separated ids of the institutions of the affiliation in order,
+and empty when no institution matches. The affiliation is the last field as
+in the files read by disambiguate.py. The institutions are drawn with a
+Zipfian distribution, so that some are repeated a lot as in real corpora,
+and the affiliations get typos, email addresses and several institutions
+at the given rates.
+
+The same seed and sizes always give the same files. The sizes are
+multiples of a scale factor so that the benchmarks and the memory tests
+can be run at the production sizes.
+
+Usage: python synthetic_data.py [options]
+"""
+
+import bisect
+import os
+import random
+from xml.sax.saxutils import escape
+
+INSTITUTIONS_PER_SCALE = 1000
+AFFILIATIONS_PER_SCALE = 10000
+CHUNK_SIZE = 200
+FIRST_ID = 900000
+
+ZIPF_EXPONENT = 1.1
+TYPO_RATE = 0.1
+EMAIL_RATE = 0.05
+MULTIPLE_RATE = 0.1
+UNMATCHED_RATE = 0.02
+
+DELETED_RATE = 0.02
+OBSOLETE_RATE = 0.01
+CORE_RATE = 0.2
+DEPARTMENT_RATE = 0.3
+CITY_NAME_RATE = 0.3
+
+# (country, country code, weight, cities).
+COUNTRIES = (
+        (u'USA', u'US', 25, (u'Chicago', u'Berkeley', u'Stanford', u'Boston', u'Princeton',
+            u'Pasadena', u'Austin', u'Seattle', u'Ann Arbor', u'Baltimore')),
+        (u'Germany', u'DE', 10, (u'Hamburg', u'München', u'Berlin', u'Heidelberg', u'Bonn',
+            u'Göttingen')),
+        (u'France', u'FR', 7, (u'Paris', u'Orsay', u'Grenoble', u'Lyon', u'Marseille')),
+        (u'Italy', u'IT', 7, (u'Roma', u'Milano', u'Pisa', u'Padova', u'Frascati', u'Trieste')),
+        (u'Japan', u'JP', 7, (u'Tokyo', u'Kyoto', u'Tsukuba', u'Osaka', u'Nagoya')),
+        (u'China', u'CN', 6, (u'Beijing', u'Shanghai', u'Hefei', u'Nanjing')),
+        (u'UK', u'GB', 6, (u'London', u'Oxford', u'Cambridge', u'Edinburgh', u'Durham')),
+        (u'Russia', u'RU', 5, (u'Moscow', u'Dubna', u'Novosibirsk', u'Protvino')),
+        (u'Switzerland', u'CH', 3, (u'Geneva', u'Zürich', u'Bern', u'Lausanne')),
+        (u'Spain', u'ES', 3, (u'Madrid', u'Barcelona', u'Valencia')),
+        (u'India', u'IN', 3, (u'Mumbai', u'Kolkata', u'Bangalore')),
+        (u'Brazil', u'BR', 2, (u'São Paulo', u'Rio de Janeiro', u'Campinas')),
+        (u'Canada', u'CA', 2, (u'Toronto', u'Montreal', u'Vancouver')),
+        (u'Poland', u'PL', 2, (u'Warsaw', u'Kraków')),
+        )
+
+US_STATES = (u'IL', u'CA', u'MA', u'NJ', u'TX', u'WA', u'MI', u'MD')
+
+FIELDS = (u'Physics', u'Astronomy', u'Astrophysics', u'Nuclear Physics',
+        u'Theoretical Physics', u'High Energy Physics', u'Space Science',
+        u'Applied Mathematics', u'Particle Physics', u'Cosmology')
+
+# Templates of the names, with the legacy ICN style of each.
+NAME_TEMPLATES = (
+        (u'University of %(place)s', u'%(place)s U.'),
+        (u'%(place)s University', u'%(place)s U.'),
+        (u'%(place)s Institute of Technology', u'%(place)s Inst. Tech.'),
+        (u'Institute of %(field)s, %(place)s', u'%(place)s, Inst. %(field)s'),
+        (u'%(place)s National Laboratory', u'%(place)s Natl. Lab.'),
+        (u'%(place)s Observatory', u'%(place)s Obs.'),
+        (u'Research Center for %(field)s %(place)s', u'%(place)s, Res. Ctr.'),
+        )
+
+DEPARTMENTS = (u'Department of %s', u'Dept. of %s', u'Division of %s', u'Faculty of %s')
+
+EMAIL_DOMAINS = (u'gmail.com', u'mail.ru', u'yahoo.com', u'cern.ch', u'example.edu')
+
+UNMATCHED_AFFILIATIONS = (u'Private address', u'Unaffiliated', u'Independent researcher',
+        u'Home address, %(city)s')
+
+SYLLABLES = (u'ka', u'lo', u'mi', u'ran', u'tor', u've', u'sun', u'bel', u'dor', u'na',
+        u'gra', u'hel', u'stein', u'ford', u'ton')
+
+def _choose_weighted(generator, cumulative_weights):
+    return bisect.bisect(cumulative_weights, generator.random() * cumulative_weights[-1])
+
+def _get_cumulative_weights(weights):
+    cumulative_weights, total = [], 0.
+    for weight in weights:
+        total += weight
+        cumulative_weights.append(total)
+    return cumulative_weights
+
+def get_place_name(generator, extra_syllables=0):
+    return u''.join(generator.choice(SYLLABLES)
+            for _ in xrange(generator.randint(2, 3 + extra_syllables))).title()
+
+def generate_institutions(number, seed=0):
+    """
+    Returns `number` random institutions as dictionaries. Their names and
+    ICNs are unique, so that every affiliation has a single correct id.
+    """
+    generator = random.Random(seed)
+    country_weights = _get_cumulative_weights([c[2] for c in COUNTRIES])
+    institutions = []
+    names, legacy_icns = set(), set()
+    for i in xrange(number):
+        country, country_code, _, cities = COUNTRIES[_choose_weighted(generator, country_weights)]
+        city = generator.choice(cities)
+        # Some institutions are named after their city, the others after a
+        # made-up place. Names already taken are drawn again, from longer
+        # made-up places as the attempts fail.
+        place = generator.random() < CITY_NAME_RATE and city or get_place_name(generator)
+        attempts = 0
+        while True:
+            field = generator.choice(FIELDS)
+            template, icn_template = generator.choice(NAME_TEMPLATES)
+            name = template % {'place': place, 'field': field}
+            legacy_icn = icn_template % {'place': place, 'field': field}
+            if name not in names and legacy_icn not in legacy_icns:
+                break
+            attempts += 1
+            place = get_place_name(generator, attempts // 10)
+        names.add(name)
+        legacy_icns.add(legacy_icn)
+        acronym = u''.join(word[0] for word in name.replace(',', '').split()
+                if word[0].isupper())
+
+        institution = {
+                'id': unicode(FIRST_ID + i),
+                'name': name,
+                'icn': legacy_icn,
+                'legacy_icn': legacy_icn,
+                'acronym': acronym,
+                'city': city,
+                'country': country,
+                'country_code': country_code,
+                'address': [u'%d %s Street' % (generator.randint(1, 999), get_place_name(generator))],
+                'zip_code': u'%05d' % generator.randint(1000, 99999),
+                'state': country_code == u'US' and generator.choice(US_STATES) or None,
+                'department': generator.random() < DEPARTMENT_RATE and
+                        generator.choice(DEPARTMENTS) % field or None,
+                'core': generator.random() < CORE_RATE,
+                'deleted': generator.random() < DELETED_RATE,
+                }
+        if generator.random() < OBSOLETE_RATE:
+            institution['icn'] = u'obsolete ' + institution['icn']
+        if generator.random() < 0.3:
+            institution['address'].append(u'P.O. Box %d' % generator.randint(1, 9999))
+
+        # Poisson-like number of name variants, mostly short forms.
+        variants = []
+        for _ in xrange(min(int(generator.expovariate(0.7)), 6)):
+            draw = generator.random()
+            if draw < 0.4:
+                variant = u'%s, %s' % (name, city)
+            elif draw < 0.6:
+                variant = legacy_icn
+            elif draw < 0.8:
+                variant = name.upper()
+            else:
+                variant = u'%s %s' % (acronym, city)
+            if variant not in [v for v, _ in variants]:
+                variants.append((variant, generator.random() < 0.1))
+        institution['variants'] = variants
+        institutions.append(institution)
+    return institutions
+
+def _get_datafield(tag, subfields):
+    return u'  <datafield tag="%s" ind1=" " ind2=" ">\n%s  </datafield>\n' % (tag,
+            u''.join(u'    <subfield code="%s">%s</subfield>\n' % (code, escape(value))
+                    for code, value in subfields if value))
+
+def get_marcxml_record(institution):
+    """
+    Returns the MARCXML of an institution.
+    """
+    parts = [u'<record>\n  <controlfield tag="001">%s</controlfield>\n' % institution['id']]
+    parts.append(_get_datafield('110', [('a', institution['name']),
+            ('b', institution['department']), ('t', institution['icn']),
+            ('u', institution['legacy_icn']), ('x', institution['acronym'])]))
+    parts.append(_get_datafield('371', [('a', address) for address in institution['address']] +
+            [('b', institution['city']), ('c', institution['state']),
+                    ('d', institution['country']), ('e', institution['zip_code']),
+                    ('g', institution['country_code'])]))
+    for variant, ads in institution['variants']:
+        parts.append(_get_datafield('410', [('a', variant), ('9', ads and u'ADS' or None)]))
+    parts.append(_get_datafield('980', [('a', u'INSTITUTION')]))
+    if institution['core']:
+        parts.append(_get_datafield('980', [('a', u'CORE')]))
+    if institution['deleted']:
+        parts.append(_get_datafield('980', [('c', u'DELETED')]))
+    parts.append(u'</record>\n')
+    return u''.join(parts)
+
+def write_institution_files(institutions, directory='etc', chunk_size=CHUNK_SIZE):
+    """
+    Writes the institutions to the MARCXML files of a directory, in the
+    layout of institution_indexer.get_institution_marcxml, and returns
+    their paths.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    paths = []
+    for number, start in enumerate(xrange(0, len(institutions), chunk_size)):
+        path = os.path.join(directory, 'institutions_%03d.xm' % number)
+        out = open(path, 'w')
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        out.write('<!-- Search-Engine-Total-Number-Of-Results: %d -->\n' % len(institutions))
+        out.write('<collection xmlns="http://www.loc.gov/MARC21/slim">\n')
+        for institution in institutions[start:start + chunk_size]:
+            out.write(get_marcxml_record(institution).encode('utf_8'))
+        out.write('</collection>\n')
+        out.close()
+        paths.append(path)
+    return paths
+
+def add_typo(generator, text):
+    """
+    Returns the text with a character deleted, duplicated, replaced or
+    swapped with the next one.
+    """
+    if len(text) < 2:
+        return text
+    i = generator.randrange(len(text) - 1)
+    draw = generator.random()
+    if draw < 0.25:
+        return text[:i] + text[i + 1:]
+    elif draw < 0.5:
+        return text[:i] + text[i] + text[i:]
+    elif draw < 0.75:
+        return text[:i] + generator.choice(u'abcdefghijklmnopqrstuvwxyz') + text[i + 1:]
+    return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+
+def get_institution_affiliation(generator, institution):
+    """
+    Returns one of the ways authors write an institution.
+    """
+    draw = generator.random()
+    if draw < 0.4:
+        affiliation = u'%s, %s, %s' % (institution['name'], institution['city'],
+                institution['country'])
+    elif draw < 0.55:
+        affiliation = institution['legacy_icn']
+    elif draw < 0.7 and institution['variants']:
+        affiliation = generator.choice(institution['variants'])[0]
+    elif draw < 0.85:
+        affiliation = u'%s, %s %s' % (institution['name'], institution['zip_code'],
+                institution['city'])
+    else:
+        affiliation = u'%s, %s, %s' % (institution['name'], institution['address'][0],
+                institution['city'])
+    if institution['department'] and generator.random() < 0.5:
+        affiliation = u'%s, %s' % (institution['department'], affiliation)
+    return affiliation
+
+def iter_affiliations(institutions, number, seed=0):
+    """
+    Yields `number` random (affiliation, ids) pairs of the indexable
+    institutions.
+    """
+    generator = random.Random(seed)
+    institutions = [i for i in institutions if not i['deleted'] and
+            not i['icn'].startswith('obsolete')]
+    # The ranks of the Zipfian distribution are shuffled so that the most
+    # frequent institutions are spread over the ids.
+    ranks = range(len(institutions))
+    generator.shuffle(ranks)
+    weights = _get_cumulative_weights([1. / (rank + 1) ** ZIPF_EXPONENT for rank in ranks])
+
+    for _ in xrange(number):
+        if generator.random() < UNMATCHED_RATE:
+            affiliation = generator.choice(UNMATCHED_AFFILIATIONS) % \
+                    {'city': generator.choice(generator.choice(COUNTRIES)[3])}
+            yield affiliation, []
+            continue
+
+        members = [institutions[_choose_weighted(generator, weights)]]
+        if generator.random() < MULTIPLE_RATE and len(institutions) > 1:
+            # Without replacement: an institution is not paired with itself.
+            while len(members) < 2:
+                member = institutions[_choose_weighted(generator, weights)]
+                if member is not members[0]:
+                    members.append(member)
+        parts = [get_institution_affiliation(generator, member) for member in members]
+        affiliation = generator.choice((u'; ', u' and ')).join(parts)
+        if generator.random() < TYPO_RATE:
+            for _ in xrange(generator.randint(1, 2)):
+                affiliation = add_typo(generator, affiliation)
+        if generator.random() < EMAIL_RATE:
+            affiliation += generator.choice((u'; e-mail: %s@%s', u' (%s@%s)', u', Email: %s@%s')) % (
+                    get_place_name(generator).lower(), generator.choice(EMAIL_DOMAINS))
+        yield affiliation, [member['id'] for member in members]
+
+def write_affiliations(pairs, path):
+    """
+    Writes (affiliation, ids) pairs as 'ids<TAB>affiliation' lines.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    out = open(path, 'w')
+    for affiliation, ids in pairs:
+        out.write((u'%s\t%s\n' % (u','.join(ids), affiliation.replace(u'\t', u' '))).encode('utf_8'))
+    out.close()
+
+def generate(scale=1., seed=0, directory='etc', affiliations_path='var/affiliations.tsv',
+        number_of_institutions=None, number_of_affiliations=None):
+    """
+    Writes the institution files and the affiliation file of a scale
+    factor. Returns the numbers of institutions and affiliations.
+    """
+    if number_of_institutions is None:
+        number_of_institutions = int(INSTITUTIONS_PER_SCALE * scale)
+    if number_of_affiliations is None:
+        number_of_affiliations = int(AFFILIATIONS_PER_SCALE * scale)
+    institutions = generate_institutions(number_of_institutions, seed)
+    if directory:
+        write_institution_files(institutions, directory)
+    if affiliations_path:
+        write_affiliations(iter_affiliations(institutions, number_of_affiliations, seed),
+                affiliations_path)
+    return number_of_institutions, number_of_affiliations
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-s", "--scale", dest="scale", type="float", default=1.,
+            help="scale factor: %d institutions and %d affiliations per unit" % (
+                    INSTITUTIONS_PER_SCALE, AFFILIATIONS_PER_SCALE))
+    parser.add_option("-i", "--institutions", dest="institutions", type="int", default=None,
+            help="number of institutions, instead of the scale factor")
+    parser.add_option("-a", "--affiliations", dest="affiliations", type="int", default=None,
+            help="number of affiliations, instead of the scale factor")
+    parser.add_option("--seed", dest="seed", type="int", default=0,
+            help="seed of the random generator")
+    parser.add_option("-d", "--directory", dest="directory", default='etc',
+            help="directory of the MARCXML files, none if empty")
+    parser.add_option("-o", "--output", dest="output", default='var/affiliations.tsv',
+            help="affiliation file, none if empty")
+
+    options, args = parser.parse_args()
+    if options.directory and os.path.exists(options.directory) and os.listdir(options.directory):
+        parser.error('%s is not empty, the institution files would be mixed' % options.directory)
+    number_of_institutions, number_of_affiliations = generate(options.scale, options.seed,
+            options.directory, options.output, options.institutions, options.affiliations)
+    print 'Generated %d institutions in %s and %d affiliations in %s.' % (
+            number_of_institutions, options.directory or 'no directory',
+            number_of_affiliations, options.output or 'no file')
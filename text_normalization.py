@@ -0,0 +1,25 @@
+"""
+Normalization of institution names and affiliations shared by the local
+indexes.
+"""
+
+import re
+import unicodedata
+
+RE_NON_WORD = re.compile(r'\W+', re.UNICODE)
+
+def to_unicode(text):
+    if not isinstance(text, unicode):
+        text = text.decode('utf_8', 'replace')
+    return text
+
+def strip_accents(s):
+    return ''.join((c for c in unicodedata.normalize('NFD', s) if unicodedata.category(c) != 'Mn'))
+
+def normalize(text):
+    """
+    Returns a lowercase unicode string without accents and with punctuation
+    replaced by single spaces.
+    """
+    text = strip_accents(to_unicode(text)).lower()
+    return RE_NON_WORD.sub(' ', text).strip()
@@ -0,0 +1,199 @@
+"""
+Batch matching of affiliations without Solr.
+
+All the unique cleaned affiliations and all the indexed institutions are
+vectorized into sparse TF-IDF matrices. The candidates of each affiliation
+are then found by multiplying chunks of the affiliation matrix with the
+institution matrix, so the memory used only depends on the chunk size.
+
+The results have the same shape as those of
+institution_searcher.search_institutions, with cosine similarities as
+scores, so that get_separation_score keeps its meaning.
+
+Requires NumPy and SciPy.
+"""
+
+import math
+import re
+
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    numpy = None
+
+import institution_indexer
+import institution_searcher as s
+
+RE_WORD = re.compile(r'\w\w+', re.UNICODE)
+
+# Fields of the indexed documents that describe an institution.
+DOCUMENT_FIELDS = ('display_name', 'institution', 'institution_acronym',
+        'name_variants', 'city', 'country')
+
+def normalize(text):
+    """
+    Returns a lowercase unicode string without accents.
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf_8', 'replace')
+    return s.strip_accents(text).lower()
+
+def get_word_tokens(text):
+    return RE_WORD.findall(normalize(text))
+
+def get_char_ngrams(text, n=3):
+    """
+    Returns the character n-grams of each word, padded with spaces.
+    """
+    ngrams = []
+    for word in get_word_tokens(text):
+        word = ' %s ' % word
+        ngrams += [word[i:i + n] for i in xrange(len(word) - n + 1)]
+    return ngrams
+
+def get_document_text(document):
+    """
+    Returns the text of an indexed institution document.
+    """
+    values = []
+    for field in DOCUMENT_FIELDS:
+        value = document.get(field)
+        if isinstance(value, list):
+            values += value
+        elif value:
+            values.append(value)
+    return u' '.join(values)
+
+class TfidfMatcher(object):
+    """
+    Sparse TF-IDF index of the institution documents.
+
+    `analyzer` is either 'word' for word tokens or 'char' for character
+    n-grams, which are more tolerant to typos and abbreviations.
+    """
+
+    def __init__(self, documents, analyzer='word', ngram=3):
+        if numpy is None:
+            raise ImportError('The TF-IDF matcher requires NumPy and SciPy.')
+
+        self.analyzer = analyzer
+        self.ngram = ngram
+        self.ids = [document['id'] for document in documents]
+        self.columns = dict((identifier, column) for column, identifier in enumerate(self.ids))
+        self.display_names = [document['display_name'] for document in documents]
+
+        tokens = [self.tokenize(get_document_text(document)) for document in documents]
+        self.vocabulary = {}
+        document_frequencies = []
+        for document_tokens in tokens:
+            for token in set(document_tokens):
+                index = self.vocabulary.setdefault(token, len(self.vocabulary))
+                if index == len(document_frequencies):
+                    document_frequencies.append(0)
+                document_frequencies[index] += 1
+
+        number = len(documents)
+        self.idf = numpy.array([math.log((1. + number) / (1. + df)) + 1
+                for df in document_frequencies])
+        # Transposed once so that every chunk product is CSR x CSC.
+        self.matrix = self.vectorize(tokens).T.tocsc()
+
+    def tokenize(self, text):
+        if self.analyzer == 'char':
+            return get_char_ngrams(text, self.ngram)
+        return get_word_tokens(text)
+
+    def vectorize(self, tokens):
+        """
+        Returns the L2-normalized TF-IDF CSR matrix of lists of tokens.
+        Tokens missing from the vocabulary are ignored.
+        """
+        indptr, indices, data = [0], [], []
+        for row_tokens in tokens:
+            counts = {}
+            for token in row_tokens:
+                index = self.vocabulary.get(token)
+                if index is not None:
+                    counts[index] = counts.get(index, 0) + 1
+            columns = sorted(counts)
+            values = numpy.array([counts[c] for c in columns], dtype=float) * \
+                    self.idf[numpy.array(columns, dtype=int)]
+            norm = numpy.sqrt((values ** 2).sum())
+            if norm:
+                values /= norm
+            indices += columns
+            data += values.tolist()
+            indptr.append(len(indices))
+
+        return scipy.sparse.csr_matrix((data, indices, indptr),
+                shape=(len(tokens), len(self.vocabulary)))
+
+    def search_queries(self, queries, k=10, chunk_size=1000, blocks=None):
+        """
+        Returns the list of the top `k` results of each query.
+
+        `blocks` optionally gives for each query the set of the ids of the
+        institutions it is restricted to, or None.
+        """
+        out = []
+        for start in xrange(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+            scores = self.vectorize([self.tokenize(q) for q in chunk]).dot(self.matrix).tocsr()
+            for row in xrange(len(chunk)):
+                begin, end = scores.indptr[row], scores.indptr[row + 1]
+                values = scores.data[begin:end]
+                columns = scores.indices[begin:end]
+                block = blocks and blocks[start + row]
+                if block:
+                    allowed = numpy.array([self.ids[c] in block for c in columns], dtype=bool)
+                    if allowed.any():
+                        values, columns = values[allowed], columns[allowed]
+                if len(values) > k:
+                    top = numpy.argpartition(-values, k)[:k]
+                    values, columns = values[top], columns[top]
+                order = numpy.argsort(-values, kind='mergesort')
+                out.append([{
+                    'id': self.ids[columns[i]],
+                    'display_name': self.display_names[columns[i]],
+                    'score': float(values[i]),
+                    } for i in order if values[i] > 0])
+        return out
+
+    def search_institutions(self, institutions, clean_up=True, k=10, chunk_size=1000, gazetteer=None):
+        """
+        Searches for multiple institutions and returns (institution, results)
+        pairs like institution_searcher.search_institutions. Institutions that
+        are identical once cleaned are only vectorized once.
+
+        With a gazetteer, every institution is restricted to the block of the
+        country and city it mentions, unless no candidate is in the block.
+        """
+        keys = []
+        queries = {}
+        for institution in institutions:
+            query = clean_up and s._clean_affiliation(institution) or institution
+            block = None
+            if gazetteer is not None:
+                place = gazetteer.detect(institution)
+                block = place and gazetteer.get_ids(place) or None
+            keys.append((query, block))
+            queries.setdefault((query, block), len(queries))
+
+        unique_keys = sorted(queries, key=queries.get)
+        results = self.search_queries([query for query, _ in unique_keys], k, chunk_size,
+                [block for _, block in unique_keys])
+
+        return [(institution, results[queries[key]]) for institution, key in zip(institutions, keys)]
+
+def get_matcher(directory='etc', analyzer='word'):
+    """
+    Returns a matcher over the institutions of the MARCXML files.
+    """
+    return TfidfMatcher(institution_indexer.get_institution_documents(directory), analyzer)
+
+def search_institutions(institutions, clean_up=True, directory='etc', analyzer='word'):
+    """
+    Batch equivalent of institution_searcher.search_institutions.
+    """
+    return get_matcher(directory, analyzer).search_institutions(institutions, clean_up)
@@ -0,0 +1,76 @@
+"""
+Precomputed token sets of the institution names used to rerank results.
+
+The indexer assigns every normalized word of the display names and name
+variants an integer id, in sorted order so that the ids only change when
+the vocabulary does, and stores the token id set of each name. Reranking a
+query then only needs set intersections of small integers.
+"""
+
+import marshal
+import os
+import re
+
+import local_indexes
+from text_normalization import normalize
+
+FEATURES_FILE = 'token_features.marshal'
+
+RE_TOKEN = re.compile(r'\w\w+', re.UNICODE)
+
+def get_tokens(text):
+    return set(RE_TOKEN.findall(normalize(text)))
+
+def get_names(document):
+    names = [document['display_name']]
+    for name in document.get('name_variants') or []:
+        if name not in names:
+            names.append(name)
+    return names
+
+def build_token_features(documents, directory):
+    """
+    Builds the token id sets of the names of the documents and writes them
+    to `directory`.
+    """
+    tokens = {}
+    for document in documents:
+        tokens[document['id']] = [get_tokens(name) for name in get_names(document)]
+
+    vocabulary = set()
+    for name_tokens in tokens.values():
+        for name in name_tokens:
+            vocabulary.update(name)
+    vocabulary = dict((token, i) for i, token in enumerate(sorted(vocabulary)))
+
+    names = {}
+    for identifier, name_tokens in tokens.items():
+        names[identifier] = [tuple(sorted(vocabulary[t] for t in name)) for name in name_tokens]
+
+    local_indexes.write_file(os.path.join(directory, FEATURES_FILE), marshal.dumps((vocabulary, names)))
+
+class TokenFeatures(object):
+
+    def __init__(self, directory):
+        self.vocabulary, names = marshal.load(open(os.path.join(directory, FEATURES_FILE), 'rb'))
+        self.names = dict((identifier, [frozenset(name) for name in name_tokens])
+                for identifier, name_tokens in names.items())
+
+    def get_query_ids(self, query):
+        """
+        Returns the token ids of a query. Unknown tokens cannot match any
+        name and are dropped.
+        """
+        vocabulary = self.vocabulary
+        return frozenset(vocabulary[t] for t in get_tokens(query) if t in vocabulary)
+
+    def get_coverage(self, query_ids, identifier):
+        """
+        Returns the best proportion of the tokens of a name of the
+        institution that appear in the query, or None if the institution is
+        unknown.
+        """
+        names = self.names.get(identifier)
+        if not names:
+            return None
+        return max([float(len(name & query_ids)) / len(name) for name in names if name] or [0.])
@@ -0,0 +1,201 @@
+#!/usr/bin/python
+"""
+Tracing of the Celery tasks of the searches.
+
+When the SEARCH_TRACE environment variable names a directory, every run of
+search_institutions or institution_test_suite.evaluate that fans out to
+Celery gets a trace context, which is passed to each of its tasks. The
+spans are appended as JSON lines to a file of the run in that directory:
+
+    client   enqueue   time spent in delay()
+             task N    from the enqueueing of task N to the time the
+                       client saw it ready
+             collect   time spent fetching the result of a task
+    worker   queued    from the enqueueing of the task to its start, i.e.
+                       the broker queueing and the worker pickup
+             query     each query of the task
+             task      the whole task, before the result is serialized
+
+Once all the results are collected, the spans are converted to the Chrome
+trace event format, which chrome://tracing and Perfetto show as a timeline
+with one row per worker process. Queueing delays, stragglers and the time
+between the end of a task and the collection of its result are then
+visible. The spans of workers running on other hosts are only written if
+the directory is shared, and are shifted by the differences between the
+clocks of the hosts.
+
+Usage: python tracing.py trace_file.jsonl [...]
+"""
+
+import itertools
+import json
+import os
+import socket
+import thread
+import time
+
+TRACE_VARIABLE = 'SEARCH_TRACE'
+
+# (process id, path) of the trace files in which the process is named.
+_NAMED = set()
+_RUNS = itertools.count()
+
+def start_trace(name, directory=None):
+    """
+    Returns the trace context of a new run, or None if tracing is disabled.
+    """
+    directory = directory or os.environ.get(TRACE_VARIABLE)
+    if not directory:
+        return None
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    trace_id = '%s-%s-%d-%d' % (name, time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+            _RUNS.next())
+    return {'id': trace_id, 'path': os.path.join(directory, trace_id + '.jsonl')}
+
+def _append(path, lines):
+    # Single writes in append mode do not interleave between processes. The
+    # file is closed right away, as the workers never know when a run ends.
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        os.write(fd, ''.join(lines))
+    finally:
+        os.close(fd)
+
+def _write_event(context, event):
+    for name, value in event.get('args', {}).items():
+        if isinstance(value, str):
+            event['args'][name] = value.decode('utf_8', 'replace')
+    event['pid'] = os.getpid()
+    lines = [json.dumps(event) + '\n']
+    key = (os.getpid(), context['path'])
+    if key not in _NAMED:
+        # Names the process in the trace the first time.
+        _NAMED.add(key)
+        lines.insert(0, json.dumps({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                'args': {'name': '%s:%d' % (socket.gethostname(), os.getpid())}}) + '\n')
+    _append(context['path'], lines)
+
+def add_span(context, name, start, end, **args):
+    """
+    Records a span of the current thread. Does nothing without context.
+    """
+    if context is None:
+        return
+    args.setdefault('task', context.get('task'))
+    _write_event(context, {'name': name, 'ph': 'X', 'ts': start * 1e6,
+            'dur': (end - start) * 1e6, 'tid': thread.get_ident(), 'args': args})
+
+def add_async_span(context, name, identifier, start, end, **args):
+    """
+    Records a span that overlaps the other spans of the thread, such as the
+    lifetime of a task on the client.
+    """
+    if context is None:
+        return
+    event = {'name': name, 'cat': 'task', 'id': identifier, 'tid': thread.get_ident()}
+    _write_event(context, dict(event, ph='b', ts=start * 1e6, args=args))
+    _write_event(context, dict(event, ph='e', ts=end * 1e6))
+
+def start_task(context):
+    """
+    Records the time a task spent queued and returns its start time. Called
+    by the tasks when they start.
+    """
+    start = time.time()
+    if context is not None:
+        add_span(context, 'queued', context['enqueued'], start)
+    return start
+
+def write_chrome_trace(path):
+    """
+    Converts a file of spans to the Chrome trace event format and returns
+    the path of the converted file.
+    """
+    events = [json.loads(line) for line in open(path) if line.strip()]
+    output = os.path.splitext(path)[0] + '.json'
+    json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, open(output, 'w'))
+    return output
+
+class TracedResult(object):
+    """
+    Async result of a traced task, which records when it is first seen
+    ready.
+    """
+
+    def __init__(self, async_result, task):
+        self.async_result = async_result
+        self.task = task
+
+    def ready(self):
+        ready = self.async_result.ready()
+        if ready and self.task[2] is None:
+            self.task[2] = time.time()
+        return ready
+
+    def __getattr__(self, name):
+        return getattr(self.async_result, name)
+
+class TaskTracer(object):
+    """
+    Sends the tasks of a run with their trace contexts and records their
+    client spans. Without tracing, only sends and collects the tasks.
+    """
+
+    def __init__(self, name, directory=None):
+        self.context = start_trace(name, directory)
+        # [async result, enqueue time, ready time] of every task.
+        self.tasks = []
+
+    def delay(self, function, *args, **kwargs):
+        """
+        Calls function.delay(*args, **kwargs), with the trace context of a
+        new task if tracing is enabled, and returns its result.
+        """
+        start = time.time()
+        if self.context is not None:
+            kwargs['trace'] = dict(self.context, task=len(self.tasks), enqueued=start)
+        async_result = function.delay(*args, **kwargs)
+        add_span(self.context, 'enqueue', start, time.time(), task=len(self.tasks))
+        task = [async_result, start, None]
+        self.tasks.append(task)
+        return TracedResult(async_result, task)
+
+    def wait(self, interval=0.1):
+        """
+        Waits until all the tasks are ready.
+        """
+        while True:
+            if all(task[2] is not None or TracedResult(task[0], task).ready()
+                    for task in self.tasks):
+                return
+            time.sleep(interval)
+
+    def get_results(self):
+        """
+        Returns the results of the tasks in order and writes the trace.
+        """
+        results = []
+        for number, (async_result, _, _) in enumerate(self.tasks):
+            start = time.time()
+            results.append(async_result.result)
+            add_span(self.context, 'collect', start, time.time(), task=number)
+        self.finish()
+        return results
+
+    def finish(self):
+        """
+        Writes the trace in the Chrome format, if tracing is enabled.
+        """
+        if self.context is None:
+            return
+        for number, (_, enqueued, ready) in enumerate(self.tasks):
+            if ready is not None:
+                add_async_span(self.context, 'task %d' % number, number, enqueued, ready)
+        if os.path.exists(self.context['path']):
+            print 'Trace written to %s.' % write_chrome_trace(self.context['path'])
+
+if __name__ == '__main__':
+    import sys
+    for path in sys.argv[1:]:
+        print write_chrome_trace(path)